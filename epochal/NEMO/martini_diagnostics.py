@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MARTINI spin-up convergence diagnostics from the rebuilt restarts.
+
+Volume weights (e1t*e2t*e3t*tmask) and basin masks are computed once from the
+mesh_mask.nc file and cached as memory-mapped arrays. Each leg restart is then
+reduced level by level to global and basin-mean temperature, salinity and heat
+content. Legs are processed in parallel and appended to a netCDF time series,
+so that only new legs are computed when the command is run again.
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xarray as xr
+import netCDF4 as nc
+from restart_manifest import parse_legs
+from martini_forecast import MARTINI_BASE, DAYS_PER_YEAR, get_restart_list
+
+# reference density (kg/m3) and specific heat (J/kg/K) of NEMO
+RHO0 = 1026.
+RCP = 3991.86795711963
+
+
+def compute_weights(meshfile, basinfile=None):
+    """
+    Volume weights and basin masks from mesh_mask.nc and (optionally) a subbasins file,
+    whose variables ending in 'msk' (e.g. atlmsk, pacmsk, indmsk) are used as basins
+
+    Returns:
+        The (z, y, x) volume weights, the (basin, y, x) masks and the basin names
+    """
+
+    with nc.Dataset(meshfile) as mesh:
+        tmask = mesh.variables['tmask'][0].astype('f8')
+        area = mesh.variables['e1t'][0].astype('f8') * mesh.variables['e2t'][0].astype('f8')
+        if 'e3t_0' in mesh.variables:
+            thick = mesh.variables['e3t_0'][0].astype('f8')
+        else:
+            thick = mesh.variables['e3t_1d'][0].astype('f8')[:, np.newaxis, np.newaxis]
+    volume = np.asarray(tmask * area * thick)
+
+    names, masks = ['global'], [np.ones(volume.shape[1:])]
+    if basinfile:
+        with nc.Dataset(basinfile) as basins:
+            for var in basins.variables:
+                if var.endswith('msk'):
+                    names.append(var[:-3])
+                    masks.append(np.asarray(basins.variables[var][:]).squeeze().astype('f8'))
+
+    return volume, np.stack(masks), names
+
+
+def load_weights(meshfile, cachedir, basinfile=None):
+    """
+    Load the cached weights, computing them if the cache is missing or older than the mesh files
+
+    Returns:
+        The paths of the cached volume and basin arrays, and the basin names
+    """
+
+    paths = {key: os.path.join(cachedir, key + '.npy') for key in ['volume', 'basins']}
+    namefile = os.path.join(cachedir, 'basins.txt')
+    sources = [meshfile] + ([basinfile] if basinfile else [])
+    newest = max(os.path.getmtime(source) for source in sources)
+
+    if not all(os.path.exists(path) and os.path.getmtime(path) > newest
+               for path in list(paths.values()) + [namefile]):
+        print(f'Computing volume weights from {meshfile}')
+        os.makedirs(cachedir, exist_ok=True)
+        volume, masks, names = compute_weights(meshfile, basinfile)
+        np.save(paths['volume'], volume)
+        np.save(paths['basins'], masks)
+        with open(namefile, 'w', encoding='utf-8') as fff:
+            fff.write('\n'.join(names))
+
+    with open(namefile, 'r', encoding='utf-8') as fff:
+        names = fff.read().split('\n')
+
+    return paths, names
+
+
+def reduce_leg(filename, paths):
+    """
+    Worker: volume-weighted sums of a leg restart, computed level by level
+
+    Returns:
+        Time (years) and a dictionary of (basin) arrays
+    """
+
+    volume = np.load(paths['volume'], mmap_mode='r')
+    basins = np.load(paths['basins'], mmap_mode='r')
+    nbasins = basins.shape[0]
+    flat_basins = basins.reshape(nbasins, -1)
+
+    sums = {key: np.zeros(nbasins) for key in ['volume', 'temp', 'salt']}
+    with nc.Dataset(filename) as ds:
+        time = float(ds.variables['adatrj'][...]) / DAYS_PER_YEAR if 'adatrj' in ds.variables else np.nan
+        for level in range(volume.shape[0]):
+            weights = flat_basins * volume[level].ravel()
+            sums['volume'] += weights.sum(axis=1)
+            sums['temp'] += weights @ np.asarray(ds.variables['tn'][0, level], dtype='f8').ravel()
+            sums['salt'] += weights @ np.asarray(ds.variables['sn'][0, level], dtype='f8').ravel()
+
+    return time, {
+        'thetao': sums['temp'] / sums['volume'],
+        'so': sums['salt'] / sums['volume'],
+        'ohc': RHO0 * RCP * sums['temp'],
+        'volume': sums['volume']
+    }
+
+
+def compute_diagnostics(flist, legs, paths, names, nproc=None):
+    """Reduce the restarts of the legs in parallel into a dataset of time series"""
+
+    nproc = min(nproc or os.cpu_count(), len(flist))
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        results = list(pool.map(reduce_leg, flist, [paths] * len(flist)))
+
+    attrs = {
+        'thetao': {'long_name': 'volume-mean potential temperature', 'units': 'degC'},
+        'so': {'long_name': 'volume-mean salinity', 'units': '1e-3'},
+        'ohc': {'long_name': 'ocean heat content', 'units': 'J'},
+        'volume': {'long_name': 'ocean volume', 'units': 'm3'}
+    }
+    data = xr.Dataset(
+        {var: (('leg', 'basin'), np.stack([result[1][var] for result in results]), attrs[var])
+         for var in attrs},
+        coords={'leg': legs, 'basin': names,
+                'time': ('leg', [result[0] for result in results], {'units': 'years'})})
+
+    return data
+
+
+def update_diagnostics(expname, meshfile, basinfile=None, legs='all', nproc=None, basedir=MARTINI_BASE):
+    """
+    Append the diagnostics of the legs not yet processed to <martini>/<exp>/diagnostics.nc
+
+    Returns:
+        The full diagnostics dataset
+    """
+
+    martini_dir = os.path.join(basedir, expname)
+    outfile = os.path.join(martini_dir, 'diagnostics.nc')
+    paths, names = load_weights(meshfile, os.path.join(martini_dir, 'weights'), basinfile)
+
+    available = [int(os.path.basename(os.path.dirname(path)))
+                 for path in get_restart_list(expname, basedir=basedir)]
+    selected = parse_legs(legs, available)
+
+    old = None
+    if os.path.exists(outfile):
+        with xr.open_dataset(outfile) as ds:
+            old = ds.load()
+        selected = [leg for leg in selected if leg not in old['leg'].values]
+
+    if not selected:
+        print('No new legs to process')
+        return old
+
+    print(f'Computing diagnostics for {len(selected)} legs')
+    flist = get_restart_list(expname, legs=selected, basedir=basedir)
+    data = compute_diagnostics(flist, selected, paths, names, nproc=nproc)
+    if old is not None:
+        data = xr.concat([old, data], dim='leg').sortby('leg')
+
+    data.to_netcdf(outfile + '.tmp')
+    os.replace(outfile + '.tmp', outfile)
+
+    return data
+
+
+def get_args():
+    """Command line parser for the MARTINI diagnostics"""
+
+    parser = argparse.ArgumentParser(
+        description="Global and basin-mean T, S and heat content time series from the rebuilt restarts.")
+    parser.add_argument("expname", metavar="EXPNAME", help="Experiment name")
+    parser.add_argument("meshmask", type=str, help="path to the mesh_mask.nc file")
+    parser.add_argument("--basins", type=str, default=None,
+                        help="subbasins file with *msk variables (e.g. atlmsk, pacmsk, indmsk)")
+    parser.add_argument("--legs", type=str, default='all',
+                        help="legs to process: a single leg, a range (10-20), a list (1,5,10-12) or all")
+    parser.add_argument("--nproc", type=int, default=None, help="number of workers (default: all the cpus)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    update_diagnostics(args.expname, args.meshmask, basinfile=args.basins,
+                       legs=args.legs, nproc=args.nproc)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MARTINI forecast of the ocean state from the rebuilt restarts of the last legs.
+
+For each gridpoint the evolution of the fields (by default tn, sn, tb, sb) over
+the last N legs is fitted with either a linear trend or an exponential relaxation
+towards an equilibrium value, and the restart is extrapolated K years ahead.
+Fits are closed-form least squares computed on dask chunks, so that the memory
+footprint is bounded by the chunk size even on eORCA025.
+"""
+
+import os
+import glob
+import shutil
+import argparse
+import numpy as np
+import xarray as xr
+import dask.array as da
+import netCDF4 as nc
+from restart_manifest import parse_legs
+
+MARTINI_BASE = "/ec/res4/scratch/ccpd/martini"
+
+# fields which are extrapolated by default
+FORECAST_VARS = ['tn', 'sn', 'tb', 'sb']
+
+# default chunking of the restarts
+CHUNKS = {'nav_lev': 1}
+
+DAYS_PER_YEAR = 365.
+
+
+def get_restart_list(expname, nlegs=None, legs=None, basedir=MARTINI_BASE):
+    """Rebuilt restarts (restart.nc) of the selected legs, or of the last nlegs ones"""
+
+    available = sorted(int(os.path.basename(os.path.dirname(path)))
+                       for path in glob.glob(os.path.join(basedir, expname, '[0-9][0-9][0-9]', 'restart.nc')))
+    if legs is not None:
+        missing = set(legs) - set(available)
+        if missing:
+            raise FileNotFoundError(f'No rebuilt restart for legs {sorted(missing)}')
+        available = sorted(legs)
+    elif nlegs is not None:
+        available = available[-nlegs:]
+
+    return [os.path.join(basedir, expname, str(leg).zfill(3), 'restart.nc') for leg in available]
+
+
+def get_times(flist, leg_years=1.):
+    """
+    Time in years of each restart, from the elapsed days (adatrj) if available,
+    otherwise assuming legs of leg_years length
+    """
+
+    times = []
+    for i, filename in enumerate(flist):
+        with nc.Dataset(filename) as ds:
+            if 'adatrj' in ds.variables:
+                times.append(float(ds.variables['adatrj'][...]) / DAYS_PER_YEAR)
+            else:
+                times.append(i * leg_years)
+
+    return np.array(times)
+
+
+def fit_linear(field, times, target):
+    """Least squares linear trend along the leg axis, evaluated at the target time"""
+
+    tdev = xr.DataArray(times - times.mean(), dims='leg')
+    mean = field.mean('leg')
+    slope = (tdev * (field - mean)).sum('leg') / (tdev**2).sum()
+
+    return mean + slope * (target - times.mean())
+
+
+def fit_exponential(field, times, target):
+    """
+    Exponential relaxation y(t) = y_inf + (y_0 - y_inf) exp(-t/tau), fitted through the
+    lag-one regression y_{n+1} = r y_n + c of equally spaced legs, with r = exp(-dt/tau).
+    Points where the relaxation is not well defined (no decay, oscillations, constant
+    fields) fall back to the linear trend.
+    """
+
+    steps = np.diff(times)
+    if not np.allclose(steps, steps[0], rtol=1e-3):
+        raise ValueError('Exponential fit requires equally spaced legs')
+
+    prev = field.isel(leg=slice(0, -1)).drop_vars('leg', errors='ignore')
+    succ = field.isel(leg=slice(1, None)).drop_vars('leg', errors='ignore')
+    prev_dev = prev - prev.mean('leg')
+    rate = (prev_dev * (succ - succ.mean('leg'))).sum('leg') / (prev_dev**2).sum('leg')
+    valid = (rate > 0) & (rate < 1)
+    rate = rate.where(valid, 0.5)
+    equilibrium = (succ.mean('leg') - rate * prev.mean('leg')) / (1 - rate)
+
+    last = field.isel(leg=-1)
+    forecast = equilibrium + (last - equilibrium) * rate**((target - times[-1]) / steps[0])
+
+    return forecast.where(valid, fit_linear(field, times, target))
+
+
+def forecast_restart(flist, outfile, years, method='linear', variables=None,
+                     chunks=None, leg_years=1.):
+    """
+    Extrapolate the restart fields years ahead of the last restart
+
+    Args:
+        flist (list): the rebuilt restarts of the legs, sorted in time
+        outfile (str): the forecasted restart, a copy of the last one with updated fields
+        years (float): forecast horizon in years from the last restart
+        method (str, optional): 'linear' or 'exp'. Default is 'linear'.
+        variables (list, optional): fields to be extrapolated. Default is FORECAST_VARS.
+        chunks (dict, optional): dask chunks of the restarts. Default is CHUNKS.
+        leg_years (float, optional): leg length, used only if adatrj is missing
+
+    Returns:
+        The path of the forecasted restart
+    """
+
+    fits = {'linear': fit_linear, 'exp': fit_exponential}
+    if method not in fits:
+        raise ValueError(f'Unknown method {method}: available are {list(fits)}')
+    if len(flist) < 3:
+        raise ValueError('At least 3 legs are needed for the forecast')
+
+    variables = variables or FORECAST_VARS
+    times = get_times(flist, leg_years=leg_years)
+    target = times[-1] + years
+    print(f'Forecasting {variables} with {method} fit over {len(flist)} legs, {years} years ahead')
+
+    data = xr.concat([xr.open_dataset(filename, chunks=chunks or CHUNKS, decode_times=False,
+                                      mask_and_scale=False)[variables] for filename in flist],
+                     dim='leg')
+
+    shutil.copy(flist[-1], outfile)
+    with nc.Dataset(outfile, 'r+') as out:
+        for var in variables:
+            forecast = fits[method](data[var].astype('f8'), times, target)
+            target_var = out.variables[var]
+            target_var.set_auto_maskandscale(False)
+            da.store(forecast.transpose(*target_var.dimensions).data.astype(target_var.dtype),
+                     target_var, lock=True)
+        out.setncattr('martini_forecast', f'{method} fit over {len(flist)} legs, {years} years ahead')
+
+    return outfile
+
+
+def get_args():
+    """Command line parser for the MARTINI forecast"""
+
+    parser = argparse.ArgumentParser(
+        description="Extrapolate NEMO restarts ahead in time from the rebuilt restarts of the last legs.")
+    parser.add_argument("expname", metavar="EXPNAME", help="Experiment name")
+    parser.add_argument("--nlegs", type=int, default=10, help="number of last legs used for the fit")
+    parser.add_argument("--legs", type=str, default=None,
+                        help="explicit legs used for the fit, as range (10-20) or list (1,5,10-12)")
+    parser.add_argument("--years", type=float, required=True, help="forecast horizon in years")
+    parser.add_argument("--method", type=str, default='linear', choices=['linear', 'exp'],
+                        help="linear trend or exponential relaxation")
+    parser.add_argument("--vars", type=str, nargs='+', default=FORECAST_VARS, help="fields to be extrapolated")
+    parser.add_argument("--leg-years", type=float, default=1., help="leg length, if adatrj is not in the restarts")
+    parser.add_argument("--outfile", type=str, default=None,
+                        help="output restart (default: <martini>/<exp>/forecast/restart.nc)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    legs = parse_legs(args.legs) if args.legs else None
+    flist = get_restart_list(args.expname, nlegs=args.nlegs, legs=legs)
+    outfile = args.outfile or os.path.join(MARTINI_BASE, args.expname, 'forecast', 'restart.nc')
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    forecast_restart(flist, outfile, args.years, method=args.method,
+                     variables=args.vars, leg_years=args.leg_years)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MARTINI reduced-order forecast of the ocean state (EOF + DMD/AR on the principal components).
+
+Since the number of legs is much smaller than the number of gridpoints, the EOFs are
+obtained with the method of snapshots: the leg-by-leg Gram matrix of the normalised
+T/S anomalies is accumulated by streaming over dask chunks (threaded), so the snapshot
+matrix is never held in memory. Its eigenvectors give the principal components, whose
+dynamics is fitted with a linear operator (DMD) or independent AR(1) models.
+The forecasted state is a linear combination of the leg anomalies, which is again
+computed chunk by chunk and stored into a copy of the last restart.
+"""
+
+import os
+import shutil
+import argparse
+import numpy as np
+import xarray as xr
+import dask
+import dask.array as da
+import netCDF4 as nc
+from restart_manifest import parse_legs
+from martini_forecast import MARTINI_BASE, CHUNKS, get_restart_list, get_times
+
+# fields defining the reduced state
+STATE_VARS = ['tn', 'sn']
+
+# fields reconstructed from the reduced forecast
+FORECAST_VARS = ['tn', 'sn', 'tb', 'sb']
+
+
+def open_legs(flist, variables, chunks=None):
+    """Lazily concatenate the restart fields of the legs along a new leg dimension"""
+
+    data = xr.concat([xr.open_dataset(filename, chunks=chunks or CHUNKS, decode_times=False,
+                                      mask_and_scale=False)[variables] for filename in flist],
+                     dim='leg')
+
+    return data.astype('f8')
+
+
+def gram_matrix(data, variables):
+    """
+    Streamed Gram matrix of the anomalies, each variable normalised by its rms over wet points.
+    Salinity is used to identify wet points (it is zero on land).
+
+    Returns:
+        The (nlegs, nlegs) Gram matrix and the per-variable normalisation
+    """
+
+    wet = (data['sn'].isel(leg=0) > 0) if 'sn' in data else None
+    grams, counts = [], []
+    for var in variables:
+        anom = (data[var] - data[var].mean('leg')).data.rechunk({0: -1})
+        axes = list(range(1, anom.ndim))
+        grams.append(da.tensordot(anom, anom, axes=(axes, axes)))
+        counts.append(wet.sum().data if wet is not None else np.prod(anom.shape[1:]))
+
+    grams, counts = dask.compute(grams, counts)
+    nlegs = grams[0].shape[0]
+    scales = [np.sqrt(np.trace(gram) / (nlegs * count)) for gram, count in zip(grams, counts)]
+    gram = sum(gram / scale**2 for gram, scale in zip(grams, scales))
+
+    return gram, dict(zip(variables, scales))
+
+
+def get_modes(gram, nmodes=None, energy=0.99):
+    """
+    Eigendecomposition of the Gram matrix, truncated to nmodes or to the
+    number of modes explaining the requested fraction of variance
+
+    Returns:
+        Temporal eigenvectors (nlegs, nmodes) and singular values (nmodes)
+    """
+
+    eigval, eigvec = np.linalg.eigh(gram)
+    order = np.argsort(eigval)[::-1]
+    eigval, eigvec = np.clip(eigval[order], 0, None), eigvec[:, order]
+    if nmodes is None:
+        nmodes = int(np.searchsorted(np.cumsum(eigval) / eigval.sum(), energy) + 1)
+    nmodes = min(nmodes, int((eigval > eigval[0] * 1e-12).sum()))
+    print(f'Using {nmodes} modes, explaining {eigval[:nmodes].sum() / eigval.sum():.1%} of variance')
+
+    return eigvec[:, :nmodes], np.sqrt(eigval[:nmodes])
+
+
+def fit_dynamics(pcs, method='dmd'):
+    """
+    Fit the evolution a_{n+1} = A a_n + c of the principal components: a full operator
+    for DMD, a diagonal one (independent AR(1) for each mode) for AR
+
+    Returns:
+        The (nmodes, nmodes) operator and the (nmodes) intercept
+    """
+
+    prev, succ = pcs[:-1], pcs[1:]
+    if method == 'dmd':
+        design = np.hstack([prev, np.ones((prev.shape[0], 1))])
+        coeffs = np.linalg.lstsq(design, succ, rcond=None)[0]
+        return coeffs[:-1].T, coeffs[-1]
+    if method == 'ar':
+        prev_dev = prev - prev.mean(axis=0)
+        rate = (prev_dev * (succ - succ.mean(axis=0))).sum(axis=0) / (prev_dev**2).sum(axis=0)
+        return np.diag(rate), succ.mean(axis=0) - rate * prev.mean(axis=0)
+
+    raise ValueError(f'Unknown method {method}: available are dmd and ar')
+
+
+def propagate(operator, intercept, state, nsteps):
+    """Iterate the fitted linear dynamics nsteps ahead"""
+
+    for _ in range(nsteps):
+        state = operator @ state + intercept
+
+    return state
+
+
+def forecast_rom(flist, outfile, years, method='dmd', nmodes=None, energy=0.99,
+                 variables=None, chunks=None, leg_years=1.):
+    """
+    Reduced-order forecast of the restart fields years ahead of the last restart
+
+    Args:
+        flist (list): the rebuilt restarts of the legs, sorted in time
+        outfile (str): the forecasted restart, a copy of the last one with updated fields
+        years (float): forecast horizon in years from the last restart, rounded to whole legs
+        method (str, optional): 'dmd' or 'ar'. Default is 'dmd'.
+        nmodes (int, optional): number of modes. Default is set by energy.
+        energy (float, optional): fraction of variance retained if nmodes is not set
+        variables (list, optional): fields to be reconstructed. Default is FORECAST_VARS.
+        chunks (dict, optional): dask chunks of the restarts. Default is CHUNKS.
+        leg_years (float, optional): leg length, used only if adatrj is missing
+
+    Returns:
+        The path of the forecasted restart
+    """
+
+    if len(flist) < 3:
+        raise ValueError('At least 3 legs are needed for the forecast')
+
+    variables = variables or FORECAST_VARS
+    times = get_times(flist, leg_years=leg_years)
+    steps = np.diff(times)
+    if not np.allclose(steps, steps[0], rtol=1e-3):
+        raise ValueError('Reduced-order forecast requires equally spaced legs')
+    nsteps = int(round(years / steps[0]))
+    print(f'Forecasting {variables} with {method} on EOFs over {len(flist)} legs, {nsteps} legs ahead')
+
+    data = open_legs(flist, sorted(set(variables) | set(STATE_VARS)), chunks=chunks)
+    gram, _ = gram_matrix(data, STATE_VARS)
+    eigvec, singular = get_modes(gram, nmodes=nmodes, energy=energy)
+    pcs = eigvec * singular
+
+    operator, intercept = fit_dynamics(pcs, method=method)
+    future = propagate(operator, intercept, pcs[-1], nsteps)
+
+    # x_f = mean + sum_n w_n (x_n - mean), with w the leg weights of the forecasted pcs
+    weights = xr.DataArray(eigvec @ (future / singular), dims='leg')
+
+    shutil.copy(flist[-1], outfile)
+    with nc.Dataset(outfile, 'r+') as out:
+        for var in variables:
+            mean = data[var].mean('leg')
+            forecast = mean + ((data[var] - mean) * weights).sum('leg')
+            target_var = out.variables[var]
+            target_var.set_auto_maskandscale(False)
+            da.store(forecast.transpose(*target_var.dimensions).data.astype(target_var.dtype),
+                     target_var, lock=True)
+        out.setncattr('martini_forecast', f'{method} on {len(singular)} EOFs over {len(flist)} legs, '
+                                          f'{nsteps} legs ahead')
+
+    return outfile
+
+
+def get_args():
+    """Command line parser for the MARTINI reduced-order forecast"""
+
+    parser = argparse.ArgumentParser(
+        description="Reduced-order (EOF + DMD/AR) forecast of NEMO restarts from the rebuilt restarts of many legs.")
+    parser.add_argument("expname", metavar="EXPNAME", help="Experiment name")
+    parser.add_argument("--nlegs", type=int, default=50, help="number of last legs used for the decomposition")
+    parser.add_argument("--legs", type=str, default=None,
+                        help="explicit legs used for the decomposition, as range (10-20) or list (1,5,10-12)")
+    parser.add_argument("--years", type=float, required=True, help="forecast horizon in years")
+    parser.add_argument("--method", type=str, default='dmd', choices=['dmd', 'ar'],
+                        help="DMD operator or independent AR(1) on the principal components")
+    parser.add_argument("--modes", type=int, default=None, help="number of modes retained")
+    parser.add_argument("--energy", type=float, default=0.99,
+                        help="fraction of variance retained, if --modes is not given")
+    parser.add_argument("--leg-years", type=float, default=1., help="leg length, if adatrj is not in the restarts")
+    parser.add_argument("--outfile", type=str, default=None,
+                        help="output restart (default: <martini>/<exp>/forecast/restart.nc)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    legs = parse_legs(args.legs) if args.legs else None
+    flist = get_restart_list(args.expname, nlegs=args.nlegs, legs=legs)
+    outfile = args.outfile or os.path.join(MARTINI_BASE, args.expname, 'forecast', 'restart.nc')
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    forecast_rom(flist, outfile, args.years, method=args.method, nmodes=args.modes,
+                 energy=args.energy, leg_years=args.leg_years)
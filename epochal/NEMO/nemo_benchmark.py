@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the NEMO restart processing path on synthetic data.
+
+Per-processor restart sets with realistic DOMAIN_* metadata and NEMO 4.2 variable
+lists are generated for ORCA2, eORCA1 or eORCA025 sized grids. Rebuild, decomposition,
+copy versus rename/hardlink and in-place field editing are then timed, each in a
+separate process so that its peak RSS can be reported along with the throughput.
+"""
+
+import os
+import time
+import json
+import shutil
+import resource
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import netCDF4 as nc
+from nemo_rebuild import regular_domains, domain_attrs, rebuild_restart, decompose_restart
+from restart_manifest import link_or_move
+from restart_edit import edit_restart, FLUX_VARS
+
+# global size (x, y, levels) and default jpni x jpnj layout of the grids
+GRIDS = {
+    'ORCA2': (182, 149, 31, (4, 4)),
+    'eORCA1': (362, 332, 75, (8, 8)),
+    'eORCA025': (1442, 1207, 75, (16, 16))
+}
+
+# NEMO 4.2 ocean restart variables
+VARS_3D = ['ub', 'vb', 'tb', 'sb', 'un', 'vn', 'tn', 'sn', 'rhop', 'en', 'avt_k', 'avm_k', 'dissl']
+VARS_2D = ['sshb', 'sshn', 'nav_lon', 'nav_lat', 'rnf_b', 'rnf_hc_b', 'rnf_sc_b', 'utau_b', 'vtau_b',
+           'qns_b', 'emp_b', 'sfx_b', 'fraqsr_1lev', 'sbc_hc_b', 'sbc_sc_b', 'qsr_hc_b']
+VARS_0D = ['kt', 'ndastp', 'adatrj', 'ntime', 'rdt']
+
+# halo width of the subdomains, as in the NEMO per-processor files
+HALO = 1
+
+EXPNAME = 'BNCH'
+TSTEP = '00005840'
+
+
+def _synthetic_field(name, domain, nlev):
+    """Smooth synthetic values for a variable on a subdomain, depending on global indices only"""
+
+    first = domain['position_first']
+    size = domain['size_local']
+    jglo = np.arange(first[1] - 1, first[1] - 1 + size[1])[:, np.newaxis]
+    iglo = np.arange(first[0] - 1, first[0] - 1 + size[0])[np.newaxis, :]
+    field = np.cos(jglo / domain['size_global'][1] * np.pi) + np.sin(iglo / domain['size_global'][0] * 2 * np.pi)
+    field = field + sum(map(ord, name)) % 100 / 100.
+    if name in VARS_3D:
+        field = field[np.newaxis] * np.exp(-np.arange(nlev) / 20.)[:, np.newaxis, np.newaxis]
+
+    return field[np.newaxis]
+
+
+def write_rank(filename, domain, nlev):
+    """Worker: write the synthetic restart file of a single subdomain"""
+
+    with nc.Dataset(filename, 'w') as ds:
+        ds.createDimension('x', domain['size_local'][0])
+        ds.createDimension('y', domain['size_local'][1])
+        ds.createDimension('nav_lev', nlev)
+        ds.createDimension('time_counter', None)
+        ds.setncatts(domain_attrs(domain, [1, 2]))
+
+        for name in VARS_0D:
+            ds.createVariable(name, 'f8')[...] = 1.
+        ds.createVariable('nav_lev', 'f4', ('nav_lev',))[:] = np.arange(nlev)
+        ds.createVariable('time_counter', 'f8', ('time_counter',))[:] = [0.]
+        for name in VARS_2D:
+            dims = ('y', 'x') if name.startswith('nav') else ('time_counter', 'y', 'x')
+            values = _synthetic_field(name, domain, nlev)
+            ds.createVariable(name, 'f4' if name.startswith('nav') else 'f8', dims)[:] = \
+                values[0] if name.startswith('nav') else values
+        for name in VARS_3D:
+            ds.createVariable(name, 'f8', ('time_counter', 'nav_lev', 'y', 'x'))[:] = \
+                _synthetic_field(name, domain, nlev)
+
+    return filename
+
+
+def generate_restarts(outdir, grid='ORCA2', layout=None, nlev=None, halo=HALO, nproc=None):
+    """
+    Generate a synthetic per-processor restart set
+
+    Returns:
+        The list of generated files
+    """
+
+    nx, ny, levels, default_layout = GRIDS[grid]
+    nlev = nlev or levels
+    domains = regular_domains([nx, ny], layout or default_layout, halo=halo)
+    os.makedirs(outdir, exist_ok=True)
+    print(f'Generating {len(domains)} {grid} restart files ({nx}x{ny}x{nlev}) in {outdir}')
+
+    with ProcessPoolExecutor(max_workers=nproc or os.cpu_count()) as pool:
+        futures = [pool.submit(write_rank, os.path.join(outdir, f"{EXPNAME}_{TSTEP}_restart_{domain['number']:04d}.nc"),
+                               domain, nlev) for domain in domains]
+        return [future.result() for future in futures]
+
+
+def _child(queue, func, args):
+    """Run a function in a child process, reporting elapsed time and peak RSS (kB)"""
+
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    queue.put((elapsed, peak))
+
+
+def measure(name, func, args, nbytes):
+    """Time a benchmark step in a separate process"""
+
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_child, args=(queue, func, args))
+    proc.start()
+    elapsed, peak = queue.get()
+    proc.join()
+    result = {'step': name, 'seconds': elapsed, 'MB/s': nbytes / 1024**2 / elapsed, 'peak_rss_MB': peak / 1024}
+    print(f"{name:<20} {elapsed:10.3f} s {result['MB/s']:10.1f} MB/s {result['peak_rss_MB']:10.1f} MB")
+
+    return result
+
+
+def run_benchmark(workdir, grid='ORCA2', layout=None, nlev=None, halo=HALO, nproc=None, keep=False):
+    """
+    Generate a synthetic restart set and time rebuild, copy/rename and field edits
+
+    Returns:
+        A list of dictionaries with timings, throughput and peak RSS of each step
+    """
+
+    indir = os.path.join(workdir, 'input')
+    flist = generate_restarts(indir, grid=grid, layout=layout, nlev=nlev, halo=halo, nproc=nproc)
+    insize = sum(os.path.getsize(filename) for filename in flist)
+    rebuilt = os.path.join(workdir, f'{EXPNAME}_{TSTEP}_restart.nc')
+    copied = os.path.join(workdir, 'restart_copy.nc')
+    restart = os.path.join(workdir, 'restart.nc')
+
+    results = [measure('rebuild', rebuild_restart, (flist, rebuilt, nproc), insize)]
+    size = os.path.getsize(rebuilt)
+    results.append(measure('copy', shutil.copy, (rebuilt, copied), size))
+    results.append(measure('hardlink', link_or_move, (copied, restart, True), size))
+    results.append(measure('rename', link_or_move, (copied, restart), size))
+    results.append(measure('edit fluxes', edit_restart,
+                           (restart, [{'op': 'zero', 'vars': FLUX_VARS, 'optional': True}]), size))
+    results.append(measure('edit 3D field', edit_restart,
+                           (restart, [{'op': 'scale', 'vars': ['tn'], 'factor': 1.01}]), size))
+    results.append(measure('decompose', decompose_restart,
+                           (restart, os.path.join(workdir, 'decomposed'),
+                            None, layout or GRIDS[grid][3], halo, nproc), size))
+
+    if not keep:
+        shutil.rmtree(workdir)
+
+    return results
+
+
+def get_args():
+    """Command line parser for the benchmark"""
+
+    parser = argparse.ArgumentParser(description="Benchmark NEMO restart processing on synthetic data.")
+    parser.add_argument("workdir", type=str, help="scratch directory for the synthetic files")
+    parser.add_argument("--grid", type=str, default='ORCA2', choices=list(GRIDS), help="grid size")
+    parser.add_argument("--layout", type=int, nargs=2, default=None, metavar=('JPNI', 'JPNJ'),
+                        help="decomposition layout (default depends on the grid)")
+    parser.add_argument("--nlev", type=int, default=None, help="number of levels (default depends on the grid)")
+    parser.add_argument("--halo", type=int, default=HALO, help="halo width of the subdomains")
+    parser.add_argument("--nproc", type=int, default=None, help="number of workers (default: all the cpus)")
+    parser.add_argument("--keep", action="store_true", help="keep the generated files")
+    parser.add_argument("--json", type=str, default=None, help="write the results to a json file")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    res = run_benchmark(args.workdir, grid=args.grid, layout=args.layout, nlev=args.nlev, halo=args.halo,
+                        nproc=args.nproc, keep=args.keep)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fff:
+            json.dump({'grid': args.grid, 'halo': args.halo, 'results': res}, fff, indent=1)
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Native rebuilder and decomposer of NEMO restart files.
+
+The per-processor files written by NEMO carry DOMAIN_* global attributes that
+describe where each subdomain sits in the global grid. These are used to assemble
+every distributed variable into a preallocated global array, so that neither the
+Fortran rebuild_nemo tool nor symlinks and namelists are needed.
+Variables are split into bounded pieces which are assembled by a pool of workers.
+
+The inverse operation splits a global restart back into per-processor files,
+following either a template set of files or a regular jpni x jpnj layout.
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import netCDF4 as nc
+
+# maximum size (bytes) of the global block assembled by a single task
+MAX_TASK_BYTES = 256 * 1024**2
+
+# minimum number of tasks per worker, so that small grids still use all the workers
+TASKS_PER_WORKER = 2
+
+# maximum number of tasks submitted and not yet written, per worker
+TASKS_IN_FLIGHT = 2
+
+# maximum number of per-processor files written at once by a single task
+MAX_TASK_FILES = 64
+
+
+def get_domain(filename):
+    """Read the DOMAIN_* attributes of a NEMO per-processor file"""
+
+    with nc.Dataset(filename) as ds:
+        attrs = ds.__dict__
+        dimnames = list(ds.dimensions)
+        dimids = attrs.get('DOMAIN_dimensions_ids', [1, 2])
+        domain = {
+            'number': int(attrs['DOMAIN_number']),
+            'total': int(attrs['DOMAIN_number_total']),
+            'dims': (dimnames[dimids[0] - 1], dimnames[dimids[1] - 1]),
+            'size_global': [int(n) for n in attrs['DOMAIN_size_global']],
+            'size_local': [int(n) for n in attrs['DOMAIN_size_local']],
+            'position_first': [int(n) for n in attrs['DOMAIN_position_first']],
+            'halo_start': [int(n) for n in attrs.get('DOMAIN_halo_size_start', [0, 0])],
+            'halo_end': [int(n) for n in attrs.get('DOMAIN_halo_size_end', [0, 0])],
+        }
+
+    return domain
+
+
+def domain_slices(domain):
+    """Local and global (x, y) slices of the inner (halo-free) part of a subdomain"""
+
+    local, glob_ = [], []
+    for i in range(2):
+        start = domain['halo_start'][i]
+        stop = domain['size_local'][i] - domain['halo_end'][i]
+        offset = domain['position_first'][i] - 1
+        local.append(slice(start, stop))
+        glob_.append(slice(offset + start, offset + stop))
+
+    return local, glob_
+
+
+def _split_variable(name, shape, axes, itemsize, max_bytes):
+    """Split a distributed variable into pieces along its first non-spatial axis"""
+
+    nbytes = int(np.prod(shape)) * itemsize
+    others = [i for i, size in enumerate(shape) if i not in axes and size > 1]
+    if nbytes <= max_bytes or not others:
+        return [(name, None, 0, 0, nbytes)]
+
+    axis = others[0]
+    step = max(1, int(shape[axis] * max_bytes // nbytes))
+    return [(name, axis, start, min(start + step, shape[axis]),
+             nbytes * (min(start + step, shape[axis]) - start) // shape[axis])
+            for start in range(0, shape[axis], step)]
+
+
+def _pack_tasks(pieces, max_bytes):
+    """Greedily group variable pieces into tasks of bounded size"""
+
+    tasks, current, size = [], [], 0
+    for piece in pieces:
+        if current and size + piece[-1] > max_bytes:
+            tasks.append(current)
+            current, size = [], 0
+        current.append(piece)
+        size += piece[-1]
+    if current:
+        tasks.append(current)
+
+    return tasks
+
+
+def _assemble_task(flist, domains, pieces, meta):
+    """Worker: assemble a group of variable pieces from all the subdomain files"""
+
+    blocks = {}
+    for name, axis, start, stop, _ in pieces:
+        shape = list(meta[name]['shape'])
+        if axis is not None:
+            shape[axis] = stop - start
+        blocks[(name, start)] = np.full(shape, meta[name]['fill'], dtype=meta[name]['dtype'])
+
+    for filename, domain in zip(flist, domains):
+        local, glob_ = domain_slices(domain)
+        with nc.Dataset(filename) as ds:
+            for name, axis, start, stop, _ in pieces:
+                var = ds.variables[name]
+                var.set_auto_maskandscale(False)
+                xax, yax = meta[name]['axes']
+                src = [slice(None)] * var.ndim
+                dst = [slice(None)] * var.ndim
+                src[xax], src[yax] = local
+                dst[xax], dst[yax] = glob_
+                if axis is not None:
+                    src[axis] = slice(start, stop)
+                blocks[(name, start)][tuple(dst)] = var[tuple(src)]
+
+    return [(name, axis, start, stop, blocks[(name, start)])
+            for name, axis, start, stop, _ in pieces]
+
+
+def rebuild_restart(flist, outfile, nproc=None, max_bytes=MAX_TASK_BYTES):
+    """
+    Rebuild a set of NEMO per-processor files into a single global file
+
+    Args:
+        flist (list): the per-processor files (e.g. EXP_00001234_restart_????.nc)
+        outfile (str): path of the global file to be written
+        nproc (int, optional): number of workers. Default is the number of cpus.
+        max_bytes (int, optional): maximum size of the block assembled by a task,
+            reduced so that each worker gets at least TASKS_PER_WORKER tasks
+
+    Returns:
+        The path of the rebuilt file
+    """
+
+    flist = sorted(flist)
+    if not flist:
+        raise ValueError('No files to rebuild')
+
+    domains = [get_domain(filename) for filename in flist]
+    total = domains[0]['total']
+    if len(flist) > total:
+        raise ValueError(f'Found {len(flist)} files but DOMAIN_number_total is {total}')
+    xdim, ydim = domains[0]['dims']
+    nx, ny = domains[0]['size_global']
+
+    meta = {}
+    with nc.Dataset(flist[0]) as ref, \
+         nc.Dataset(outfile, 'w', format=ref.data_model) as out:
+
+        out.setncatts({key: value for key, value in ref.__dict__.items()
+                       if not key.startswith('DOMAIN')})
+        for dname, dim in ref.dimensions.items():
+            size = {xdim: nx, ydim: ny}.get(dname, len(dim))
+            out.createDimension(dname, None if dim.isunlimited() else size)
+
+        for name, var in ref.variables.items():
+            fill = var.__dict__.get('_FillValue', None)
+            ovar = out.createVariable(name, var.dtype, var.dimensions, fill_value=fill)
+            ovar.setncatts({key: value for key, value in var.__dict__.items()
+                            if key != '_FillValue'})
+            ovar.set_auto_maskandscale(False)
+            if xdim in var.dimensions and ydim in var.dimensions:
+                axes = (var.dimensions.index(xdim), var.dimensions.index(ydim))
+                shape = tuple(len(out.dimensions[d]) if not out.dimensions[d].isunlimited()
+                              else var.shape[i] for i, d in enumerate(var.dimensions))
+                meta[name] = {'shape': shape, 'axes': axes, 'dtype': var.dtype,
+                              'fill': 0 if fill is None else fill}
+            else:
+                var.set_auto_maskandscale(False)
+                ovar[...] = var[...]
+
+        # tasks small enough to keep all the workers busy, within max_bytes
+        nproc = nproc or os.cpu_count()
+        total_bytes = sum(int(np.prod(item['shape'])) * item['dtype'].itemsize for item in meta.values())
+        task_bytes = max(1, min(max_bytes, total_bytes // (TASKS_PER_WORKER * nproc)))
+        pieces = [piece for name, item in meta.items()
+                  for piece in _split_variable(name, item['shape'], item['axes'], item['dtype'].itemsize, task_bytes)]
+        tasks = _pack_tasks(pieces, task_bytes)
+        nproc = min(nproc, len(tasks)) or 1
+        print(f'Rebuilding {len(meta)} variables from {len(flist)} files '
+              f'with {len(tasks)} tasks on {nproc} workers')
+
+        # a bounded number of tasks in flight, written as they complete
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            pending, running = list(reversed(tasks)), set()
+            while pending or running:
+                while pending and len(running) < TASKS_IN_FLIGHT * nproc:
+                    running.add(pool.submit(_assemble_task, flist, domains, pending.pop(), meta))
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    for name, axis, start, stop, block in future.result():
+                        index = [slice(None)] * block.ndim
+                        if axis is not None:
+                            index[axis] = slice(start, stop)
+                        out.variables[name][tuple(index)] = block
+
+    return outfile
+
+
+def regular_domains(size_global, layout, halo=0, dims=('x', 'y')):
+    """
+    Build the DOMAIN_* description of a regular jpni x jpnj decomposition
+
+    Inner domains are split as evenly as possible, larger ones first. Halos are
+    added on each side, but clipped at the edges of the global grid
+    (i.e. periodicity is not accounted for).
+    """
+
+    bounds = []
+    for size, nproc in zip(size_global, layout):
+        if nproc > size:
+            raise ValueError(f'Cannot split {size} points on {nproc} processors')
+        edges = np.cumsum([0] + [len(part) for part in np.array_split(np.arange(size), nproc)])
+        bounds.append(list(zip(edges[:-1], edges[1:])))
+
+    domains = []
+    for jdx, (y0, y1) in enumerate(bounds[1]):
+        for idx, (x0, x1) in enumerate(bounds[0]):
+            first = [max(x0 - halo, 0), max(y0 - halo, 0)]
+            last = [min(x1 + halo, size_global[0]), min(y1 + halo, size_global[1])]
+            domains.append({
+                'number': jdx * layout[0] + idx,
+                'total': layout[0] * layout[1],
+                'dims': tuple(dims),
+                'size_global': list(size_global),
+                'size_local': [last[0] - first[0], last[1] - first[1]],
+                'position_first': [first[0] + 1, first[1] + 1],
+                'halo_start': [x0 - first[0], y0 - first[1]],
+                'halo_end': [last[0] - x1, last[1] - y1],
+            })
+
+    return domains
+
+
+def domain_attrs(domain, dimids):
+    """DOMAIN_* global attributes of a per-processor file"""
+
+    last = [first + size - 1 for first, size in zip(domain['position_first'], domain['size_local'])]
+    return {
+        'DOMAIN_number_total': np.int32(domain['total']),
+        'DOMAIN_number': np.int32(domain['number']),
+        'DOMAIN_dimensions_ids': np.array(dimids, dtype='i4'),
+        'DOMAIN_size_global': np.array(domain['size_global'], dtype='i4'),
+        'DOMAIN_size_local': np.array(domain['size_local'], dtype='i4'),
+        'DOMAIN_position_first': np.array(domain['position_first'], dtype='i4'),
+        'DOMAIN_position_last': np.array(last, dtype='i4'),
+        'DOMAIN_halo_size_start': np.array(domain['halo_start'], dtype='i4'),
+        'DOMAIN_halo_size_end': np.array(domain['halo_end'], dtype='i4'),
+        'DOMAIN_type': 'BOX'
+    }
+
+
+def _create_domain_file(ref, outfile, domain):
+    """Create the per-processor file of a subdomain, with the structure of the global file"""
+
+    xdim, ydim = domain['dims']
+    out = nc.Dataset(outfile, 'w', format=ref.data_model)
+
+    dimnames = list(ref.dimensions)
+    attrs = {key: value for key, value in ref.__dict__.items()
+             if not key.startswith('DOMAIN')}
+    attrs.update(domain_attrs(domain, [dimnames.index(xdim) + 1, dimnames.index(ydim) + 1]))
+    out.setncatts(attrs)
+    for dname, dim in ref.dimensions.items():
+        size = {xdim: domain['size_local'][0], ydim: domain['size_local'][1]}.get(dname, len(dim))
+        out.createDimension(dname, None if dim.isunlimited() else size)
+
+    for name, var in ref.variables.items():
+        fill = var.__dict__.get('_FillValue', None)
+        ovar = out.createVariable(name, var.dtype, var.dimensions, fill_value=fill)
+        ovar.setncatts({key: value for key, value in var.__dict__.items()
+                        if key != '_FillValue'})
+        ovar.set_auto_maskandscale(False)
+
+    return out
+
+
+def _write_domains(globfile, outfiles, domains):
+    """
+    Worker: write the per-processor files of a group of subdomains.
+    Each variable is read level by level only once, on the bounding box of the group,
+    and scattered to all the files of the group.
+    """
+
+    xdim, ydim = domains[0]['dims']
+    starts = np.array([domain['position_first'] for domain in domains]) - 1
+    stops = starts + np.array([domain['size_local'] for domain in domains])
+    box0, box1 = starts.min(axis=0), stops.max(axis=0)
+
+    with nc.Dataset(globfile) as ref:
+        outs = [_create_domain_file(ref, outfile, domain) for outfile, domain in zip(outfiles, domains)]
+        try:
+            for name, var in ref.variables.items():
+                var.set_auto_maskandscale(False)
+                if not (xdim in var.dimensions and ydim in var.dimensions):
+                    values = var[...]
+                    for out in outs:
+                        out.variables[name][...] = values
+                    continue
+
+                xax, yax = var.dimensions.index(xdim), var.dimensions.index(ydim)
+                levels = [None] if var.ndim < 3 else range(var.shape[var.ndim - 3])
+                for level in levels:
+                    index = [slice(None)] * var.ndim
+                    if level is not None:
+                        index[var.ndim - 3] = slice(level, level + 1)
+                    index[xax], index[yax] = slice(box0[0], box1[0]), slice(box0[1], box1[1])
+                    values = var[tuple(index)]
+                    for out, start, stop in zip(outs, starts - box0, stops - box0):
+                        local = [slice(None)] * var.ndim
+                        local[xax], local[yax] = slice(start[0], stop[0]), slice(start[1], stop[1])
+                        index[xax], index[yax] = slice(None), slice(None)
+                        out.variables[name][tuple(index)] = values[tuple(local)]
+        finally:
+            for out in outs:
+                out.close()
+
+    return outfiles
+
+
+def decompose_restart(globfile, outprefix, templates=None, layout=None, halo=0, nproc=None):
+    """
+    Split a global NEMO restart into per-processor files
+
+    Args:
+        globfile (str): the global restart file
+        outprefix (str): prefix of the output files, written as <outprefix>_????.nc
+        templates (list, optional): per-processor files providing the decomposition
+        layout (tuple, optional): (jpni, jpnj) regular layout, used if no templates
+        halo (int, optional): halo width for the regular layout. Default is 0.
+        nproc (int, optional): number of workers. Default is the number of cpus.
+
+    Returns:
+        The list of written files
+    """
+
+    if templates:
+        domains = [get_domain(filename) for filename in sorted(templates)]
+    elif layout:
+        with nc.Dataset(globfile) as ds:
+            dims = ('x', 'y')
+            size_global = [len(ds.dimensions[dim]) for dim in dims]
+        domains = regular_domains(size_global, layout, halo=halo, dims=dims)
+    else:
+        raise ValueError('Either templates or layout must be provided')
+
+    with nc.Dataset(globfile) as ds:
+        sizes = [len(ds.dimensions[dim]) for dim in domains[0]['dims']]
+    if sizes != domains[0]['size_global']:
+        raise ValueError(f'Global file has size {sizes}, decomposition expects {domains[0]["size_global"]}')
+
+    # contiguous groups of domains (i.e. bands along y), at least one per worker
+    nproc = min(nproc or os.cpu_count(), len(domains))
+    ngroups = max(nproc, -(-len(domains) // MAX_TASK_FILES))
+    groups = [list(group) for group in np.array_split(np.arange(len(domains)), ngroups)]
+    print(f'Decomposing {globfile} into {len(domains)} files on {nproc} workers')
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        futures = [pool.submit(_write_domains, globfile,
+                               [f"{outprefix}_{domains[i]['number']:04d}.nc" for i in group],
+                               [domains[i] for i in group])
+                   for group in groups]
+        written = [outfile for future in futures for outfile in future.result()]
+
+    return written
+
+
+def get_args():
+    """Command line parser for the native rebuilder"""
+
+    parser = argparse.ArgumentParser(
+        description="Rebuild NEMO per-processor files into a global file, or decompose it back.")
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+
+    rebuild = subparsers.add_parser('rebuild', help="rebuild per-processor files into a global file")
+    rebuild.add_argument("outfile", type=str, help="path to the global output file")
+    rebuild.add_argument("infiles", type=str, nargs='+', help="per-processor files")
+
+    decompose = subparsers.add_parser('decompose', help="split a global file into per-processor files")
+    decompose.add_argument("infile", type=str, help="path to the global input file")
+    decompose.add_argument("outprefix", type=str, help="prefix of the output files (<outprefix>_????.nc)")
+    decompose.add_argument("--template", type=str, nargs='+',
+                           help="per-processor files to take the decomposition from")
+    decompose.add_argument("--layout", type=int, nargs=2, metavar=('JPNI', 'JPNJ'),
+                           help="regular decomposition layout, if no template is given")
+    decompose.add_argument("--halo", type=int, default=0, help="halo width for the regular layout")
+
+    for sub in [rebuild, decompose]:
+        sub.add_argument("--nproc", type=int, default=None,
+                         help="number of workers (default: all the cpus)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    if args.mode == 'rebuild':
+        rebuild_restart(args.infiles, args.outfile, nproc=args.nproc)
+    else:
+        decompose_restart(args.infile, args.outprefix, templates=args.template,
+                          layout=args.layout, halo=args.halo, nproc=args.nproc)
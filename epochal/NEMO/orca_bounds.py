@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 
 import abc
+import os
+import copy
 
 import numpy as np
 import xarray as xr
 import traceback
 import argparse
 import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 
 class OrcaMesh(metaclass=abc.ABCMeta):
@@ -22,14 +26,44 @@ class OrcaMesh(metaclass=abc.ABCMeta):
     # dimension for unstructured grid
     UNSTRUCT_DIM = 'cell'
 
+    # index of the wet-only cells in the flattened (y, x) grid
+    INDEX_VAR = 'cell_index'
+
     FILLVAL = -1.e20
 
-    def __init__(self, args):
+    # default memory budget (MB) of the chunked processing of the mesh
+    MEMORY = 1024
+
+    # staggerings and output formats available for the one-pass export
+    STAGGS = ['T', 'U', 'V', 'F']
+    FORMATS = ['cf', 'xesmf', 'unstructured', 'scrip', 'griddes']
+
+    def __init__(self, args, ds_mesh=None):
         self.stagg = (args.stagg).lower()
         self.level = args.level
-        self.ds_xesmf = self._geom_to_xesmf(args.meshmask)
+        self.memory = getattr(args, 'memory', None) or self.MEMORY
+        self.wet_only = getattr(args, 'wet_only', False)
+        self.ds_xesmf = self._geom_to_xesmf(args.meshmask, ds_mesh)
         self.ds_xesmf = self._set_mesh_attrs()
 
+    @classmethod
+    def open_mesh(cls, meshfile, memory=None):
+        """
+        Open lazily the mesh file, with dask chunks along y and levels sized so that
+        a few float64 temporaries per thread fit in the memory budget (MB).
+        """
+
+        ds_mesh = xr.open_dataset(meshfile, drop_variables=['time_counter'])\
+                    .squeeze()
+
+        nthreads = os.cpu_count() or 1
+        chunk_bytes = (memory or cls.MEMORY) * 1024**2 // (4 * nthreads)
+        chunks = {'y': int(np.clip(chunk_bytes // (8 * ds_mesh.sizes['x']), 1, ds_mesh.sizes['y']))}
+        if 'nav_lev' in ds_mesh.dims:
+            chunks['nav_lev'] = 1
+
+        return ds_mesh.chunk(chunks)
+
     @staticmethod
     def _get_level_bnds(depths_ctn, vbnds_dim):
         """
@@ -42,17 +76,14 @@ class OrcaMesh(metaclass=abc.ABCMeta):
         """
         
         zdim = list(depths_ctn.dims)[0]
-        nz = depths_ctn.sizes[zdim]
-        
         ctns_arr = depths_ctn.values
-        bnds_tmp = np.ndarray(shape=[nz+1], dtype=float)
-        
-        bnds_tmp[0] = 0.
-        for k in range(0, nz):
-            bnds_tmp[k+1] = 2 * ctns_arr[k] - bnds_tmp[k]
-        
-        return xr.DataArray(data=np.transpose([bnds_tmp[:-1],
-                                               bnds_tmp[1:]]),
+
+        # bnds[k+1] = 2 * ctns[k] - bnds[k], with bnds[0] = 0, unrolled as an alternating cumulative sum
+        sign = (-1.) ** np.arange(ctns_arr.size + 1)
+        bnds_tmp = np.zeros(ctns_arr.size + 1)
+        bnds_tmp[1:] = -2 * sign[1:] * np.cumsum(sign[:-1] * ctns_arr)
+
+        return xr.DataArray(data=np.stack([bnds_tmp[:-1], bnds_tmp[1:]], axis=-1),
                             dims=[zdim, vbnds_dim])
         
 
@@ -76,7 +107,7 @@ class OrcaMesh(metaclass=abc.ABCMeta):
             
         return ds_out
         
-    def _geom_to_xesmf(self, meshfile):
+    def _geom_to_xesmf(self, meshfile, ds_mesh=None):
         """ Return grid/mask dataset understandable by xESMF. """
 
         get_vars = ["glam"+self.stagg,
@@ -88,8 +119,8 @@ class OrcaMesh(metaclass=abc.ABCMeta):
         if self.level:
             get_vars += ['gdept_1d']
             
-        ds_mesh = xr.open_dataset(meshfile, drop_variables=['time_counter'])\
-                    .squeeze()
+        if ds_mesh is None:
+            ds_mesh = self.open_mesh(meshfile, self.memory)
 
         ds_bounds = self._get_bounds_coords(ds_mesh, self.stagg)
 
@@ -180,66 +211,56 @@ class OrcaMesh(metaclass=abc.ABCMeta):
         ds_all_coords = self._get_all_coords(ds_mesh)
         crn_info = self._get_corner_dict()
 
-        nx = ds_mesh.sizes['x']
-        ny = ds_mesh.sizes['y']
-
-        ifwd_x = int(crn_info['fwd_x'])
-        ifwd_y = int(crn_info['fwd_y'])
-
-        slice_main_x = slice(ifwd_x, nx + ifwd_x)
-        slice_main_y = slice(ifwd_y, ny + ifwd_y)
-
-        idx_single_x = -1 + ifwd_x
-        idx_single_y = -1 + ifwd_y
-
         ds_out = xr.Dataset()
 
         for coord in ['lon', 'lat']:
-            tmp_bnds = xr.DataArray(data=np.ndarray(shape=[ny + 1, nx + 1],
-                                                    dtype=float), dims=['y_b', 'x_b'])
+            ds_out[coord+'_b'] = xr.DataArray(
+                data=self.bounds_kernel(ds_all_coords[crn_info['crn']][coord].values,
+                                        ds_all_coords[crn_info['pivot_x']][coord].values,
+                                        ds_all_coords[crn_info['pivot_y']][coord].values,
+                                        ds_all_coords[crn_info['ctn']][coord].values,
+                                        crn_info['fwd_x'], crn_info['fwd_y']),
+                dims=['y_b', 'x_b'])
             
-            tmp_bnds.loc[dict(x_b=slice_main_x,
-                              y_b=slice_main_y)] = \
-                                  ds_all_coords[crn_info['crn']][coord].data
+        return ds_out
 
-            tmp_bnds.loc[dict(x_b=idx_single_x, y_b=slice_main_y)] = \
-                2 * ds_all_coords[crn_info['pivot_x']][coord].isel(x=idx_single_x).data \
-                - ds_all_coords[crn_info['crn']][coord].isel(x=idx_single_x).data
-            
-            tmp_bnds.loc[dict(y_b=idx_single_y, x_b=slice_main_x)] = \
-                2 * ds_all_coords[crn_info['pivot_y']][coord].isel(y=idx_single_y).data \
-                - ds_all_coords[crn_info['crn']][coord].isel(y=idx_single_y).data
+    @staticmethod
+    def bounds_kernel(crn, pivot_x, pivot_y, ctn, fwd_x, fwd_y):
+        """
+        Compute the (y+1, x+1) xESMF corners from the (y, x) corner points: the missing
+        row/column (first or last, depending on the forward flags) is obtained by
+        reflecting the corners through the pivot (or centre) points.
+        """
 
-            tmp_bnds.loc[dict(x_b=idx_single_x, y_b=idx_single_y)] = \
-                2 * ds_all_coords[crn_info['ctn']][coord].isel(x=idx_single_x, y=idx_single_y).data \
-                - ds_all_coords[crn_info['crn']][coord].isel(x=idx_single_x, y=idx_single_y).data
+        ny, nx = crn.shape
+        ifwd_x, ifwd_y = int(fwd_x), int(fwd_y)
+        main_x, main_y = slice(ifwd_x, nx + ifwd_x), slice(ifwd_y, ny + ifwd_y)
+        single_x, single_y = ifwd_x - 1, ifwd_y - 1
 
-            ds_out[coord+'_b'] = tmp_bnds
-            
-        return ds_out
+        bnds = np.empty((ny + 1, nx + 1), dtype=float)
+        bnds[main_y, main_x] = crn
+        bnds[main_y, single_x] = 2 * pivot_x[:, single_x] - crn[:, single_x]
+        bnds[single_y, main_x] = 2 * pivot_y[single_y, :] - crn[single_y, :]
+        bnds[single_y, single_x] = 2 * ctn[single_y, single_x] - crn[single_y, single_x]
+
+        return bnds
+
+    @staticmethod
+    def cf_bounds_kernel(bnds):
+        """ Convert (y+1, x+1) xESMF corners into (y, x, 4) CF bounds, counterclockwise from lower left. """
+
+        return np.stack([bnds[:-1, :-1], bnds[:-1, 1:], bnds[1:, 1:], bnds[1:, :-1]], axis=-1)
 
     def get_ds_cf(self):
         """ Convert the bounds from xESMF (y+1, x+1) convention into CF convention (y,x,bnds). """
         
         ds_out = self.ds_xesmf.drop_vars(['lon_b', 'lat_b'])
-        ny, nx = ds_out['lat'].sizes['y'], ds_out['lat'].sizes['x']
 
         for coord in ['lat', 'lon']:
-            bnds_xesmf = self.ds_xesmf[coord+'_b']
-            bnds_cf = xr.zeros_like(ds_out[coord])\
-                        .expand_dims({self.BNDS_DIM: 4}, axis=-1)\
-                        .copy()
-            bnds_cf.attrs = {}
-            bnds_cf.loc[{self.BNDS_DIM: 0}] = bnds_xesmf.isel({'x_b': slice(0, nx),
-                                                               'y_b': slice(0, ny)}).data
-            bnds_cf.loc[{self.BNDS_DIM: 1}] = bnds_xesmf.isel({'x_b': slice(1, nx+1),
-                                                               'y_b': slice(0, ny)}).data
-            bnds_cf.loc[{self.BNDS_DIM: 2}] = bnds_xesmf.isel({'x_b': slice(1, nx+1),
-                                                               'y_b': slice(1, ny+1)}).data
-            bnds_cf.loc[{self.BNDS_DIM: 3}] = bnds_xesmf.isel({'x_b': slice(0, nx),
-                                                               'y_b': slice(1, ny+1)}).data
-
-            ds_out[coord+'_'+self.BNDS_DIM] = bnds_cf
+            ds_out[coord+'_'+self.BNDS_DIM] = xr.DataArray(
+                data=self.cf_bounds_kernel(self.ds_xesmf[coord+'_b'].values),
+                dims=list(ds_out[coord].dims) + [self.BNDS_DIM],
+                coords=ds_out[coord].coords)
             ds_out[coord].attrs['bounds'] = coord+'_'+self.BNDS_DIM
             ds_out[coord+'_'+self.BNDS_DIM].encoding['coordinates'] = None
             ds_out[coord+'_'+self.BNDS_DIM].encoding['_FillValue'] = None
@@ -256,16 +277,97 @@ class OrcaMesh(metaclass=abc.ABCMeta):
     def reorder_vars(self, dset):
         """ Reorder variable order in netCDF file. """
 
+        # xESMF-type datasets have (y+1, x+1) lat_b/lon_b instead of lat_bnds/lon_bnds
+        bnds = '_'+self.BNDS_DIM if 'lat_'+self.BNDS_DIM in dset.variables else '_b'
+
         vvars = []
         if self.level:
             vvars += [self.VDIM, self.VDIM+'_'+self.VBNDS_DIM]
-        vvars += ['lat', 'lat_bnds',
-                  'lon', 'lon_bnds',
+        vvars += ['lat', 'lat'+bnds,
+                  'lon', 'lon'+bnds,
                   'cell_area',
                   'mask']#,
                   #'dummy']
+        if self.INDEX_VAR in dset.variables:
+            vvars += [self.INDEX_VAR]
         
         return dset[vvars]        
+
+    def _get_mask_2d(self):
+        """ Horizontal mask, wet if any level is wet. """
+
+        mask = self.ds_xesmf['mask']
+        if self.level:
+            mask = mask.max(dim=self.VDIM)
+        return mask.values.astype('int32')
+
+    def get_ds_scrip(self):
+        """ SCRIP grid description, with (cell, 4) corners in degrees. """
+
+        lat_b = self.cf_bounds_kernel(self.ds_xesmf['lat_b'].values)
+        lon_b = self.cf_bounds_kernel(self.ds_xesmf['lon_b'].values)
+        ny, nx = lat_b.shape[:2]
+
+        ds_out = xr.Dataset({
+            'grid_dims': ('grid_rank', np.array([nx, ny], dtype='int32')),
+            'grid_center_lat': ('grid_size', self.ds_xesmf['lat'].values.ravel(), {'units': 'degrees'}),
+            'grid_center_lon': ('grid_size', self.ds_xesmf['lon'].values.ravel(), {'units': 'degrees'}),
+            'grid_imask': ('grid_size', self._get_mask_2d().ravel(), {'units': 'unitless'}),
+            'grid_corner_lat': (('grid_size', 'grid_corners'), lat_b.reshape(-1, 4), {'units': 'degrees'}),
+            'grid_corner_lon': (('grid_size', 'grid_corners'), lon_b.reshape(-1, 4), {'units': 'degrees'})
+        })
+        ds_out.attrs['title'] = 'ORCA '+self.stagg.upper()+' grid'
+        for var in ds_out.variables:
+            ds_out[var].encoding = {'_FillValue': None}
+
+        return ds_out
+
+    def write_griddes(self, fff):
+        """ Write the CDO curvilinear grid description (griddes text), with corners, to an open file. """
+
+        lat_b = self.cf_bounds_kernel(self.ds_xesmf['lat_b'].values)
+        lon_b = self.cf_bounds_kernel(self.ds_xesmf['lon_b'].values)
+        ny, nx = lat_b.shape[:2]
+
+        fff.write('\n'.join([
+            '#', '# ORCA '+self.stagg.upper()+' grid', '#',
+            'gridtype  = curvilinear',
+            f'gridsize  = {nx * ny}',
+            f'xsize     = {nx}',
+            f'ysize     = {ny}',
+            'xname     = lon',
+            'xunits    = "degrees_east"',
+            'yname     = lat',
+            'yunits    = "degrees_north"',
+            'nvertex   = 4']) + '\n')
+
+        # values are streamed row by row, the text is never held in memory
+        for name, arr, ncol in [('xvals', self.ds_xesmf['lon'].values, nx), ('xbounds', lon_b, 4),
+                                ('yvals', self.ds_xesmf['lat'].values, nx), ('ybounds', lat_b, 4)]:
+            fff.write(f'{name:<10}= ')
+            np.savetxt(fff, arr.reshape(-1, ncol), fmt='%.10g')
+
+    def export(self, fmt, outfile):
+        """ Write the mesh in one of the FORMATS. """
+
+        if fmt == 'griddes':
+            with open(outfile, 'w', encoding='utf8') as fff:
+                self.write_griddes(fff)
+            return outfile
+
+        if fmt == 'scrip':
+            ds_out = self.get_ds_scrip()
+        elif fmt == 'xesmf':
+            ds_out = self.reorder_vars(self.ds_xesmf)
+        elif fmt == 'cf':
+            ds_out = self.reorder_vars(self.get_ds_cf())
+        elif fmt == 'unstructured':
+            ds_out = self.reorder_vars(self.reshape_unstructured(self.get_ds_cf(), self.wet_only))
+        else:
+            raise ValueError(f'Unknown format {fmt}: available are {self.FORMATS}')
+
+        ds_out.to_netcdf(outfile)
+        return outfile
     
     @staticmethod
     def _get_all_coords(ds_mesh):
@@ -279,16 +381,47 @@ class OrcaMesh(metaclass=abc.ABCMeta):
 
         return all_coords
 
-    def reshape_unstructured(self, original):
-        """Reshape your array to be a unstructured grid instead of a curvilinear grid"""
+    def reshape_unstructured(self, original, wet_only=False):
+        """
+        Reshape your array to be a unstructured grid instead of a curvilinear grid.
+        With wet_only, land cells are dropped and the int32 position of each packed
+        cell in the flattened (y, x) grid is stored in INDEX_VAR.
+        """
 
-        new = original.stack({self.UNSTRUCT_DIM: ('y', 'x')}).drop_vars(['x','y', self.UNSTRUCT_DIM])
+        # no multi-index: on large grids it is as big as the fields, and it is dropped anyway
+        new = original.stack({self.UNSTRUCT_DIM: ('y', 'x')}, create_index=False)\
+                      .drop_vars(['x','y', self.UNSTRUCT_DIM], errors='ignore')
         new['lon_' + self.BNDS_DIM] = new['lon_' + self.BNDS_DIM].transpose(self.UNSTRUCT_DIM, self.BNDS_DIM) 
         new['lat_'+ self.BNDS_DIM] = new['lat_' + self.BNDS_DIM].transpose(self.UNSTRUCT_DIM, self.BNDS_DIM)
         #new['dummy'].attrs['grid_type'] = 'unstructured'
         new['mask'].attrs['grid_type'] = 'unstructured'
+
+        if wet_only:
+            index = np.flatnonzero(self._get_mask_2d()).astype('int32')
+            new = new.isel({self.UNSTRUCT_DIM: index})
+            new[self.INDEX_VAR] = xr.DataArray(
+                data=index, dims=[self.UNSTRUCT_DIM],
+                attrs={'long_name': 'index of the cell in the flattened (y, x) grid',
+                       'grid_shape': list(original['mask'].shape[-2:])})
+            new[self.INDEX_VAR].encoding = {'_FillValue': None}
         
         return new
+
+    @staticmethod
+    def pack(field, index):
+        """ Gather the wet cells of a (..., y, x) field into a (..., cell) array. """
+
+        return field.reshape(field.shape[:-2] + (-1,))[..., index]
+
+    @staticmethod
+    def unpack(packed, index, shape, fill_value=np.nan):
+        """ Scatter a (..., cell) array back into a (..., y, x) field, filling land cells. """
+
+        field = np.full(packed.shape[:-1] + (shape[0] * shape[1],), fill_value,
+                        dtype=np.result_type(packed.dtype, fill_value))
+        field[..., index] = packed
+
+        return field.reshape(packed.shape[:-1] + tuple(shape))
  
 
 def get_args():
@@ -302,16 +435,66 @@ def get_args():
                         help="generate xesmf-type of file, with bounds stored as (y+1, x+1) array, instead of CF-compliant (y,x,4) bounds")
     parser.add_argument('--unstructured', action=argparse.BooleanOptionalAction,
                         help="produce unstructured grid (instead of curvilinear) to be used with NEMO GRIB files")
+    parser.add_argument('--wet-only', action=argparse.BooleanOptionalAction,
+                        help="with --unstructured, keep only the ocean cells and write their index in the (y, x) grid")
     parser.add_argument('--level', action=argparse.BooleanOptionalAction,
                         help="include vertical axis")
+    parser.add_argument('--formats', type=str, nargs='+', choices=OrcaMesh.FORMATS,
+                        help="one-pass mode: read the mesh once and write all the T, U, V and F grids "
+                             "in the given formats, as <outfile>_<stagg>_<format>.nc (.txt for griddes)")
+    parser.add_argument('--memory', type=int, default=OrcaMesh.MEMORY,
+                        help="memory budget (MB) of the chunked processing of the mesh")
+    parser.add_argument('--nproc', type=int, default=None,
+                        help="number of worker processes in one-pass mode, each building and writing a staggering")
     parser.add_argument(
-        "outfile", type=str,  help="path to output file")
+        "outfile", type=str,  help="path to output file (prefix of the output files in one-pass mode)")
 
     return parser.parse_args()
 
     
+def _export_stagg(args, stagg, ds_mesh):
+    """ Worker: build the grid of a staggering from the shared mesh and write it in all the requested formats. """
+
+    stagg_args = copy.copy(args)
+    stagg_args.stagg = stagg
+    orca = OrcaMesh(stagg_args, ds_mesh)
+
+    outfiles = []
+    for fmt in args.formats:
+        ext = '.txt' if fmt == 'griddes' else '.nc'
+        outfiles.append(orca.export(fmt, f'{args.outfile}_{stagg}_{fmt}{ext}'))
+
+    return outfiles
+
+
+def export_all(args):
+    """
+    Read the mesh once and write all the staggerings in all the requested formats, each staggering
+    built and written by its own process (HDF5 is not thread-safe), within a share of the memory budget.
+    """
+
+    nproc = min(args.nproc or os.cpu_count(), len(OrcaMesh.STAGGS))
+    worker_args = copy.copy(args)
+    worker_args.memory = max(1, (args.memory or OrcaMesh.MEMORY) // nproc)
+
+    # horizontal fields are read once here and shared by all the staggerings, 3D masks stay lazy
+    ds_mesh = OrcaMesh.open_mesh(args.meshmask, worker_args.memory)
+    for var in ds_mesh.data_vars:
+        if 'nav_lev' not in ds_mesh[var].dims:
+            ds_mesh[var] = ds_mesh[var].load()
+
+    # spawned workers: forking after HDF5 and dask have been used in the parent can deadlock
+    with ProcessPoolExecutor(max_workers=nproc, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(_export_stagg, worker_args, stagg, ds_mesh) for stagg in OrcaMesh.STAGGS]
+        return [outfile for future in futures for outfile in future.result()]
+
+
 def main(args):
 
+    if args.formats:
+        export_all(args)
+        return
+
     orca = OrcaMesh(args)
     
     if args.xesmf:
@@ -320,7 +503,7 @@ def main(args):
         ds_out = orca.get_ds_cf()
 
     if args.unstructured:
-        ds_out = orca.reshape_unstructured(ds_out)
+        ds_out = orca.reshape_unstructured(ds_out, args.wet_only)
 
     ds_out = orca.reorder_vars(ds_out)
     
@@ -3,22 +3,21 @@
 
 """
 This is a command line tool to modfy the NEMO restart files from a specific EC-Eart4
-experiment, given a specific experiment and leg. 
+experiment, given a specific experiment and leg (or a range of legs).
+Processed legs are recorded in a manifest and skipped when run again.
 
 Authors
 Alessandro Sozza and Paolo Davini (CNR-ISAC, Oct 2023)
 """
 
-import subprocess
 import os
-import glob
-import shutil
 import argparse
-import xarray as xr
+from nemo_rebuild import rebuild_restart, decompose_restart
+from restart_manifest import RestartIndex, Manifest, parse_legs, link_or_move
+from restart_edit import edit_restart, FLUX_VARS
 
-# on atos, you will need to have
-# module load intel/2021.4.0 intel-mkl/19.0.5 prgenv/intel hdf5 netcdf4 
-# export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:/usr/local/apps/netcdf4/4.9.1/INTEL/2021.4/lib:/usr/local/apps/hdf5/1.12.2/INTEL/2021.4/lib
+EXP_BASE = "/ec/res4/scratch/itas/ece4"
+MARTINI_BASE = "/ec/res4/scratch/ccpd/martini"
 
 def parse_args():
     """Command line parser for nemo-restart"""
@@ -27,10 +26,24 @@ def parse_args():
 
     # add positional argument (mandatory)
     parser.add_argument("expname", metavar="EXPNAME", help="Experiment name")
-    parser.add_argument("leg", metavar="LEG", help="The leg you want to process for rebuilding", type=str)
+    parser.add_argument("leg", metavar="LEG", type=str,
+                        help="The leg you want to process for rebuilding: a single leg, a range (10-20), a list (1,5,10-12) or all")
 
     # optional to activate nemo rebuild
     parser.add_argument("--rebuild", action="store_true", help="Enable nemo-rebuild")
+    parser.add_argument("--nproc", type=int, default=None,
+                        help="Number of workers for the rebuild (default: all the cpus)")
+
+    # optional to split the final restarts back into per-processor files
+    parser.add_argument("--decompose", action="store_true",
+                        help="Decompose restart.nc and restart_ice.nc following the leg decomposition")
+
+    # optional to reset the surface fluxes of the ocean restart
+    parser.add_argument("--zero-fluxes", action="store_true",
+                        help="Set to zero the _b surface fluxes in restart.nc (edited in place)")
+
+    # optional to process again legs already in the manifest
+    parser.add_argument("--force", action="store_true", help="Process legs even if already done, rescanning the restart tree")
 
     parsed = parser.parse_args()
 
@@ -41,75 +54,107 @@ def get_nemo_timestep(filename):
 
     return os.path.basename(filename).split('_')[1]
 
-def rebuild_nemo(expname, leg, dirs):
-    """Minimal nemo rebuilder in a temporary path"""
+def decompose_nemo(expname, leg, dirs, index, nproc=None):
+    """Split the global restarts back into per-processor files, using the leg files as templates"""
+
+    outputs = []
+    for kind in ['restart', 'restart_ice']:
+        outputs += decompose_restart(os.path.join(dirs['tmp'], kind + '.nc'),
+                                     os.path.join(dirs['tmp'], kind),
+                                     templates=index.files(leg, kind), nproc=nproc)
+    return outputs
+
+def rebuild_nemo(expname, leg, dirs, index, nproc=None):
+    """Native nemo rebuilder writing the global restarts in the temporary path"""
 
-    rebuilder = os.path.join(dirs['rebuild'], "rebuild_nemo")
-  
+    rebuilt = {}
     for kind in ['restart', 'restart_ice']:
-        print('Processing' + kind)
-        flist = glob.glob(os.path.join(dirs['exp'], 'restart', leg.zfill(3), expname + '*_' + kind + '_????.nc'))
+        print('Processing ' + kind)
+        flist = index.files(leg, kind)
+        if not flist:
+            raise FileNotFoundError(f'No {kind} files found for {expname} leg {leg}')
         tstep = get_nemo_timestep(flist[0])
+        outfile = os.path.join(dirs['tmp'], expname + '_' + tstep + '_' + kind + '.nc')
+        rebuilt[kind] = rebuild_restart(flist, outfile, nproc=nproc)
 
-        for filename in flist:
-            destination_path = os.path.join(dirs['tmp'], os.path.basename(filename))
-            try:
-                os.symlink(filename, destination_path)
-            except FileExistsError:
-                pass
+    return rebuilt
 
-        rebuild_command = [rebuilder, '-p', str(4), '-m', os.path.join(dirs['tmp'],  expname + "_" + tstep + "_" + kind ), str(len(flist))]
-        print(rebuild_command)
-        try:
-            subprocess.run(rebuild_command, stderr=subprocess.PIPE, text=True, check=True)
-            for file in glob.glob('nam_rebuld_*') : 
-                os.remove(file)
-        except subprocess.CalledProcessError as e:
-            error_message = e.stderr
-            print(error_message) 
+def finalize_nemo(expname, dirs, zero_fluxes=False):
+    """
+    Rename the rebuilt restarts to restart.nc and restart_ice.nc (no copy involved)
+    and optionally reset the surface fluxes of the ocean restart.
+    Both global restarts must have been rebuilt, in this run or in a previous one.
+    """
 
-        for filename in flist:
-            destination_path = os.path.join(dirs['tmp'], os.path.basename(filename))
-            os.remove(destination_path)
+    outputs = []
+    for kind in ['restart', 'restart_ice']:
+        target = os.path.join(dirs['tmp'], kind + '.nc')
+        flist = [file for file in os.listdir(dirs['tmp'])
+                 if file.startswith(expname + '_') and file.endswith('_' + kind + '.nc')]
+        if flist:
+            link_or_move(os.path.join(dirs['tmp'], flist[0]), target)
+        if not os.path.exists(target):
+            raise FileNotFoundError(f'No rebuilt {kind} in {dirs["tmp"]}, run with --rebuild')
+        outputs.append(target)
 
+    if zero_fluxes:
+        edit_restart(os.path.join(dirs['tmp'], 'restart.nc'),
+                     [{'op': 'zero', 'vars': FLUX_VARS, 'optional': True}])
 
-if __name__ == "__main__":
-    
-    # parser
-    args = parse_args()
-    expname = args.expname
-    leg = args.leg
+    return outputs
+
+def requested_ops(args):
+    """Operations requested on the command line, as recorded in the manifest"""
+
+    return [op for op in ['rebuild', 'zero_fluxes', 'decompose'] if getattr(args, op)]
+
+def process_leg(expname, leg, index, args):
+    """Rebuild, finalize and optionally decompose the restarts of a single leg"""
 
     # define directories
     dirs = {
-        'exp': os.path.join("/ec/res4/scratch/itas/ece4", expname),
-        'tmp':  os.path.join("/ec/res4/scratch/ccpd/martini", expname, leg.zfill(3)),
-        'rebuild': "/ec/res4/hpcperm/itas/src/rebuild_nemo"
+        'exp': os.path.join(EXP_BASE, expname),
+        'tmp':  os.path.join(MARTINI_BASE, expname, str(leg).zfill(3))
     }
 
     os.makedirs(dirs['tmp'], exist_ok=True)
 
     if args.rebuild:
-        rebuild_nemo(expname=expname, leg=leg, dirs=dirs)
+        rebuild_nemo(expname=expname, leg=leg, dirs=dirs, index=index, nproc=args.nproc)
+
+    outputs = finalize_nemo(expname=expname, dirs=dirs, zero_fluxes=args.zero_fluxes)
 
-    filelist = glob.glob(os.path.join(dirs['tmp'],  expname + '*_restart.nc'))
-    timestep = get_nemo_timestep(filelist[0])
-    oce = os.path.join(dirs['tmp'], expname + '_' + timestep + '_restart.nc')
+    if args.decompose:
+        outputs += decompose_nemo(expname=expname, leg=leg, dirs=dirs, index=index, nproc=args.nproc)
 
-    # ice restart copy
+    return outputs
 
-    shutil.copy(os.path.join(dirs['tmp'], expname + '_' + timestep + '_restart.nc'), os.path.join(dirs['tmp'], 'restart.nc'))
-    #xfield = xr.open_dataset(os.path.join(dirs['tmp'], expname + '_' + timestep + '_restart.nc'))
-    #list2nan = ['rnf_b', 'rnf_hc_b', 'rnf_sc_b', 'utau_b', 'vtau_b', 'qns_b', 'emp_b', 'sfx_b']
-    #for var in list2nan:
-    #    xfield[var] = xr.where(xfield[var]!=0, 0., 0.)
-    #xfield.to_netcdf(os.path.join(dirs['tmp'], 'restart.nc'))
-    shutil.copy(os.path.join(dirs['tmp'], expname + '_' + timestep + '_restart_ice.nc'), os.path.join(dirs['tmp'], 'restart_ice.nc'))
-    os.remove(os.path.join(dirs['tmp'], expname + '_' + timestep + '_restart.nc'))
-    os.remove(os.path.join(dirs['tmp'], expname + '_' + timestep + '_restart_ice.nc'))
 
-    flist = glob.glob('nam_rebuild*')
-    for file in flist:
-        os.remove(file)
+if __name__ == "__main__":
 
-    
+    # parser
+    args = parse_args()
+    expname = args.expname
+
+    # scan the restart tree once, reusing the cached listing of unchanged legs
+    martini_dir = os.path.join(MARTINI_BASE, expname)
+    restart_dir = os.path.join(EXP_BASE, expname, 'restart')
+    os.makedirs(martini_dir, exist_ok=True)
+    index = RestartIndex(restart_dir, expname, cachefile=os.path.join(martini_dir, 'index.json'),
+                         rescan=args.force)
+    manifest = Manifest(os.path.join(martini_dir, 'manifest.json'))
+
+    ops = requested_ops(args)
+    for leg in parse_legs(args.leg, index.legs()):
+        inputs = index.stats(leg)
+        if not args.force and manifest.is_done(leg, inputs, ops):
+            print(f'Leg {leg} already processed, skipping')
+            continue
+        print(f'Processing leg {leg}')
+        try:
+            outputs = process_leg(expname, leg, index, args)
+        except FileNotFoundError as err:
+            print(f'Leg {leg} not processed: {err}')
+            continue
+        manifest.record(leg, inputs, outputs, ops=ops, reset=args.rebuild,
+                        input_dir=os.path.join(restart_dir, str(leg).zfill(3)))
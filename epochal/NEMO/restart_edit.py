@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+In-place editing of NEMO restart fields.
+
+The restart is opened read-write with netCDF4 and only the named variables are
+modified, level by level, with declarative operations:
+    {'op': 'zero', 'vars': [...]}
+    {'op': 'scale', 'vars': [...], 'factor': 0.5}
+    {'op': 'clip', 'vars': [...], 'min': 0., 'max': None}
+    {'op': 'set', 'vars': [...], 'source': 'other_restart.nc', 'source_var': None}
+Missing variables raise an error, unless the operation has 'optional': True.
+Untouched variables are neither decoded nor rewritten.
+"""
+
+import argparse
+import numpy as np
+import netCDF4 as nc
+
+# surface fluxes at the before time step, which can be reset for a clean restart
+FLUX_VARS = ['rnf_b', 'rnf_hc_b', 'rnf_sc_b', 'utau_b', 'vtau_b', 'qns_b', 'emp_b', 'sfx_b']
+
+
+def _slabs(var):
+    """Indices of the slabs of a variable: one per level for 3D fields, the whole variable otherwise"""
+
+    if var.ndim < 3:
+        return [Ellipsis]
+
+    axis = var.ndim - 3
+    slabs = []
+    for level in range(var.shape[axis]):
+        index = [slice(None)] * var.ndim
+        index[axis] = level
+        slabs.append(tuple(index))
+
+    return slabs
+
+
+def _apply(operation, var, source=None):
+    """Apply a single operation to a variable, slab by slab"""
+
+    op = operation['op']
+    for index in _slabs(var):
+        if op == 'zero':
+            var[index] = 0
+        elif op == 'scale':
+            var[index] = var[index] * operation['factor']
+        elif op == 'clip':
+            var[index] = np.clip(var[index], operation.get('min'), operation.get('max'))
+        elif op == 'set':
+            var[index] = source[index]
+        else:
+            raise ValueError(f'Unknown operation {op}: available are zero, scale, clip and set')
+
+
+def edit_restart(filename, operations):
+    """
+    Modify in place the named variables of a restart file
+
+    Args:
+        filename (str): the restart file
+        operations (list): declarative operations (see module docstring)
+
+    Returns:
+        The list of modified variables
+    """
+
+    modified = []
+    with nc.Dataset(filename, 'r+') as ds:
+        for operation in operations:
+            src_ds = nc.Dataset(operation['source']) if operation['op'] == 'set' else None
+            try:
+                for name in operation['vars']:
+                    if name not in ds.variables:
+                        if not operation.get('optional', False):
+                            raise KeyError(f'Variable {name} not found in {filename}')
+                        continue
+                    var = ds.variables[name]
+                    source = None
+                    if src_ds is not None:
+                        source = src_ds.variables[operation.get('source_var') or name]
+                        if source.shape != var.shape:
+                            raise ValueError(f'Shape mismatch for {name}: {source.shape} vs {var.shape}')
+                    _apply(operation, var, source)
+                    modified.append(name)
+            finally:
+                if src_ds is not None:
+                    src_ds.close()
+
+    return modified
+
+
+def get_args():
+    """Command line parser for the restart editor"""
+
+    parser = argparse.ArgumentParser(description="Edit in place the fields of a NEMO restart file.")
+    parser.add_argument("restart", type=str, help="path to the restart file")
+    parser.add_argument("--zero", type=str, nargs='+', default=[], help="variables to be set to zero")
+    parser.add_argument("--zero-fluxes", action="store_true", help="set to zero the _b surface fluxes")
+    parser.add_argument("--scale", type=str, nargs=2, action='append', default=[],
+                        metavar=('VAR', 'FACTOR'), help="multiply a variable by a factor")
+    parser.add_argument("--clip", type=str, nargs=3, action='append', default=[],
+                        metavar=('VAR', 'MIN', 'MAX'), help="clip a variable (use None for no bound)")
+    parser.add_argument("--set", type=str, nargs=2, action='append', default=[],
+                        metavar=('VAR', 'FILE'), help="copy a variable from another file")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+
+    def bound(value):
+        return None if value == 'None' else float(value)
+
+    ops = []
+    if args.zero:
+        ops.append({'op': 'zero', 'vars': args.zero})
+    if args.zero_fluxes:
+        ops.append({'op': 'zero', 'vars': FLUX_VARS, 'optional': True})
+    ops += [{'op': 'scale', 'vars': [var], 'factor': float(factor)} for var, factor in args.scale]
+    ops += [{'op': 'clip', 'vars': [var], 'min': bound(vmin), 'max': bound(vmax)}
+            for var, vmin, vmax in args.clip]
+    ops += [{'op': 'set', 'vars': [var], 'source': source} for var, source in args.set]
+
+    print('Modified', edit_restart(args.restart, ops))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Directory index and processing manifest for the NEMO restarts of an experiment.
+
+The restart/ tree of an experiment is scanned once and the listing of each leg
+directory is cached on disk, so that it is read again only when the directory
+changes. The manifest records inputs (size, mtime, checksum) and outputs of
+each processed leg, so that legs already rebuilt can be skipped.
+"""
+
+import os
+import re
+import json
+import hashlib
+
+# restart files of a leg, e.g. EXP_00001234_restart_ice_0012.nc
+RESTART_PATTERN = r'^{expname}_(\d+)_(restart|restart_ice)_(\d{{4}})\.nc$'
+
+# bytes read at the head and at the tail of a file for the checksum
+CHECKSUM_BYTES = 1024**2
+
+
+def file_checksum(filename, nbytes=CHECKSUM_BYTES):
+    """
+    Sampled checksum of a file: blake2b of its size, head and tail.
+    Reading the whole multi-GB restarts would cost as much as the rebuild.
+    """
+
+    size = os.path.getsize(filename)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(filename, 'rb') as fff:
+        digest.update(fff.read(nbytes))
+        if size > 2 * nbytes:
+            fff.seek(-nbytes, os.SEEK_END)
+            digest.update(fff.read(nbytes))
+        elif size > nbytes:
+            digest.update(fff.read())
+
+    return digest.hexdigest()
+
+
+def file_stat(filename, checksum=True):
+    """Size, mtime and (optionally) checksum of a file"""
+
+    stat = os.stat(filename)
+    info = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if checksum:
+        info['checksum'] = file_checksum(filename)
+
+    return info
+
+
+def _write_json(path, content):
+    """Atomically write a json file"""
+
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'w', encoding='utf-8') as fff:
+        json.dump(content, fff, indent=1)
+    os.replace(tmpfile, path)
+
+
+def _read_json(path):
+    """Read a json file, returning an empty dictionary if missing or broken"""
+
+    try:
+        with open(path, 'r', encoding='utf-8') as fff:
+            return json.load(fff)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+class RestartIndex:
+    """Cached index of the restart/ tree of an experiment"""
+
+    def __init__(self, restart_dir, expname, cachefile=None, rescan=False):
+        self.restart_dir = restart_dir
+        self.expname = expname
+        self.cachefile = cachefile
+        self.pattern = re.compile(RESTART_PATTERN.format(expname=re.escape(expname)))
+        self.index = self._scan(rescan)
+
+    def _scan(self, rescan=False):
+        """
+        Scan the leg directories, reusing the cached listing of unchanged ones.
+        A directory mtime does not change when a file is rewritten in place: use rescan then.
+        """
+
+        cache = _read_json(self.cachefile) if self.cachefile and not rescan else {}
+        index = {}
+        with os.scandir(self.restart_dir) as entries:
+            for entry in entries:
+                if not (entry.is_dir() and entry.name.isdigit()):
+                    continue
+                mtime = entry.stat().st_mtime
+                cached = cache.get(entry.name)
+                if cached and cached['mtime'] == mtime:
+                    index[entry.name] = cached
+                else:
+                    index[entry.name] = {'mtime': mtime, 'files': self._scan_leg(entry.path)}
+
+        if self.cachefile:
+            _write_json(self.cachefile, index)
+
+        return index
+
+    def _scan_leg(self, path):
+        """List the restart files of a leg directory, grouped by kind"""
+
+        files = {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                match = self.pattern.match(entry.name)
+                if match:
+                    stat = entry.stat()
+                    files.setdefault(match.group(2), {})[entry.name] = {
+                        'size': stat.st_size, 'mtime': stat.st_mtime}
+
+        return files
+
+    def legs(self):
+        """Sorted list of legs (as int) having restart files"""
+
+        return sorted(int(leg) for leg, content in self.index.items() if content['files'])
+
+    def files(self, leg, kind):
+        """Full paths of the restart files of a given leg and kind"""
+
+        legdir = str(leg).zfill(3)
+        names = self.index.get(legdir, {}).get('files', {}).get(kind, {})
+        return [os.path.join(self.restart_dir, legdir, name) for name in sorted(names)]
+
+    def stats(self, leg):
+        """Size and mtime of all the restart files of a leg, as recorded in the index"""
+
+        legdir = str(leg).zfill(3)
+        stats = {}
+        for kind in self.index.get(legdir, {}).get('files', {}).values():
+            stats.update(kind)
+
+        return stats
+
+
+def parse_legs(legs, available=None):
+    """
+    Parse a leg selection: 'all', a single leg '12', a range '10-20' or a list '1,5,10-12'.
+    If the available legs are given, selected legs that are not available are dropped.
+    """
+
+    if legs == 'all':
+        if available is None:
+            raise ValueError("Selecting all the legs requires the list of available legs")
+        return list(available)
+
+    selected = []
+    for item in legs.split(','):
+        if '-' in item:
+            first, last = item.split('-')
+            selected += range(int(first), int(last) + 1)
+        else:
+            selected.append(int(item))
+
+    if available is not None:
+        missing = sorted(set(selected) - set(available))
+        if missing:
+            print(f'Warning: no restarts for legs {missing}, skipping them')
+        selected = [leg for leg in selected if leg in available]
+
+    return selected
+
+
+class Manifest:
+    """Manifest of the processed legs of an experiment, stored as json"""
+
+    def __init__(self, path):
+        self.path = path
+        self.content = _read_json(path)
+
+    def is_done(self, leg, inputs, ops=()):
+        """
+        A leg is done if it was recorded with the same inputs (name, size and mtime),
+        with all the requested operations, and all its outputs still exist with the recorded size
+        """
+
+        entry = self.content.get(str(leg))
+        if not entry:
+            return False
+
+        if not set(ops) <= set(entry.get('ops', [])):
+            return False
+
+        recorded = {name: (info['size'], info['mtime']) for name, info in entry['inputs'].items()}
+        current = {name: (info['size'], info['mtime']) for name, info in inputs.items()}
+        if recorded != current:
+            return False
+
+        for path, info in entry['outputs'].items():
+            if not os.path.exists(path) or os.path.getsize(path) != info['size']:
+                return False
+
+        return True
+
+    def record(self, leg, inputs, outputs, ops=(), input_dir=None, reset=False):
+        """
+        Record a processed leg with the operations run: checksums of the inputs are computed here.
+        Unless reset (e.g. the restarts were rebuilt again), the operations and outputs
+        of a previous run on the same inputs are kept.
+        """
+
+        previous = self.content.get(str(leg), {})
+        if reset or not self.is_done(leg, inputs):
+            previous = {}
+        if input_dir:
+            inputs = {name: {**info, 'checksum': file_checksum(os.path.join(input_dir, name))}
+                      for name, info in inputs.items()}
+        self.content[str(leg)] = {
+            'inputs': inputs,
+            'ops': sorted(set(previous.get('ops', [])) | set(ops)),
+            'outputs': {**previous.get('outputs', {}), **{path: file_stat(path) for path in outputs}}
+        }
+        _write_json(self.path, self.content)
+
+
+def link_or_move(source, target, keep=False):
+    """
+    Place a file at a new path without copying: hardlink it if the source
+    has to be kept, rename it otherwise.
+    """
+
+    if os.path.exists(target):
+        os.remove(target)
+    if keep:
+        os.link(source, target)
+    else:
+        os.replace(source, target)
+
+    return target
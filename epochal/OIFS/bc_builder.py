@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Builder of the ICMCL boundary condition files of OIFS, one file per year.
+
+The monthly climatologies (e.g. the month_* files of the ECMWF climate directory,
+possibly modified beforehand with oifs_modifier) are read once and memory-mapped.
+Each year is then written by copying the messages in time order, with all the
+variables of a month together as cdo mergetime does. Only the reference date of
+each message is patched in its header bytes, as cdo settaxis would set it. The
+packed data are copied untouched, and the years are written concurrently.
+"""
+
+import os
+import mmap
+import tempfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import eccodes
+from grib_index import GribIndex
+
+# day and hour of the monthly time axis
+BC_DAY = 15
+BC_HOUR = 0
+
+# bytes of the message covering the reference date of both GRIB editions
+HEADER = 40
+
+
+class Climatology:
+    """ The monthly messages of several variables, memory-mapped from their GRIB files. """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self._files = [open(path, 'rb') for path in self.paths]
+        self._maps = [mmap.mmap(fff.fileno(), 0, access=mmap.ACCESS_READ) for fff in self._files]
+
+        # messages of each variable, in time order
+        months = []
+        for num, path in enumerate(self.paths):
+            records = GribIndex.open(path).records
+            dates = [self._date(num, record) for record in records]
+            months.append([record for _, record in sorted(zip(dates, records), key=lambda pair: pair[0])])
+        if len({len(records) for records in months}) != 1:
+            raise ValueError(f"The files have different numbers of months: {[len(r) for r in months]}")
+        # for each month, the (file, record) of all the variables
+        self.months = [[(num, records[month]) for num, records in enumerate(months)]
+                       for month in range(len(months[0]))]
+
+    def _date(self, num, record):
+        """Reference date and time of a message, from its header"""
+
+        message = self._maps[num][record['offset']:record['offset'] + record['length']]
+        gid = eccodes.codes_new_from_message(message)
+        date = (eccodes.codes_get(gid, 'dataDate'), eccodes.codes_get(gid, 'dataTime'))
+        eccodes.codes_release(gid)
+
+        return date
+
+    def close(self):
+        for mapped in self._maps:
+            mapped.close()
+        for fff in self._files:
+            fff.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write_year(self, year, outfile, first_month=1):
+        """Write the months of the climatology as consecutive months of a year, from first_month"""
+
+        # unique temporary name, the same file may be written by concurrent jobs
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for step, fields in enumerate(self.months):
+                    month = first_month - 1 + step
+                    date = (year + month // 12, month % 12 + 1, BC_DAY, BC_HOUR)
+                    for num, record in fields:
+                        view = memoryview(self._maps[num])[record['offset']:record['offset'] + record['length']]
+                        try:
+                            header = set_reference_date(view[:HEADER], record['edition'], *date)
+                            out.write(header)
+                            out.write(view[HEADER:])
+                        finally:
+                            view.release()
+        except BaseException:
+            os.remove(tmpfile)
+            raise
+        # mkstemp creates the file readable by the owner only
+        os.chmod(tmpfile, 0o644)
+        os.replace(tmpfile, outfile)
+
+        return outfile
+
+
+def set_reference_date(header, edition, year, month, day, hour=0):
+    """
+    Copy of the first bytes of a GRIB message with the reference date and time patched
+    in the identification section (section 1), minutes and seconds set to zero
+    """
+
+    header = bytearray(header)
+    if edition == 1:
+        # section 1 follows the 8 bytes of section 0, with year of century and century
+        century, year_of_century = divmod(year - 1, 100)
+        header[20:25] = bytes([year_of_century + 1, month, day, hour, 0])
+        header[32] = century + 1
+    elif edition == 2:
+        # section 1 follows the 16 bytes of section 0
+        if header[20] != 1:
+            raise ValueError("Identification section not found after the indicator section")
+        header[28:35] = year.to_bytes(2, 'big') + bytes([month, day, hour, 0, 0])
+    else:
+        raise ValueError(f"Unknown GRIB edition {edition}")
+
+    return bytes(header)
+
+
+def build_bc(paths, years, outdir, prefix='ICMCLECE4', nproc=4, first_month=1):
+    """
+    Write one ICMCL file per year from monthly climatologies, with nproc concurrent writers
+
+    Returns:
+        The list of the files written
+    """
+
+    os.makedirs(outdir, exist_ok=True)
+    with Climatology(paths) as clim, ThreadPoolExecutor(max_workers=nproc) as pool:
+        futures = [pool.submit(clim.write_year, year, os.path.join(outdir, f'{prefix}-{year}'), first_month)
+                   for year in years]
+        return [future.result() for future in futures]
+
+
+def get_args():
+    """Command line parser for the BC builder"""
+
+    parser = argparse.ArgumentParser(description="Build per-year OIFS ICMCL files from monthly climatologies.")
+    parser.add_argument("paths", type=str, nargs='+', help="monthly climatology of each variable, e.g. month_alb")
+    parser.add_argument("--outdir", type=str, required=True, help="directory of the ICMCL files")
+    parser.add_argument("--years", type=int, nargs=2, required=True, metavar=('FIRST', 'LAST'),
+                        help="first and last year of the files")
+    parser.add_argument("--prefix", type=str, default='ICMCLECE4', help="prefix of the file names")
+    parser.add_argument("--nproc", type=int, default=4, help="number of files written at the same time")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    files = build_bc(args.paths, range(args.years[0], args.years[1] + 1), args.outdir,
+                     prefix=args.prefix, nproc=args.nproc)
+    print(f"Written {len(files)} files in {args.outdir}")
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Small builder of CDO operator chains, e.g. -setgrid,... -remapcon,... -sp2gpl file,
+so that several operators run as a single CDO invocation streaming the fields in
+memory, instead of writing and reading back a temporary file at each step.
+Operators are added in the order they are applied to the data.
+"""
+
+
+class Chain:
+    """ A chain of CDO operators applied to some input files, run as a single CDO call. """
+
+    def __init__(self, inputs, options=None, ops=None):
+        self.inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+        self.options = options
+        # (operator, parameters), from the first applied to the last
+        self.ops = list(ops or [])
+
+    def op(self, name, *params):
+        """A new chain applying the operator with its parameters to the output of this one"""
+
+        return Chain(self.inputs, self.options, self.ops + [(name, params)])
+
+    @staticmethod
+    def _format(name, params):
+        return ','.join([name] + [str(param) for param in params])
+
+    @property
+    def operators(self):
+        """Operators of the chain, in CDO syntax"""
+
+        return ' '.join('-' + self._format(name, params) for name, params in reversed(self.ops))
+
+    @property
+    def key(self):
+        """Description of the operation, independent of the input files (e.g. as cache key)"""
+
+        return ' '.join(['cdo'] + ([self.options] if self.options else []) + [self.operators])
+
+    def __str__(self):
+        return ' '.join([self.operators] + self.inputs)
+
+    def run(self, cdo, output):
+        """Run the chain with the CDO bindings, writing the output file"""
+
+        if not self.ops:
+            raise ValueError('Empty CDO chain')
+        name, params = self.ops[-1]
+        inner = ' '.join(['-' + self._format(*op) for op in reversed(self.ops[:-1])] + self.inputs)
+        kwargs = {'options': self.options} if self.options else {}
+
+        return getattr(cdo, name)(*params, input=inner, output=output, **kwargs)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Reduced Gaussian grid definitions computed in Python, without CDO or the ECMWF climate files:
+Gaussian latitudes and quadrature weights (roots of the Legendre polynomials by Newton
+iteration, vectorized over all the latitudes), the number of points per row of the
+octahedral (TCO) and linear (TL) reduced grids, and the CDO griddes text of the grids.
+"""
+
+import functools
+import numpy as np
+from utils import extract_grid_info, spectral2gaussian
+
+# points per row of the northern hemisphere of the ECMWF linear reduced grids (not given by a closed rule)
+TL_REDUCED_POINTS = {
+    63: [20, 27, 36, 40, 45, 50, 60, 64, 72, 75, 80, 90, 90, 96, 100, 108, 108, 120, 120, 120, 128,
+         128, 128, 128, 128, 128, 128, 128, 128, 128, 128, 128],
+    95: [20, 25, 36, 40, 45, 50, 60, 60, 72, 75, 80, 90, 96, 100, 108, 120, 120, 120, 128, 135, 144,
+         144, 160, 160, 160, 160, 160, 180, 180, 180, 180, 180, 192, 192, 192, 192, 192, 192, 192,
+         192, 192, 192, 192, 192, 192, 192, 192, 192],
+    159: [18, 25, 36, 40, 45, 54, 60, 64, 72, 72, 80, 90, 96, 100, 108, 120, 120, 128, 135, 144, 144,
+          150, 160, 160, 180, 180, 180, 192, 192, 200, 200, 216, 216, 216, 225, 225, 240, 240, 240,
+          256, 256, 256, 256, 288, 288, 288, 288, 288, 288, 288, 288, 288, 300, 300, 300, 300, 320,
+          320, 320, 320, 320, 320, 320, 320, 320, 320, 320, 320, 320, 320, 320, 320, 320, 320, 320,
+          320, 320, 320, 320, 320]
+}
+
+# maximum length of the lines of the griddes values, as CDO
+GRIDDES_WIDTH = 80
+
+
+@functools.lru_cache(maxsize=None)
+def gaussian_quadrature(nlat_half, tol=1e-15, maxiter=100):
+    """
+    Gaussian quadrature nodes and weights, roots of the Legendre polynomial of degree 2*nlat_half
+
+    Returns:
+        Sine of the latitudes, from north to south, and the weights (summing to 2)
+    """
+
+    nlat = 2 * nlat_half
+    # first guess of the roots of the northern hemisphere, all refined together
+    mu = np.cos(np.pi * (np.arange(1, nlat_half + 1) - 0.25) / (nlat + 0.5))
+    for _ in range(maxiter):
+        p_prev, p_curr = np.ones_like(mu), mu
+        for n in range(2, nlat + 1):
+            p_prev, p_curr = p_curr, ((2 * n - 1) * mu * p_curr - (n - 1) * p_prev) / n
+        deriv = nlat * (p_prev - mu * p_curr) / (1 - mu**2)
+        step = p_curr / deriv
+        mu = mu - step
+        if np.abs(step).max() < tol:
+            break
+
+    weights = 2 / ((1 - mu**2) * deriv**2)
+    mu, weights = np.concatenate([mu, -mu[::-1]]), np.concatenate([weights, weights[::-1]])
+    # cached arrays are shared between callers
+    for arr in [mu, weights]:
+        arr.flags.writeable = False
+
+    return mu, weights
+
+
+def gaussian_latitudes(nlat_half):
+    """Gaussian latitudes (degrees), from north to south"""
+
+    return np.rad2deg(np.arcsin(gaussian_quadrature(nlat_half)[0]))
+
+
+@functools.lru_cache(maxsize=None)
+def _reduced_points(kind, spectral):
+    """Memoized worker of reduced_points"""
+
+    nlat_half = spectral2gaussian(spectral, kind)
+    if kind == 'CO':
+        north = 4 * np.arange(1, nlat_half + 1) + 16
+    elif kind == 'L':
+        if spectral not in TL_REDUCED_POINTS:
+            raise ValueError(f"Reduced points of TL{spectral} unknown: available are {list(TL_REDUCED_POINTS)}")
+        north = np.array(TL_REDUCED_POINTS[spectral])
+    else:
+        raise ValueError("Unknown grid type")
+
+    points = np.concatenate([north, north[::-1]])
+    points.flags.writeable = False
+
+    return points
+
+
+def reduced_points(kind, spectral):
+    """Number of points of each row of the reduced grid, from north to south"""
+
+    return _reduced_points(kind.upper(), int(spectral))
+
+
+def _autobreak(prefix, values, fmt):
+    """Values after a prefix, wrapped as in the CDO griddes output"""
+
+    text = prefix
+    width = len(prefix)
+    for value in values:
+        if width > GRIDDES_WIDTH:
+            text += '\n' + ' ' * len(prefix)
+            width = len(prefix)
+        item = fmt % value + ' '
+        text += item
+        width += len(item)
+
+    return text + '\n'
+
+
+def griddes(grid):
+    """
+    CDO griddes text of a reduced Gaussian grid, e.g. 'TCO95' or 'TL63L31'
+
+    Returns:
+        The grid description, as written by cdo griddes
+    """
+
+    info = extract_grid_info(grid) or extract_grid_info(grid + 'L1')
+    if info is None:
+        raise ValueError(f"Unknown grid {grid}")
+    kind, spectral, _ = info
+    nlat_half = spectral2gaussian(spectral, kind)
+    points = reduced_points(kind, spectral)
+
+    text = '#\n# gridID 1\n#\n'
+    for key, value in [('gridtype', 'gaussian_reduced'), ('gridsize', points.sum()), ('xsize', 2),
+                       ('ysize', 2 * nlat_half), ('xname', 'lon'), ('xlongname', '"longitude"'),
+                       ('xunits', '"degrees_east"'), ('yname', 'lat'), ('ylongname', '"latitude"'),
+                       ('yunits', '"degrees_north"'), ('numLPE', nlat_half)]:
+        text += f'{key:<10}= {value}\n'
+    # the last longitude is truncated to the micro-degrees of the GRIB2 encoding
+    text += _autobreak(f'{"xvals":<10}= ', [0, np.floor((360 - 360 / points.max()) * 1e6) / 1e6], '%.15g')
+    text += _autobreak(f'{"yvals":<10}= ', gaussian_latitudes(nlat_half), '%.15g')
+    text += _autobreak('reducedPoints = ', points, '%d')
+
+    return text
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Message index of GRIB files (ICMSH, ICMGG, ICMCL, ...), to select and concatenate
+messages without rescanning and decoding the files.
+
+A file is scanned once, reading only the message headers, and the offset, length,
+shortName, level and edition of each message are stored in a sidecar index (in the
+cache directory, invalidated when the file size or modification time change).
+Selected messages are then copied directly from the memory-mapped file, so that
+extracting variables costs only the selected bytes and merges are indexed writes.
+"""
+
+import os
+import json
+import mmap
+import hashlib
+import tempfile
+import argparse
+import eccodes
+
+# default location of the sidecar indices
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'epochal', 'gribindex')
+
+
+class GribIndex:
+    """ The list of messages of a GRIB file, with their position and identification. """
+
+    FIELDS = ('offset', 'length', 'shortName', 'level', 'edition')
+
+    def __init__(self, filename, records):
+        self.filename = filename
+        self.records = records
+
+    @classmethod
+    def build(cls, filename):
+        """Scan the headers of the messages of a GRIB file"""
+
+        records = []
+        with open(filename, 'rb') as fff:
+            while True:
+                gid = eccodes.codes_grib_new_from_file(fff, headers_only=True)
+                if gid is None:
+                    break
+                records.append({'offset': eccodes.codes_get(gid, 'offset', int),
+                                'length': eccodes.codes_get(gid, 'totalLength', int),
+                                'shortName': eccodes.codes_get(gid, 'shortName'),
+                                'level': eccodes.codes_get(gid, 'level', int),
+                                'edition': eccodes.codes_get(gid, 'edition', int)})
+                eccodes.codes_release(gid)
+
+        return cls(filename, records)
+
+    @staticmethod
+    def sidecar(filename, cachedir=CACHE_DIR):
+        """Path of the sidecar index of a file"""
+
+        name = hashlib.blake2b(os.path.abspath(filename).encode(), digest_size=16).hexdigest()
+        return os.path.join(cachedir, f'{name}.json')
+
+    @classmethod
+    def open(cls, filename, cachedir=CACHE_DIR):
+        """Index of a file from its sidecar, built and stored if missing or outdated"""
+
+        stat = os.stat(filename)
+        sidecar = cls.sidecar(filename, cachedir)
+        if os.path.exists(sidecar):
+            with open(sidecar, 'r', encoding='utf-8') as fff:
+                saved = json.load(fff)
+            if saved['size'] == stat.st_size and saved['mtime'] == stat.st_mtime_ns:
+                return cls(filename, [dict(zip(cls.FIELDS, record)) for record in saved['records']])
+
+        index = cls.build(filename)
+        os.makedirs(cachedir, exist_ok=True)
+        # unique temporary name, the same file may be indexed by concurrent jobs
+        fd, tmpfile = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as fff:
+            json.dump({'filename': os.path.abspath(filename), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                       'records': [[record[field] for field in cls.FIELDS] for record in index.records]}, fff)
+        os.replace(tmpfile, sidecar)
+
+        return index
+
+    def select(self, names=None, levels=None):
+        """Records of the messages of the given variables and levels (all if None), in file order"""
+
+        return [record for record in self.records
+                if (names is None or record['shortName'] in names) and (levels is None or record['level'] in levels)]
+
+    def write(self, out, records=None):
+        """Copy the messages of the records (all if None) from the memory-mapped file to an open binary file"""
+
+        records = self.records if records is None else records
+        if not records:
+            return
+        with open(self.filename, 'rb') as fff, mmap.mmap(fff.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for record in records:
+                    out.write(view[record['offset']:record['offset'] + record['length']])
+            finally:
+                view.release()
+
+
+def write_messages(output, sources, cachedir=CACHE_DIR):
+    """
+    Write the selected messages of several GRIB files, in order, to a single output file
+
+    Args:
+        sources: list of (filename, names) pairs, all the messages of the file if names is None
+    """
+
+    indices = [(GribIndex.open(filename, cachedir), names) for filename, names in sources]
+    with open(output, 'wb') as out:
+        for index, names in indices:
+            index.write(out, index.select(names))
+
+
+def get_args():
+    """Command line parser for the GRIB message extraction"""
+
+    parser = argparse.ArgumentParser(description="Extract variables from GRIB files through a message index.")
+    parser.add_argument("inputs", type=str, nargs='+', help="GRIB files")
+    parser.add_argument("output", type=str, help="GRIB file with the selected messages")
+    parser.add_argument("--names", type=str, nargs='+', default=None, help="variables to extract, all if not given")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    write_messages(args.output, [(filename, args.names) for filename in args.inputs])
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Content-addressed cache of the intermediate products of the OIFS pipelines.
+
+An entry is keyed by the operator chain of a step and by its inputs: external
+files are hashed (memoized on size and modification time, so that large inputs
+are read once), while files produced by another cached step are identified by
+the key of that step, so intermediates are never re-read for hashing. Entries are
+stored in the cache directory (e.g. under TMPDIR) and evicted least recently used
+first when the total size exceeds the quota. The index is protected by a file lock,
+so that concurrent jobs can share the same cache, and an entry being computed or
+copied out is reserved, so that other jobs wait for it instead of computing it
+again and eviction leaves it alone.
+"""
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# default disk quota of the cache (bytes)
+QUOTA = 50 * 1024**3
+
+# bytes read at once when hashing files
+BLOCK = 16 * 1024**2
+
+
+class IntermediateCache:
+    """ A directory of step outputs, addressed by the hash of the operator chain and inputs. """
+
+    def __init__(self, cachedir, quota=QUOTA):
+        self.cachedir = cachedir
+        self.quota = quota
+        self.indexfile = os.path.join(cachedir, 'index.json')
+        self.hashfile = os.path.join(cachedir, 'hashes.json')
+        self._thread_lock = threading.Lock()
+        os.makedirs(cachedir, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive access to the index, between threads and processes"""
+
+        with self._thread_lock, open(os.path.join(self.cachedir, '.lock'), 'w', encoding='utf-8') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _read(path):
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as fff:
+                return json.load(fff)
+        return {}
+
+    @staticmethod
+    def _write(path, data):
+        with open(path + '.tmp', 'w', encoding='utf-8') as fff:
+            json.dump(data, fff, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def _lockfile(self, key):
+        """Path of the reserve lock of an entry"""
+
+        lockdir = os.path.join(self.cachedir, 'locks')
+        os.makedirs(lockdir, exist_ok=True)
+        return os.path.join(lockdir, key)
+
+    @contextmanager
+    def reserve(self, key):
+        """Exclusive access to an entry while it is looked up and, if missing, computed and stored"""
+
+        with open(self._lockfile(key), 'w', encoding='utf-8') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _reserved(self, key):
+        """Whether an entry is reserved, e.g. being copied out, by another job"""
+
+        with open(self._lockfile(key), 'w', encoding='utf-8') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return False
+
+    def file_hash(self, path):
+        """Content hash of a file, recomputed only if its size or modification time changed"""
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._locked():
+            known = self._read(self.hashfile).get(path)
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime_ns:
+            return known['hash']
+
+        hasher = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as fff:
+            for block in iter(lambda: fff.read(BLOCK), b''):
+                hasher.update(block)
+
+        with self._locked():
+            hashes = self._read(self.hashfile)
+            hashes[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': hasher.hexdigest()}
+            self._write(self.hashfile, hashes)
+
+        return hasher.hexdigest()
+
+    @staticmethod
+    def make_key(chain, inputs):
+        """Key of an entry from the operator chain and the identifiers of the inputs"""
+
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(chain.encode())
+        for ident in inputs:
+            hasher.update(b'|' + ident.encode())
+
+        return hasher.hexdigest()
+
+    def fetch(self, key, outputs):
+        """
+        Copy the cached files of an entry to the outputs, returning False if not cached.
+        To be called under reserve(key), which keeps the entry from being evicted during the copy.
+        """
+
+        entry = os.path.join(self.cachedir, key)
+        with self._locked():
+            index = self._read(self.indexfile)
+            if key not in index or not os.path.isdir(entry):
+                return False
+            index[key]['used'] = time.time()
+            self._write(self.indexfile, index)
+
+        # copies, so that later in-place edits of the outputs cannot alter the cache,
+        # made outside the index lock not to hold up the other jobs
+        for num, output in enumerate(outputs):
+            shutil.copyfile(os.path.join(entry, str(num)), output + '.tmp')
+            os.replace(output + '.tmp', output)
+
+        return True
+
+    def store(self, key, outputs):
+        """Store the outputs of a step, then evict the least recently used entries above quota"""
+
+        entry = os.path.join(self.cachedir, key)
+        tmpdir = f'{entry}.tmp-{os.getpid()}-{threading.get_ident()}'
+        os.makedirs(tmpdir, exist_ok=True)
+        for num, output in enumerate(outputs):
+            shutil.copyfile(output, os.path.join(tmpdir, str(num)))
+        size = sum(os.path.getsize(output) for output in outputs)
+
+        with self._locked():
+            index = self._read(self.indexfile)
+            if os.path.isdir(entry):
+                shutil.rmtree(tmpdir)
+            else:
+                os.rename(tmpdir, entry)
+            index[key] = {'size': size, 'used': time.time()}
+
+            total = sum(item['size'] for item in index.values())
+            for old in sorted(index, key=lambda name: index[name]['used']):
+                if total <= self.quota:
+                    break
+                if old == key or self._reserved(old):
+                    continue
+                shutil.rmtree(os.path.join(self.cachedir, old), ignore_errors=True)
+                total -= index.pop(old)['size']
+            self._write(self.indexfile, index)
+
+    def usage(self):
+        """Number of entries and total size (bytes) of the cache"""
+
+        with self._locked():
+            index = self._read(self.indexfile)
+        return len(index), sum(item['size'] for item in index.values())
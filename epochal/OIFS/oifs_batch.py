@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Batch driver of the OIFS IC/BC generator, for many target resolutions and start dates.
+
+The jobs (a matrix of targets x start dates, or explicit TARGET:STARTDATE pairs)
+run on a process pool, each in its own temporary directory. All the jobs share the
+cache of intermediate products: the inputs common to several jobs (e.g. the
+truncation of the source ICs of a start date) are computed once, while the other
+jobs wait for them and copy the result. Final files common to several jobs (e.g. the
+climate BCs of a target) are produced by the first of them only, so that jobs never
+write the same file, with or without the cache. If that job fails, the jobs relying
+on its shared files are reported as failed too.
+A summary of the timings of each job is printed at the end.
+"""
+
+import os
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from oifs_generator import build_steps, generate, startdate, source_grid, BASE_TGT, TMPDIR, CACHE_DIR
+from intermediate_cache import QUOTA
+
+
+def make_jobs(targets, startdates):
+    """
+    Jobs of the batch: targets may be grids (combined with all the start dates)
+    or TARGET:STARTDATE pairs
+
+    Returns:
+        A list of unique (target, startdate) pairs, in the given order
+    """
+
+    jobs = []
+    for target in targets:
+        if ':' in target:
+            jobs.append(tuple(target.split(':', 1)))
+        else:
+            jobs += itertools.product([target], startdates)
+
+    return list(dict.fromkeys(jobs))
+
+
+def job_tmpdir(tmpdir, target, date):
+    """Temporary directory of a job"""
+
+    return os.path.join(tmpdir, f'{target}_{date}')
+
+
+def shared_outputs(jobs, source, base_tgt, tmpdir):
+    """
+    Final files written by several jobs, e.g. the climate BCs of a target
+
+    Returns:
+        For each job, the files it must not write since an earlier job writes them,
+        with the (target, startdate) of that job
+    """
+
+    owner = {}
+    skip = {}
+    for target, date in jobs:
+        jobdir = job_tmpdir(tmpdir, target, date)
+        steps = build_steps(target, date, source, base_tgt, jobdir)[0]
+        outputs = [path for step in steps for path in step.outputs if os.path.dirname(path) != jobdir]
+        skip[(target, date)] = {path: owner[path] for path in outputs
+                                if owner.setdefault(path, (target, date)) != (target, date)}
+
+    return skip
+
+
+def run_job(target, date, source, base_tgt, tmpdir, nproc, cachedir, quota, clean, skip=None):
+    """Run a single job in its own temporary directory, reporting failures instead of raising"""
+
+    start = time.perf_counter()
+    result = {'target': target, 'startdate': date, 'error': None, 'steps': {}}
+    try:
+        result['steps'] = generate(target, startdate=date, source_grid=source, base_tgt=base_tgt,
+                                   tmpdir=job_tmpdir(tmpdir, target, date), nproc=nproc,
+                                   clean=clean, cachedir=cachedir, quota=quota, skip=skip)
+    except Exception as err:
+        result['error'] = f'{type(err).__name__}: {err}'
+    result['seconds'] = time.perf_counter() - start
+
+    return result
+
+
+def run_batch(jobs, source=source_grid, base_tgt=BASE_TGT, tmpdir=TMPDIR, njobs=4, nproc=2,
+              cachedir=CACHE_DIR, quota=QUOTA, clean=False):
+    """
+    Run the jobs on a pool of njobs processes, each running up to nproc steps at the same time
+
+    Returns:
+        The list of job results (target, startdate, error, seconds and step timings)
+    """
+
+    skip = shared_outputs(jobs, source, base_tgt, tmpdir)
+    results = []
+    with ProcessPoolExecutor(max_workers=njobs) as pool:
+        futures = [pool.submit(run_job, target, date, source, base_tgt, tmpdir, nproc, cachedir, quota, clean,
+                               skip[(target, date)])
+                   for target, date in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            status = 'failed' if result['error'] else 'done'
+            print(f"Job {result['target']} {result['startdate']} {status} in {result['seconds']:.1f}s")
+            results.append(result)
+
+    # the shared files of a failed job were not necessarily written
+    failed = {(res['target'], res['startdate']) for res in results if res['error']}
+    for res in results:
+        lost = [(path, job) for path, job in skip[(res['target'], res['startdate'])].items() if job in failed]
+        if lost and not res['error']:
+            path, job = lost[0]
+            res['error'] = f'shared output {os.path.basename(path)} not written: job {job[0]} {job[1]} failed'
+            print(f"Job {res['target']} {res['startdate']} failed: {res['error']}")
+
+    order = {job: num for num, job in enumerate(jobs)}
+    return sorted(results, key=lambda res: order[(res['target'], res['startdate'])])
+
+
+def summary(results):
+    """Table of the timings of the jobs, with their slowest step"""
+
+    lines = [f"{'target':<12} {'startdate':<10} {'status':<7} {'seconds':>9}  slowest step"]
+    for res in results:
+        slowest = max(res['steps'], key=res['steps'].get, default=None)
+        detail = res['error'] if res['error'] else (f"{slowest} ({res['steps'][slowest]:.1f}s)" if slowest else '-')
+        lines.append(f"{res['target']:<12} {res['startdate']:<10} {'failed' if res['error'] else 'done':<7} "
+                     f"{res['seconds']:>9.1f}  {detail}")
+    failed = sum(1 for res in results if res['error'])
+    lines.append(f"{len(results) - failed} of {len(results)} jobs done, "
+                 f"{sum(res['seconds'] for res in results):.1f}s of total job time")
+
+    return '\n'.join(lines)
+
+
+def get_args():
+    """Command line parser for the batch driver"""
+
+    parser = argparse.ArgumentParser(description="Generate OIFS ICs and BCs for many targets and start dates.")
+    parser.add_argument("--targets", type=str, nargs='+', required=True,
+                        help="target grids (e.g. TL63L31 TCO95L91) or TARGET:STARTDATE pairs")
+    parser.add_argument("--startdates", type=str, nargs='+', default=[startdate],
+                        help="start dates combined with each target grid")
+    parser.add_argument("--source", type=str, default=source_grid, help="source grid of the ICs")
+    parser.add_argument("--njobs", type=int, default=4, help="number of concurrent jobs")
+    parser.add_argument("--nproc", type=int, default=2, help="number of concurrent steps in each job")
+    parser.add_argument("--cachedir", type=str, default=CACHE_DIR, help="cache of the intermediate products")
+    parser.add_argument("--quota", type=float, default=QUOTA / 1024**3, help="disk quota of the cache (GB)")
+    parser.add_argument("--clean", action="store_true", help="remove the temporary files of each job")
+    parser.add_argument("--summary", type=str, default=None, help="write the job results to this JSON file")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    batch = make_jobs(args.targets, args.startdates)
+    print(f"Running {len(batch)} jobs")
+    res_list = run_batch(batch, source=args.source, njobs=args.njobs, nproc=args.nproc, cachedir=args.cachedir,
+                         quota=int(args.quota * 1024**3), clean=args.clean)
+    print(summary(res_list))
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as fff:
+            json.dump(res_list, fff, indent=1)
@@ -3,21 +3,33 @@
 
 """
 This is a command line tool to OIFS ICs and BCs from default available ones.
-It can produce data from using CDO and GRIB_API. 
-It uses cdo bindings for python in a rough way to allow for exploration of temporary files.
+It can produce data using GRIB_API (ecCodes) and NumPy, with no CDO calls.
 
+The procedure is a pipeline of steps declaring their input and output files:
+independent branches (spectral truncation, gridpoint remaps, boundary conditions)
+run concurrently and a failed run resumes from the last completed step.
+GRIB messages are extracted and merged through a message index, to limit the temporary
+files written on scratch.
+Intermediate products are kept in a content-addressed cache under TMPDIR, so that
+repeated runs and runs for other targets or dates reuse the common steps.
 
 Authors
 Paolo Davini (CNR-ISAC, Apr 2024)
 """
 
-import subprocess
 import os
+import subprocess
 import shutil
-import cdo
-from utils import extract_grid_info, ecmwf_grid
-cdo = cdo.Cdo()
-cdo.debug = True
+import argparse
+from utils import extract_grid_info, ecmwf_grid, spectral2gaussian
+from gaussian import reduced_points
+from vertical import remap_grib
+from spectral import truncate_grib, sh_to_grid_grib, grid_to_sh_grib
+from grib_index import write_messages
+from point_index import remap_nn_grib
+from bc_builder import Climatology
+from pipeline import Step, Pipeline
+from intermediate_cache import IntermediateCache, QUOTA
 
 # configurable
 target_grid = 'TL63L31'
@@ -44,130 +56,197 @@ GRIDS = '/home/ccpd/perm/ecearth4/oifs-grids'
 # temporart directory
 TMPDIR = '/ec/res4/scratch/ccpd/tmpic'
 
+# cache of the intermediate products, shared by all the runs
+CACHE_DIR = os.path.join(TMPDIR, 'cache')
+
+# grid descriptions and vertical levels shipped with the tools
+GRIDS_TXT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grids')
+
+# BC variables merged in the climate file
+BC_VARIABLES = ["alb", "aluvp", "aluvd", "alnip", "alnid", "lail", "laih"]
+
+# year of the time axis of the climate file
+BC_YEAR = 2021
+
 #-----------------------#
-IC_TGT = os.path.join(BASE_TGT, target_grid, startdate)
-BC_TGT = os.path.join(BASE_TGT, target_grid, 'climate')
-
-for d in [IC_TGT, BC_TGT, TMPDIR]:
-    os.makedirs(d, exist_ok=True)
-
-# target grid info
-grid_type, spectral, vertical = extract_grid_info(target_grid)
-ecmwf_name = str(spectral) + ecmwf_grid(grid_type)
-target_spectral = 'T' + grid_type + str(spectral)
-
-# source grid info
-ic_grid_type, ic_spectral, ic_vertical = extract_grid_info(source_grid)
-source_spectral = 'T' + ic_grid_type + str(ic_spectral)
-
-if ic_vertical != vertical:
-    print("Vertical interpolation is necessary")
-    DO_VERTICAL = True
-else:
-    DO_VERTICAL = False
-
-
-# INITIAL CONDITIONS
-print("Truncating spectral file ICMSHECE4INIT to", spectral, "harmonics")
-# This is done with a clean spectral truncation with cdo.
-# Orography is therefore realiable.
-# The file has to be split in two since orography is GRIB1 and the rest is GRIB2
-OIFS_IC = os.path.join(OIFS_BASE, source_grid, startdate)
-grib2file = cdo.sp2sp(spectral, input=f"-selname,lnsp,vo,t,d {OIFS_IC}/ICMSHECE4INIT")
-gribtemp = cdo.selname("z", input=f"{OIFS_IC}/ICMSHECE4INIT", options="--eccodes")
-grib1file = cdo.sp2sp(spectral, input=gribtemp, options="--eccodes")
-subprocess.call(f"cat {grib2file} {grib1file} > {TMPDIR}/ICMSHECE4INIT", shell=True)
-
-#old version for all GRB2 data
-#cdo.sp2sp(spectral, option="--eccodes", input=f"{OIFS_IC}/ICMSHECE4INIT",output=f"{TMPDIR}/ICMSHECE4INIT")
-
-
-print ("Remapping ICMGG gaussian ICs to", target_grid)
-
-for file in ["ICMGGECE4INIT", "ICMGGECE4INIUA"]:
-    # This is done with remapcon using the grid fils computed with oifs_create_corner.py
-    #icmtmp = cdo.remapcon(f"{GRIDS}/{target_spectral}_grid.nc",
-    #             input=f"-setgrid,{GRIDS}/{source_spectral}_grid.nc {OIFS_IC}/{file}")
-    #cdo.setgrid(f"grids/{target_spectral}.txt", input=icmtmp, output=f"{TMPDIR}/{file}"
-    # this is the old version with remapnn
-    cdo.remapnn(f"grids/{target_spectral}.txt", input=f"{OIFS_IC}/{file}", output=f"{TMPDIR}/{file}")
-    
-# BOUNDARY CONDITIONS
-# This is done with a mergetime of the 7 variables in the ECMWF directory based on a magic command by Klaus Wyser
-print("Building BCs from", ecmwf_name, "data")
-variables = ["alb", "aluvp", "aluvd", "alnip", "alnid", "lail", "laih"]
-paths = [f"{OIFS_BC}/{ecmwf_name}/month_{var}" for var in variables]
-
-cdo.mergetime(options="-L", input=paths, output=f"{TMPDIR}/temp.grb")
-cdo.settaxis("2021-01-15,00:00:00,1month",
-             input=f"{TMPDIR}/temp.grb",
-             output=f"{BC_TGT}/ICMCLECE4-1990")
-
-os.remove(f"{TMPDIR}/temp.grb")
-
-# move the files to the target directory
-if not DO_VERTICAL:
-    print("Copying files to the target directory")
-    for file in ["ICMSHECE4INIT", "ICMGGECE4INIT", "ICMGGECE4INIUA"]:
-        shutil.move(f"{TMPDIR}/{file}", f"{IC_TGT}/{file}")
-
-# Procedure for vertical interpolation requires all the data to be in grid point space.
-# This is done by converting the spectral fields to gaussian grids and then moving back them to the spectral space 
-# It has been decided to interpolate spectral data (T, D, V) and keep gaussian data (Q, etc.) on the gaussian reduced grid
-# Orography and surface pressure are not touched and attached to the files at the end of the operations
-# A-B coefficients for remapeta are downloaded from ECMWF website and then converted to txt file 
-# in CDO-compliant style with convert_aka_bika.py script. These are stored in the grids folder. 
-# To set gaussian reduced grids the grid files are produced with descriptor_generator.py and
-# also stored in txt file in the grids folder
-else:
-    print("Vertical interpolation is necessary")
-    print("Select z and lnsp from ICMSHECE4INIT...")
-    VERTVALUES = (int(vertical) + 1) * 2
-    cdo.selname("z", input=f"{TMPDIR}/ICMSHECE4INIT", output=f"{TMPDIR}/orog.grb")
-    cdo.selname("lnsp", input=f"{TMPDIR}/ICMSHECE4INIT", output=f"{TMPDIR}/lnsp.grb")
-    # this is a tricky modification to avoid that CDO mess up with the final output
-    subprocess.call(f"grib_set -s numberOfVerticalCoordinateValues={VERTVALUES} {TMPDIR}/lnsp.grb {TMPDIR}/lnsp2.grb", shell=True)
-
-    # Remapeta works only on grid point space so we need to interpolate the spectral fields to gaussian
-    print("Converting ICMSHECE4INIT to gaussian grid")
-    cdo.sp2gpl(input=f"{TMPDIR}/ICMSHECE4INIT", output=f"{TMPDIR}/sp2gauss.grb")
-
-    # We then bring them on the same gaussian reduced grid
-    print("Remapping spectral fields from gaussian to gaussian reduced")
-    remapped = cdo.remapcon(f"{GRIDS}/{target_spectral}_grid.nc", input=f"{TMPDIR}/sp2gauss.grb")
-    cdo.setgrid(f"grids/{target_spectral}.txt", input=remapped, output=f"{TMPDIR}/sp2gauss_reduced.grb")
-
-    # Merge files to prepare for interpolation
-    print("Merging files")
-    subprocess.call(f"cat {TMPDIR}/ICMGGECE4INIUA {TMPDIR}/sp2gauss_reduced.grb > {TMPDIR}/single.grb", shell=True)
-
-    # Hybrid levels interpolation
-    print("Remapping vertical on hybrid levels")
-    gridfile = f"grids/L{vertical}.txt"
-    cdo.remapeta(gridfile, input=f"{TMPDIR}/single.grb", output=f"{TMPDIR}/remapped.grb")
-
-    # create INITUA file
-    print("Selecting fields to create ICMSHECE4INIUA and setting gaussian reduced grid")
-    cdo.setgrid(f"grids/{target_spectral}.txt", input=f"-selname,q,o3,crwc,cswc,clwc,ciwc,cc {TMPDIR}/remapped.grb", output=f"{IC_TGT}/ICMGGECE4INIUA")
-
-    # Nring new field to spectral space
-    print("Converting back to spectral (through gaussian regular) the spectral fields")
-    cdo.gp2spl(input=f"-setgridtype,regular -selname,t,vo,d {TMPDIR}/remapped.grb", output=f"{TMPDIR}/spback.grb")
-
-    # Merge with orography and lnsp and get the SH file
-    print("Merging files and creating the final ICMSHECE4INIT")
-    subprocess.call(f"cat {TMPDIR}/spback.grb {TMPDIR}/lnsp2.grb  {TMPDIR}/orog.grb > {IC_TGT}/ICMSHECE4INIT", shell=True)
-
-    shutil.move(f"{TMPDIR}/ICMGGECE4INIT", f"{IC_TGT}/ICMGGECE4INIT")
-
-    if do_clean:
+
+
+def build_steps(target_grid, startdate, source_grid, base_tgt, tmpdir):
+    """
+    Define the steps producing the ICs and BCs of a target grid
+
+    Returns:
+        The list of steps, the IC and BC target directories
+    """
+
+    ic_tgt = os.path.join(base_tgt, target_grid, startdate)
+    bc_tgt = os.path.join(base_tgt, target_grid, 'climate')
+
+    # target grid info
+    grid_type, spectral, vertical = extract_grid_info(target_grid)
+    ecmwf_name = str(spectral) + ecmwf_grid(grid_type)
+    target_spectral = 'T' + grid_type + str(spectral)
+
+    # source grid info
+    ic_grid_type, ic_spectral, ic_vertical = extract_grid_info(source_grid)
+    source_spectral = 'T' + ic_grid_type + str(ic_spectral)
+
+    oifs_ic = os.path.join(OIFS_BASE, source_grid, startdate)
+
+    def tmp(name):
+        return os.path.join(tmpdir, name)
+
+    steps = []
+
+    # INITIAL CONDITIONS
+    # This is done with a clean spectral truncation, as an index remap of the coefficients.
+    # Orography is therefore realiable.
+    # Orography is GRIB1 and the rest is GRIB2, but ecCodes truncates both in the same pass
+    sh_names = ["lnsp", "vo", "t", "d", "z"]
+    steps.append(Step('sh_truncate',
+                      lambda: truncate_grib(f"{oifs_ic}/ICMSHECE4INIT", tmp('ICMSHECE4INIT'), spectral, names=sh_names),
+                      [f"{oifs_ic}/ICMSHECE4INIT"], [tmp('ICMSHECE4INIT')],
+                      key=f"spectral.truncate_grib {spectral} {','.join(sh_names)}"))
+
+    for file in ["ICMGGECE4INIT", "ICMGGECE4INIUA"]:
+        # This is done with remapcon using the grid fils computed with oifs_create_corner.py
+        #icmtmp = cdo.remapcon(f"{GRIDS}/{target_spectral}_grid.nc",
+        #             input=f"-setgrid,{GRIDS}/{source_spectral}_grid.nc {OIFS_IC}/{file}")
+        #cdo.setgrid(f"grids/{target_spectral}.txt", input=icmtmp, output=f"{TMPDIR}/{file}"
+        # this is the old version with remapnn, now on the GRIB messages with the cached index of the source grid
+        steps.append(Step(f'gg_remap_{file}',
+                          lambda file=file: remap_nn_grib(f"{oifs_ic}/{file}", tmp(file),
+                                                          spectral2gaussian(spectral, grid_type),
+                                                          reduced_points(grid_type, spectral)),
+                          [f"{oifs_ic}/{file}"], [tmp(file)], key=f"point_index.remap_nn_grib {target_spectral}"))
+
+    # BOUNDARY CONDITIONS
+    # This is done merging in time the 7 variables in the ECMWF directory based on a magic command by Klaus Wyser
+    # (cdo mergetime and settaxis,2021-01-15,00:00:00,1month), patching the dates of the memory-mapped messages.
+    # Per-year files for transient runs can be produced with bc_builder.py
+    paths = [f"{OIFS_BC}/{ecmwf_name}/month_{var}" for var in BC_VARIABLES]
+
+    def write_climate():
+        with Climatology(paths) as clim:
+            clim.write_year(BC_YEAR, f"{bc_tgt}/ICMCLECE4-1990")
+
+    steps.append(Step('bc_climate', write_climate, paths, [f"{bc_tgt}/ICMCLECE4-1990"],
+                      key=f"bc_builder.write_year {BC_YEAR}"))
+
+    # move the files to the target directory
+    if ic_vertical == vertical:
+        for file in ["ICMSHECE4INIT", "ICMGGECE4INIT", "ICMGGECE4INIUA"]:
+            steps.append(Step(f'move_{file}', lambda file=file: shutil.move(tmp(file), f"{ic_tgt}/{file}"),
+                              [tmp(file)], [f"{ic_tgt}/{file}"]))
+        return steps, ic_tgt, bc_tgt
+
+    # Procedure for vertical interpolation requires all the data to be in grid point space.
+    # This is done by converting the spectral fields to gaussian grids and then moving back them to the spectral space
+    # It has been decided to interpolate spectral data (T, D, V) and keep gaussian data (Q, etc.) on the gaussian reduced grid
+    # Orography and surface pressure are not touched and attached to the files at the end of the operations
+    # A-B coefficients for the vertical remap are downloaded from ECMWF website and then converted to txt file
+    # in CDO-compliant style with convert_aka_bika.py script. These are stored in the grids folder.
+    # The spectral transforms go directly to and from the target gaussian reduced grid, computed by gaussian.py
+    vertvalues = (int(vertical) + 1) * 2
+    vct = os.path.join(GRIDS_TXT, f"L{vertical}.txt")
+    gp_names = ["lnsp", "t", "vo", "d"]
+    ua_names = ["q", "o3", "crwc", "cswc", "clwc", "ciwc", "cc"]
+    steps += [
+        # orography is copied directly at the end, lnsp is extracted through the message index
+        Step('vert_lnsp', lambda: write_messages(tmp('lnsp.grb'), [(tmp('ICMSHECE4INIT'), ['lnsp'])]),
+             [tmp('ICMSHECE4INIT')], [tmp('lnsp.grb')], key="grib_index lnsp"),
+        # this is a tricky modification to avoid that CDO mess up with the final output
+        Step('vert_lnsp_coords',
+             lambda: subprocess.run(["grib_set", "-s", f"numberOfVerticalCoordinateValues={vertvalues}",
+                                     tmp('lnsp.grb'), tmp('lnsp2.grb')], check=True),
+             [tmp('lnsp.grb')], [tmp('lnsp2.grb')], key=f"grib_set -s numberOfVerticalCoordinateValues={vertvalues}"),
+        # The vertical remap works on grid point space so we need to transform the spectral fields
+        # to the gaussian reduced grid, all the levels of a variable at once
+        Step('vert_sp2gauss',
+             lambda: sh_to_grid_grib(tmp('ICMSHECE4INIT'), tmp('sp2gauss_reduced.grb'),
+                                     spectral2gaussian(spectral, grid_type), reduced_points(grid_type, spectral),
+                                     names=gp_names),
+             [tmp('ICMSHECE4INIT')], [tmp('sp2gauss_reduced.grb')],
+             key=f"spectral.sh_to_grid_grib {target_spectral} {','.join(gp_names)}"),
+        # Hybrid levels interpolation of all the fields, in log-pressure and in a single pass on the GRIB messages
+        Step('vert_remap',
+             lambda: remap_grib([tmp('ICMGGECE4INIUA'), tmp('sp2gauss_reduced.grb')], tmp('remapped.grb'), vct),
+             [tmp('ICMGGECE4INIUA'), tmp('sp2gauss_reduced.grb'), vct], [tmp('remapped.grb')],
+             key="vertical.remap_grib"),
+        # create INITUA file: the remap keeps the grid of the messages, so the variables are extracted through the index
+        Step('vert_iniua',
+             lambda: write_messages(f"{ic_tgt}/ICMGGECE4INIUA", [(tmp('remapped.grb'), ua_names)]),
+             [tmp('remapped.grb')], [f"{ic_tgt}/ICMGGECE4INIUA"], key=f"grib_index {','.join(ua_names)}"),
+        # Bring new field to spectral space, directly from the reduced grid
+        Step('vert_spback',
+             lambda: grid_to_sh_grib(tmp('remapped.grb'), tmp('spback.grb'), spectral, names=["t", "vo", "d"]),
+             [tmp('remapped.grb')], [tmp('spback.grb')], key=f"spectral.grid_to_sh_grib {spectral} t,vo,d"),
+        # Merge with orography and lnsp and get the SH file
+        Step('vert_sh_merge',
+             lambda: write_messages(f"{ic_tgt}/ICMSHECE4INIT",
+                                    [(tmp('spback.grb'), None), (tmp('lnsp2.grb'), None), (tmp('ICMSHECE4INIT'), ['z'])]),
+             [tmp('spback.grb'), tmp('lnsp2.grb'), tmp('ICMSHECE4INIT')], [f"{ic_tgt}/ICMSHECE4INIT"],
+             key="grib_index all,all,z"),
+        Step('move_ICMGGECE4INIT',
+             lambda: shutil.move(tmp('ICMGGECE4INIT'), f"{ic_tgt}/ICMGGECE4INIT"),
+             [tmp('ICMGGECE4INIT')], [f"{ic_tgt}/ICMGGECE4INIT"])
+    ]
+
+    return steps, ic_tgt, bc_tgt
+
+
+def generate(target_grid, startdate=startdate, source_grid=source_grid, base_tgt=BASE_TGT,
+             tmpdir=TMPDIR, nproc=4, clean=do_clean, cachedir=CACHE_DIR, quota=QUOTA, skip=None):
+    """
+    Produce the ICs and BCs of a target grid, resuming a previous failed run if any.
+    Cached intermediate products are reused, unless cachedir is None.
+    The steps writing any of the skip files (e.g. produced by another run) are left out.
+
+    Returns:
+        A dictionary with the elapsed time (s) of each step run
+    """
+
+    steps, ic_tgt, bc_tgt = build_steps(target_grid, startdate, source_grid, base_tgt, tmpdir)
+    steps = [step for step in steps if not set(step.outputs) & set(skip or [])]
+    for d in [ic_tgt, bc_tgt, tmpdir]:
+        os.makedirs(d, exist_ok=True)
+
+    statefile = os.path.join(tmpdir, f'pipeline_{target_grid}_{startdate}.json')
+    cache = IntermediateCache(cachedir, quota=quota) if cachedir else None
+    timings = Pipeline(steps, statefile, cache=cache).run(nproc=nproc)
+
+    if clean:
         print("Cleaning up")
-        for file in ["gp2gauss.grb", "sp2gauss.grb", "sp2gauss_reduced.grb" "single.grb", "remapped.grb",
-                    "ICMSHECE4INIT", "ICMGGECE4INIUA",
-                    "remapped.grb", "spback.grb", "lnsp.grb", "lnsp2.grb", "orog.grb"]:
-            os.remove(file)
+        for step in steps:
+            for path in step.outputs:
+                if os.path.dirname(path) == tmpdir and os.path.exists(path):
+                    os.remove(path)
+        os.remove(statefile)
+        if not os.listdir(tmpdir):
+            os.rmdir(tmpdir)
+
+    print("Done")
+    return timings
+
+
+def get_args():
+    """Command line parser for the IC/BC generator"""
+
+    parser = argparse.ArgumentParser(description="Generate OIFS ICs and BCs for a target grid.")
+    parser.add_argument("--target", type=str, default=target_grid, help="target grid, e.g. TL63L31")
+    parser.add_argument("--startdate", type=str, default=startdate, help="start date of the ICs")
+    parser.add_argument("--source", type=str, default=source_grid, help="source grid of the ICs")
+    parser.add_argument("--nproc", type=int, default=4, help="number of concurrent steps")
+    parser.add_argument("--clean", action="store_true", default=do_clean, help="remove the temporary files")
+    parser.add_argument("--cachedir", type=str, default=CACHE_DIR, help="cache of the intermediate products")
+    parser.add_argument("--no-cache", action="store_true", help="do not use the cache of intermediate products")
+    parser.add_argument("--quota", type=float, default=QUOTA / 1024**3, help="disk quota of the cache (GB)")
+
+    return parser.parse_args()
+
 
-if do_clean:
-    os.rmdir(TMPDIR)
+if __name__ == "__main__":
 
-print("Done")
+    args = get_args()
+    generate(args.target, startdate=args.startdate, source_grid=args.source, nproc=args.nproc, clean=args.clean,
+             cachedir=None if args.no_cache else args.cachedir, quota=int(args.quota * 1024**3))
@@ -1,50 +1,182 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-"""Tool to modify OIFS ICs/BCs"""
-# INITIAL CONDITIONS
+"""
+Tool to modify OIFS ICs/BCs
+
+Modifications are declared as a list of per-variable operations, applied directly
+to the values of the GRIB messages with ecCodes in a single streaming pass, with no
+conversion to netCDF. Messages that are not modified are copied byte-for-byte.
+
+Each operation is a dictionary with the variable 'name' (GRIB shortName), the 'op' and
+optionally the 'levels' it applies to:
+    {'name': 'z', 'op': 'scale', 'value': 0.}      multiply by value
+    {'name': 'al', 'op': 'offset', 'value': 0.05}  add value
+    {'name': 'sd', 'op': 'set', 'value': 0.}       set to value
+    {'name': 'skt', 'op': 'replace', 'mask': 'lsm', 'threshold': 0.5, 'source': 'sst'}
+        where the mask field is above threshold (below, with 'below': True) take the
+        values of the source field, or of a constant if source is a number.
+        Mask and source are read from the same file, or from 'file' if given. A field
+        with a single message (e.g. lsm) applies to all levels, otherwise each level of
+        the target takes the mask and source of the same level.
+Spectral fields support scale, offset and set (the mean is the first coefficient).
+"""
+
 import os
 import shutil
-import xarray as xr
-import cdo
-cdo = cdo.Cdo()
-cdo.debug = True
+import tempfile
+import numpy as np
+import eccodes
+from grib_index import GribIndex
 
+OPERATIONS = ('scale', 'offset', 'set', 'replace')
 
 INDIR='/lus/h2resw01/hpcperm/ccpd/ECE4-DATA/oifs/TL63L31/19900101'
 OUTDIR='/lus/h2resw01/scratch/ccpd/OIFS-playground'
 
+# modifications of each IC file: flat orography and brighter surface
+MODIFICATIONS = {
+    'ICMSHECE4INIT': [{'name': 'z', 'op': 'scale', 'value': 0.}],
+    'ICMGGECE4INIT': [{'name': 'al', 'op': 'offset', 'value': 0.05}],
+    'ICMGGECE4INIUA': []
+}
+
+
+def _read_field(filename, name):
+    """Values of each level of a variable, decoding only its messages"""
+
+    index = GribIndex.open(filename)
+    records = index.select([name])
+    if not records:
+        raise KeyError(f"{name} not found in {filename}")
+    field = {}
+    with open(filename, 'rb') as fff:
+        for record in records:
+            fff.seek(record['offset'])
+            gid = eccodes.codes_new_from_message(fff.read(record['length']))
+            field[record['level']] = eccodes.codes_get_values(gid)
+            eccodes.codes_release(gid)
+
+    return field
+
+
+def _level(field, name, level):
+    """Values of a mask or source field matching the level of the target message"""
+
+    if len(field) == 1:
+        return next(iter(field.values()))
+    if level not in field:
+        raise KeyError(f"{name} has no level {level}: available are {sorted(field)}")
+
+    return field[level]
+
+
+def _check(operation):
+    """Validate an operation, failing early before any file is written"""
+
+    if operation.get('op') not in OPERATIONS:
+        raise ValueError(f"Unknown operation {operation.get('op')}: available are {OPERATIONS}")
+    if 'name' not in operation:
+        raise ValueError(f"Operation without variable name: {operation}")
+    if operation['op'] == 'replace' and not {'mask', 'source'} <= set(operation):
+        raise ValueError(f"replace needs a mask and a source: {operation}")
+    if operation['op'] != 'replace' and 'value' not in operation:
+        raise ValueError(f"{operation['op']} needs a value: {operation}")
+
+
+def _apply(values, operation, spectral, fields, level):
+    """New values of a message (at the given level) after an operation"""
+
+    kind, value = operation['op'], operation.get('value')
+    if spectral:
+        if kind == 'replace':
+            raise ValueError(f"replace is not supported on the spectral field {operation['name']}")
+        if kind == 'scale':
+            return values * value
+        # the mean of the field is the real part of the first coefficient
+        values = np.zeros_like(values) if kind == 'set' else values.copy()
+        values[0] += value
+        return values
+
+    if kind == 'scale':
+        return values * value
+    if kind == 'offset':
+        return values + value
+    if kind == 'set':
+        return np.full_like(values, value)
+
+    mask = _level(fields[operation['mask']], operation['mask'], level)
+    where = mask < operation.get('threshold', 0.5) if operation.get('below') else \
+        mask > operation.get('threshold', 0.5)
+    source = operation['source']
+    if isinstance(source, str):
+        source = _level(fields[source], source, level)
+    return np.where(where, source, values)
+
+
+def modify_grib(infile, outfile, operations):
+    """
+    Apply the operations to the messages of a GRIB file, in a single pass
+
+    Returns:
+        The number of modified messages
+    """
 
-OIFS_SPECTRAL = "ICMSHECE4INIT"
-print("ICMSHECE4INIT")
-cdo.sp2gpl(input=f"{INDIR}/{OIFS_SPECTRAL}", output=f"{OUTDIR}/grid_point.nc", options="-f nc4")
-#subprocess.call(["cdo", "-f", "nc4", "sp2gpl", f"{INDIR}/{OIFS_SPECTRAL}", f"{OUTDIR}/grid_point.nc"])
+    for operation in operations:
+        _check(operation)
 
-sh = xr.open_dataset(f"{OUTDIR}/grid_point.nc")
-print(sh)
-sh['z'] = sh['z'] * 0
-sh.to_netcdf(f"{OUTDIR}/grid_point_new.nc")
+    # mask and source fields are read beforehand, decoding only their messages
+    fields = {}
+    for operation in operations:
+        if operation['op'] == 'replace':
+            names = [operation['mask']] + ([operation['source']] if isinstance(operation['source'], str) else [])
+            for name in names:
+                fields.setdefault(name, _read_field(operation.get('file', infile), name))
 
-cdo.sp2gpl(input=f"{OUTDIR}/grid_point_new.nc", output=f"{OUTDIR}/grid_point_new.nc", options="-f nc4")
-#subprocess.call(["cdo", "-f", "grb2", "gp2spl", f"{OUTDIR}/grid_point_new.nc",
-#                 f"{OUTDIR}/{OIFS_SPECTRAL}"])
+    index = GribIndex.open(infile)
+    modified = 0
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)), suffix='.tmp')
+    try:
+        with open(infile, 'rb') as fin, os.fdopen(fd, 'wb') as fout:
+            for record in index.records:
+                todo = [operation for operation in operations if operation['name'] == record['shortName']
+                        and record['level'] in operation.get('levels', [record['level']])]
+                fin.seek(record['offset'])
+                message = fin.read(record['length'])
+                if not todo:
+                    fout.write(message)
+                    continue
 
-OIFS_INIT = "ICMGGECE4INIT"
-cdo.copy(input=f"{INDIR}/{OIFS_INIT}", output=f"{OUTDIR}/init.nc", options="-f nc4 --eccodes")
-#subprocess.call(["cdo", "--eccodes", "-f", "nc4", "copy", f"{INDIR}/{OIFS_INIT}",
-#                  f"{OUTDIR}/init.nc"])
-init = xr.open_dataset(f"{OUTDIR}/init.nc")
-print(init)
-init['al'] = init['al'] + 0.05
-init.to_netcdf(f"{OUTDIR}/init_new.nc")
+                gid = eccodes.codes_new_from_message(message)
+                spectral = eccodes.codes_get(gid, 'gridType') == 'sh'
+                values = eccodes.codes_get_values(gid)
+                missing = None
+                if not spectral and eccodes.codes_get(gid, 'bitmapPresent'):
+                    missing = values == eccodes.codes_get(gid, 'missingValue')
+                for operation in todo:
+                    values = _apply(values, operation, spectral, fields, record['level'])
+                if missing is not None:
+                    values = np.where(missing, eccodes.codes_get(gid, 'missingValue'), values)
+                eccodes.codes_set_values(gid, values)
+                eccodes.codes_write(gid, fout)
+                eccodes.codes_release(gid)
+                modified += 1
+    except BaseException:
+        os.remove(tmpfile)
+        raise
+    # mkstemp creates the file readable by the owner only
+    os.chmod(tmpfile, 0o644)
+    os.replace(tmpfile, outfile)
+    return modified
 
-cdo.setgrid(f"{INDIR}/{OIFS_INIT}", input=f"{OUTDIR}/init_new.nc", output=f"{OUTDIR}/init_new.nc", options="-f grb --eccodes")
-#subprocess.call(["cdo", "--eccodes", "-f", "grb", f"-setgrid,{INDIR}/{OIFS_INIT}", f"{OUTDIR}/init_new.nc",
-#                 f"{OUTDIR}/{OIFS_INIT}"])
 
-shutil.move(f"{INDIR}/ICMGGECE4INIUA", f"{OUTDIR}/ICMGGECE4INIUA")
-#subprocess.call(["cp", f"{INDIR}/ICMGGECE4INIUA", f"{OUTDIR}/ICMGGECE4INIUA"])
+if __name__ == "__main__":
 
-for file in os.listdir(OUTDIR):
-    if file.endswith(".nc") or file.endswith(".grb"):
-        os.remove(os.path.join(OUTDIR, file))
+    os.makedirs(OUTDIR, exist_ok=True)
+    for filename, ops in MODIFICATIONS.items():
+        print(filename)
+        if ops:
+            count = modify_grib(f"{INDIR}/{filename}", f"{OUTDIR}/{filename}", ops)
+            print(f"Modified {count} messages")
+        else:
+            shutil.copy(f"{INDIR}/{filename}", f"{OUTDIR}/{filename}")
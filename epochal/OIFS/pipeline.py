@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Minimal file-based pipeline for the OIFS IC/BC tools.
+
+Each step declares the files it reads and writes, dependencies are inferred from
+them and independent steps run concurrently in a bounded thread pool (the work is
+done by CDO and other external processes, so threads are enough). Completed steps
+are recorded in a state file: after a failure, a new run skips them and restarts
+from the first incomplete step. Intermediate files that have already been consumed
+(e.g. moved or cleaned) are not recomputed if all the steps needing them are done.
+Steps with a key (their operator chain) can be served from a content-addressed
+intermediate cache, shared between runs of different targets and dates.
+"""
+
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Step:
+    """
+    A pipeline step: a callable producing the output files from the input files.
+    The key describes the operation (e.g. the CDO operator chain): with the inputs, it
+    must fully determine the outputs for the step to be cached. Steps without key are never cached.
+    """
+
+    def __init__(self, name, func, inputs=None, outputs=None, key=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.key = key
+
+    def __repr__(self):
+        return f'Step({self.name}: {self.inputs} -> {self.outputs})'
+
+
+class Pipeline:
+    """ A set of steps, run in dependency order with resume from a state file. """
+
+    def __init__(self, steps, statefile, cache=None):
+        self.steps = {}
+        self.producer = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f'Duplicated step {step.name}')
+            self.steps[step.name] = step
+            for output in step.outputs:
+                if output in self.producer:
+                    raise ValueError(f'{output} is produced by both {self.producer[output]} and {step.name}')
+                self.producer[output] = step.name
+
+        self.deps = {name: {self.producer[path] for path in step.inputs if path in self.producer}
+                     for name, step in self.steps.items()}
+        self.users = {name: {user for user, deps in self.deps.items() if name in deps} for name in self.steps}
+        self.order = self._toposort()
+        self.statefile = statefile
+        self.cache = cache
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def _toposort(self):
+        """Steps in dependency order, failing on cycles"""
+
+        order, done = [], set()
+        remaining = dict(self.deps)
+        while remaining:
+            ready = [name for name, deps in remaining.items() if deps <= done]
+            if not ready:
+                raise ValueError(f'Dependency cycle between steps {sorted(remaining)}')
+            for name in ready:
+                order.append(name)
+                done.add(name)
+                del remaining[name]
+
+        return order
+
+    def _load_state(self):
+        if os.path.exists(self.statefile):
+            with open(self.statefile, 'r', encoding='utf-8') as fff:
+                return json.load(fff)
+        return {}
+
+    def _save_state(self, state):
+        with self._lock:
+            with open(self.statefile + '.tmp', 'w', encoding='utf-8') as fff:
+                json.dump(state, fff, indent=1)
+            os.replace(self.statefile + '.tmp', self.statefile)
+
+    def content_key(self, name):
+        """
+        Cache key of a step: its operator key and the identity of its inputs, i.e. the key
+        of the producing step for cached intermediates and the content hash for other files
+        """
+
+        with self._lock:
+            if name in self._keys:
+                return self._keys[name]
+
+        idents = []
+        for path in self.steps[name].inputs:
+            producer = self.producer.get(path)
+            if producer is not None and self.steps[producer].key is not None:
+                position = self.steps[producer].outputs.index(path)
+                idents.append(f'{self.content_key(producer)}:{position}')
+            else:
+                idents.append(self.cache.file_hash(path))
+        key = self.cache.make_key(self.steps[name].key, idents)
+
+        with self._lock:
+            self._keys[name] = key
+        return key
+
+    def pending(self, state=None):
+        """
+        Steps to be run: incomplete steps (not recorded as done, or with missing outputs)
+        whose outputs are final or needed by another step to be run
+        """
+
+        state = self._load_state() if state is None else state
+        todo = set()
+        for name in reversed(self.order):
+            step = self.steps[name]
+            complete = name in state and all(os.path.exists(path) for path in step.outputs)
+            needed = not self.users[name] or self.users[name] & todo
+            if not complete and needed:
+                todo.add(name)
+            # a rerun step needs fresh inputs, even from complete steps whose outputs are gone
+            if name in todo:
+                for dep in self.deps[name]:
+                    if not all(os.path.exists(path) for path in self.steps[dep].outputs):
+                        state.pop(dep, None)
+
+        return [name for name in self.order if name in todo]
+
+    def run(self, nproc=4):
+        """
+        Run the pending steps, with at most nproc of them at the same time
+
+        Returns:
+            A dictionary with the elapsed time (s) of each step run
+        """
+
+        state = self._load_state()
+        todo = self.pending(state)
+        missing = [path for name in todo for path in self.steps[name].inputs
+                   if path not in self.producer and not os.path.exists(path)]
+        if missing:
+            raise FileNotFoundError(f'Missing pipeline inputs: {missing}')
+        if len(todo) < len(self.steps):
+            print(f'Resuming: {len(self.steps) - len(todo)} of {len(self.steps)} steps already done')
+
+        timings = {}
+        failed = None
+        running = {}
+
+        def timed(step):
+            start = time.perf_counter()
+            if self.cache is None or step.key is None:
+                step.func()
+            else:
+                key = self.content_key(step.name)
+                with self.cache.reserve(key):
+                    if self.cache.fetch(key, step.outputs):
+                        print(f'Step {step.name} taken from the cache')
+                    else:
+                        step.func()
+                        self.cache.store(key, step.outputs)
+            return time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=nproc) as pool:
+            while todo or running:
+                if failed is None:
+                    for name in [name for name in todo if not self.deps[name] & (set(todo) | set(running.values()))]:
+                        print(f'Starting step {name}')
+                        running[pool.submit(timed, self.steps[name])] = name
+                        todo.remove(name)
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        timings[name] = future.result()
+                    except Exception as err:
+                        print(f'Step {name} failed: {err}')
+                        failed = failed or (name, err)
+                        continue
+                    state[name] = {'outputs': self.steps[name].outputs, 'seconds': timings[name]}
+                    self._save_state(state)
+
+        if failed:
+            raise RuntimeError(f'Step {failed[0]} failed, rerun to resume') from failed[1]
+
+        return timings
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Reusable spatial index of the points of a grid (ORCA meshes, reduced Gaussian grids),
+built as a KD-tree on 3D unit vectors so that distances are exact chords on the sphere,
+with no issues at the poles or across the dateline. Queries are batched (k-NN and
+radius), and the tree can be saved to disk or cached by a hash of the points, so
+that repeated nearest-neighbour remaps and mask adjustments do not rebuild it.
+GRIB files (e.g. the gridpoint ICs) are remapped onto reduced Gaussian grids with
+ecCodes in a single pass, searching the neighbours once per source grid.
+"""
+
+import os
+import pickle
+import hashlib
+import tempfile
+import argparse
+import numpy as np
+import xarray as xr
+import eccodes
+from scipy.spatial import cKDTree
+from utils import to_xyz, reduced_gaussian_geometry
+from gaussian import gaussian_latitudes
+from spectral import set_gaussian_grid
+
+# earth radius (km), as in IFS and NEMO
+EARTH_RADIUS = 6371.229
+
+# default location of the index cache
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'epochal', 'index')
+
+# names of (lat, lon) in the grid files
+POINT_VARS = [('clat', 'clon'), ('lat', 'lon'), ('grid_center_lat', 'grid_center_lon'),
+              ('nav_lat', 'nav_lon'), ('latitude', 'longitude')]
+
+
+def chord_to_km(chord):
+    """Great-circle distance (km) of a chord on the unit sphere"""
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+def km_to_chord(distance):
+    """Chord on the unit sphere of a great-circle distance (km)"""
+
+    return 2 * np.sin(np.minimum(distance / EARTH_RADIUS, np.pi) / 2)
+
+
+def read_points(filename, mask=None):
+    """
+    Read the lat/lon (degrees) of the grid points of a file, and optionally a mask variable
+
+    Returns:
+        Flattened lat, lon and boolean mask (None if not requested), and the grid shape
+    """
+
+    with xr.open_dataset(filename) as ds:
+        for lat, lon in POINT_VARS:
+            if lat in ds.variables and lon in ds.variables:
+                break
+        else:
+            raise KeyError(f'No latitude/longitude found in {filename}')
+
+        coords = []
+        for name in [lat, lon]:
+            values = ds[name].values.astype('f8')
+            if ds[name].attrs.get('units', '').startswith('radian'):
+                values = np.rad2deg(values)
+            coords.append(values)
+        shape = coords[0].shape
+
+        wet = None
+        if mask:
+            # 3D masks are wet if any level is wet
+            extra = [dim for dim in ds[mask].dims if dim not in ds[lat].dims]
+            wet = (ds[mask].max(dim=extra) > 0.5).values.ravel()
+
+    return coords[0].ravel(), coords[1].ravel(), wet, shape
+
+
+class PointIndex:
+    """ A KD-tree of grid points on the unit sphere, optionally restricted to the masked points. """
+
+    def __init__(self, lat, lon, mask=None, shape=None):
+        lat, lon = np.asarray(lat, dtype='f8').ravel(), np.asarray(lon, dtype='f8').ravel()
+        self.shape = tuple(shape) if shape is not None else lat.shape
+        self.size = lat.size
+        # position of the indexed points in the flattened grid
+        self.points = np.flatnonzero(mask) if mask is not None else np.arange(lat.size)
+        self.tree = cKDTree(to_xyz(lat[self.points], lon[self.points]))
+
+    @classmethod
+    def from_file(cls, filename, mask=None):
+        """Index the points of a grid file, e.g. mask='mask' for the wet points of an ORCA grid"""
+
+        lat, lon, wet, shape = read_points(filename, mask)
+        return cls(lat, lon, mask=wet, shape=shape)
+
+    @classmethod
+    def cached(cls, lat, lon, mask=None, shape=None, cachedir=CACHE_DIR):
+        """Load the index of the points from the cache, building and storing it if missing"""
+
+        hasher = hashlib.blake2b(digest_size=16)
+        for arr in [lat, lon, mask]:
+            if arr is not None:
+                hasher.update(np.ascontiguousarray(arr, dtype='f8').tobytes())
+            hasher.update(b'|')
+        cachefile = os.path.join(cachedir, f'index_{hasher.hexdigest()}.pkl')
+
+        if os.path.exists(cachefile):
+            return cls.load(cachefile)
+
+        index = cls(lat, lon, mask=mask, shape=shape)
+        os.makedirs(cachedir, exist_ok=True)
+        fd, tmpfile = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fff:
+            pickle.dump(index, fff, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, cachefile)
+
+        return index
+
+    def save(self, filename):
+        """Serialize the index to disk"""
+
+        with open(filename, 'wb') as fff:
+            pickle.dump(self, fff, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(filename):
+        """Load an index saved with save()"""
+
+        with open(filename, 'rb') as fff:
+            return pickle.load(fff)
+
+    def query(self, lat, lon, k=1, max_distance=np.inf):
+        """
+        Batched k nearest neighbours of the query points (degrees)
+
+        Returns:
+            Distances (km) and positions in the flattened grid, with shape (..., k) if k > 1.
+            Missing neighbours beyond max_distance (km) have infinite distance and position -1.
+        """
+
+        xyz = to_xyz(np.asarray(lat, dtype='f8'), np.asarray(lon, dtype='f8'))
+        chord, found = self.tree.query(xyz, k=k, workers=-1,
+                                       distance_upper_bound=km_to_chord(max_distance))
+        missing = found == self.tree.n
+        positions = np.where(missing, -1, self.points[np.minimum(found, self.tree.n - 1)])
+
+        return np.where(missing, np.inf, chord_to_km(chord)), positions
+
+    def query_radius(self, lat, lon, radius):
+        """
+        Batched search of the grid points within radius (km) of the query points (degrees)
+
+        Returns:
+            An object array (same shape as the query) of arrays of positions in the flattened grid,
+            or a single array for a single query point
+        """
+
+        xyz = to_xyz(np.asarray(lat, dtype='f8'), np.asarray(lon, dtype='f8'))
+        found = self.tree.query_ball_point(xyz, km_to_chord(np.asarray(radius, dtype='f8')), workers=-1)
+        if xyz.ndim == 1:
+            return self.points[np.asarray(found, dtype=int)]
+
+        result = np.empty(xyz.shape[:-1], dtype=object)
+        for pos in np.ndindex(result.shape):
+            result[pos] = self.points[np.asarray(found[pos], dtype=int)]
+
+        return result
+
+    def remap_nn(self, data, lat, lon):
+        """Nearest-neighbour remap of (..., grid) data onto the query points"""
+
+        _, positions = self.query(lat, lon)
+        data = np.asarray(data)
+
+        return data.reshape(data.shape[:data.ndim - len(self.shape)] + (-1,))[..., positions]
+
+
+def remap_nn_grib(infile, outfile, nlat_half, points, cachedir=CACHE_DIR):
+    """
+    Nearest-neighbour remap of the gridpoint messages of a GRIB file onto a reduced Gaussian grid,
+    in a single pass. The index of each source grid is cached and queried once for all its messages.
+
+    Args:
+        nlat_half: Gaussian number of the target grid
+        points: points per row of the target grid
+    """
+
+    target = reduced_gaussian_geometry(gaussian_latitudes(nlat_half), points)
+    positions = {}
+    with open(infile, 'rb') as fin, open(outfile, 'wb') as fout:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(fin)
+            if gid is None:
+                break
+            grid = eccodes.codes_get(gid, 'md5GridSection')
+            if grid not in positions:
+                index = PointIndex.cached(eccodes.codes_get_array(gid, 'latitudes'),
+                                          eccodes.codes_get_array(gid, 'longitudes'), cachedir=cachedir)
+                positions[grid] = index.query(target['lat'], target['lon'])[1]
+            values = eccodes.codes_get_values(gid)[positions[grid]]
+            set_gaussian_grid(gid, nlat_half, points)
+            eccodes.codes_set_values(gid, values)
+            eccodes.codes_write(gid, fout)
+            eccodes.codes_release(gid)
+
+
+def get_args():
+    """Command line parser for the point index"""
+
+    parser = argparse.ArgumentParser(description="Build a spherical KD-tree index of the points of a grid file.")
+    parser.add_argument("gridfile", type=str, help="grid file with lat/lon of the points")
+    parser.add_argument("outfile", type=str, help="serialized index")
+    parser.add_argument("--mask", type=str, default=None,
+                        help="index only the points where this variable is > 0.5 (e.g. mask)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    idx = PointIndex.from_file(args.gridfile, mask=args.mask)
+    idx.save(args.outfile)
+    print(f'Indexed {len(idx.points)} of {idx.size} points in {args.outfile}')
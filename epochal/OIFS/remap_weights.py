@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+First-order conservative remapping weights between grids with cell corners,
+as produced by oifs_create_corners.py (clat_bnds/clon_bnds, in radians) and by
+orca_bounds.py (lat_bnds/lon_bnds CF or unstructured, and SCRIP files).
+
+Cells are spherical polygons with great-circle edges, as in CDO remapcon.
+Candidate source/target pairs are found with a KD-tree on the 3D unit vectors of
+the cell centres, and their overlap is computed for all the pairs at once by
+clipping the polygons (Sutherland-Hodgman on the sphere) with numpy arrays.
+Weights are stored as CSR matrices in a cache keyed by a hash of the two grids,
+so that later remaps only load the matrix and apply a single sparse product to
+all the levels and variables.
+"""
+
+import os
+import hashlib
+import tempfile
+import argparse
+import numpy as np
+import xarray as xr
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
+from utils import to_xyz
+
+# default location of the weights cache
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'epochal', 'remap')
+
+# number of source cells processed at once in the overlap computation
+BATCH = 100000
+
+# bump when the weights computation changes, to invalidate the cache
+VERSION = 1
+
+# names of (centre lat, centre lon, corner lat, corner lon, mask) in the grid files
+GRID_VARS = [
+    ('clat', 'clon', 'clat_bnds', 'clon_bnds', None),
+    ('lat', 'lon', 'lat_bnds', 'lon_bnds', 'mask'),
+    ('grid_center_lat', 'grid_center_lon', 'grid_corner_lat', 'grid_corner_lon', 'grid_imask')
+]
+
+
+def read_grid(filename):
+    """
+    Read cell centres, corners and mask from a grid file
+
+    Returns:
+        A dictionary with (cell) lat/lon, (cell, nv) lat_bnds/lon_bnds in degrees,
+        the (cell) boolean mask (None if missing) and the horizontal dims/shape
+    """
+
+    with xr.open_dataset(filename) as ds:
+        for lat, lon, lat_bnds, lon_bnds, mask in GRID_VARS:
+            if lat_bnds in ds.variables and lon_bnds in ds.variables:
+                break
+        else:
+            raise KeyError(f'No cell corners found in {filename}')
+
+        dims = ds[lat].dims
+        grid = {'dims': dims, 'shape': ds[lat].shape}
+        for key, name in [('lat', lat), ('lon', lon), ('lat_bnds', lat_bnds), ('lon_bnds', lon_bnds)]:
+            values = ds[name].values.astype('f8')
+            if ds[name].attrs.get('units', '').startswith('radian'):
+                values = np.rad2deg(values)
+            grid[key] = values.reshape((-1, values.shape[-1]) if key.endswith('bnds') else -1)
+
+        grid['mask'] = None
+        if mask and mask in ds.variables:
+            # 3D masks are wet if any level is wet
+            extra = [dim for dim in ds[mask].dims if dim not in dims]
+            grid['mask'] = (ds[mask].max(dim=extra) > 0.5).values.ravel() if extra else \
+                           (ds[mask] > 0.5).values.ravel()
+
+    return grid
+
+
+def _normalize(vec):
+    """Normalize vectors along the last axis, leaving zero vectors untouched"""
+
+    norm = np.linalg.norm(vec, axis=-1, keepdims=True)
+    return np.divide(vec, norm, out=np.zeros_like(vec), where=norm > 0)
+
+
+def polygons(grid):
+    """
+    Cell polygons as counterclockwise (cell, nv, 3) unit vectors,
+    with their centres and radii (max chord distance from centre to corners)
+    """
+
+    poly = to_xyz(grid['lat_bnds'], grid['lon_bnds'])
+    centre = _normalize(poly.sum(axis=1))
+
+    # reverse clockwise cells, e.g. the upper-left first corners of oifs_create_corners.py:
+    # the orientation is that of the summed edge cross products, robust to repeated corners
+    normal = np.cross(poly, np.roll(poly, -1, axis=1)).sum(axis=1)
+    clockwise = np.einsum('ij,ij->i', normal, centre) < 0
+    poly[clockwise] = poly[clockwise, ::-1]
+
+    radius = np.linalg.norm(poly - centre[:, np.newaxis], axis=-1).max(axis=1)
+
+    return poly, centre, radius
+
+
+def polygon_area(poly, count=None):
+    """Area on the unit sphere of convex (n, maxv, 3) polygons with count vertices, by triangle fans"""
+
+    nvert = poly.shape[1]
+    count = np.full(poly.shape[0], nvert) if count is None else count
+    area = np.zeros(poly.shape[0])
+    first = poly[:, 0]
+    for i in range(1, nvert - 1):
+        valid = i + 1 < count
+        second, third = poly[:, i], poly[:, i + 1]
+        triple = np.einsum('ij,ij->i', first, np.cross(second, third))
+        denom = 1 + np.einsum('ij,ij->i', first, second) + np.einsum('ij,ij->i', second, third) + \
+            np.einsum('ij,ij->i', third, first)
+        area += np.where(valid, 2 * np.arctan2(np.abs(triple), denom), 0.)
+
+    return area
+
+
+def clip_polygons(subject, clip):
+    """
+    Clip convex (n, ns, 3) subject polygons with convex counterclockwise (n, nc, 3) clip polygons,
+    one pair per row. Degenerate clip edges (repeated corners) are ignored.
+
+    Returns:
+        The (n, ns + nc, 3) clipped polygons and their number of vertices
+    """
+
+    npairs, nsub, nclip = subject.shape[0], subject.shape[1], clip.shape[1]
+    maxv = nsub + nclip
+    rows = np.arange(npairs)
+
+    poly = np.zeros((npairs, maxv, 3))
+    poly[:, :nsub] = subject
+    count = np.full(npairs, nsub)
+    normals = _normalize(np.cross(clip, np.roll(clip, -1, axis=1)))
+
+    for k in range(nclip):
+        normal = normals[:, k]
+        skip = ~normal.any(axis=1)
+        dist = np.einsum('ijk,ik->ij', poly, normal)
+        inside = (dist >= 0) | skip[:, np.newaxis]
+
+        out = np.zeros_like(poly)
+        nout = np.zeros(npairs, dtype=int)
+        for i in range(maxv):
+            valid = i < count
+            if not valid.any():
+                break
+            nxt = np.where(i + 1 < count, i + 1, 0)
+            in_p, in_q = inside[:, i], inside[rows, nxt]
+
+            # Sutherland-Hodgman: intersection when the edge crosses, then the next vertex if inside
+            cross = valid & (in_p != in_q)
+            if cross.any():
+                sel = rows[cross]
+                dist_p, dist_q = dist[sel, i], dist[sel, nxt[sel]]
+                vert_p, vert_q = poly[sel, i], poly[sel, nxt[sel]]
+                frac = (dist_p / (dist_p - dist_q))[:, np.newaxis]
+                out[sel, np.minimum(nout[sel], maxv - 1)] = _normalize(vert_p + frac * (vert_q - vert_p))
+                nout[sel] += 1
+
+            keep = valid & in_q
+            sel = rows[keep]
+            out[sel, np.minimum(nout[sel], maxv - 1)] = poly[sel, nxt[sel]]
+            nout[sel] += 1
+
+        poly, count = out, np.minimum(nout, maxv)
+
+    return poly, count
+
+
+def compute_weights(src, tgt, norm='fracarea', batch=BATCH):
+    """
+    Conservative remapping weights from the source to the target grid (see read_grid)
+
+    Args:
+        src (dict): source grid, masked cells are not used
+        tgt (dict): target grid
+        norm (str, optional): 'fracarea' (divide by the covered target area, as the CDO default)
+                              or 'destarea' (divide by the full target area)
+        batch (int, optional): number of source cells processed at once
+
+    Returns:
+        The (target, source) CSR matrix of weights
+    """
+
+    if norm not in ['fracarea', 'destarea']:
+        raise ValueError(f'Unknown normalization {norm}: available are fracarea and destarea')
+
+    src_poly, src_centre, src_radius = polygons(src)
+    tgt_poly, tgt_centre, tgt_radius = polygons(tgt)
+    active = np.flatnonzero(src['mask']) if src['mask'] is not None else np.arange(len(src_poly))
+    tree = cKDTree(tgt_centre)
+
+    rows, cols, overlaps = [], [], []
+    for start in range(0, len(active), batch):
+        isrc = active[start:start + batch]
+        cands = tree.query_ball_point(src_centre[isrc], src_radius[isrc] + tgt_radius.max(), workers=-1)
+        lengths = np.fromiter(map(len, cands), dtype=int, count=len(cands))
+        if not lengths.sum():
+            continue
+        pair_src = np.repeat(isrc, lengths)
+        pair_tgt = np.concatenate(cands).astype(int)
+
+        near = np.linalg.norm(src_centre[pair_src] - tgt_centre[pair_tgt], axis=1) <= \
+            src_radius[pair_src] + tgt_radius[pair_tgt]
+        pair_src, pair_tgt = pair_src[near], pair_tgt[near]
+
+        poly, count = clip_polygons(src_poly[pair_src], tgt_poly[pair_tgt])
+        area = polygon_area(poly, count)
+        found = (count >= 3) & (area > 0)
+        rows.append(pair_tgt[found])
+        cols.append(pair_src[found])
+        overlaps.append(area[found])
+
+    rows, cols, overlaps = [np.concatenate(arr) if arr else np.zeros(0) for arr in [rows, cols, overlaps]]
+    weights = sp.csr_matrix((overlaps, (rows.astype(int), cols.astype(int))),
+                            shape=(len(tgt_poly), len(src_poly)))
+
+    if norm == 'fracarea':
+        denom = np.asarray(weights.sum(axis=1)).ravel()
+    else:
+        denom = polygon_area(tgt_poly)
+    scale = np.divide(1., denom, out=np.zeros_like(denom), where=denom > 0)
+
+    return sp.csr_matrix(sp.diags(scale) @ weights)
+
+
+def grid_hash(*grids, norm='fracarea'):
+    """Hash of the corners and masks of the grids, used as key of the weights cache"""
+
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f'{VERSION}-{norm}'.encode())
+    for grid in grids:
+        for key in ['lat_bnds', 'lon_bnds', 'mask']:
+            if grid[key] is not None:
+                hasher.update(np.ascontiguousarray(grid[key]).tobytes())
+            hasher.update(b'|')
+
+    return hasher.hexdigest()
+
+
+def load_weights(src, tgt, norm='fracarea', cachedir=CACHE_DIR):
+    """
+    Load the weights from the cache, computing and storing them if missing.
+    Grids are either grid files or dictionaries from read_grid.
+
+    Returns:
+        The (target, source) CSR matrix of weights
+    """
+
+    src = read_grid(src) if isinstance(src, str) else src
+    tgt = read_grid(tgt) if isinstance(tgt, str) else tgt
+    cachefile = os.path.join(cachedir, f'remapcon_{grid_hash(src, tgt, norm=norm)}.npz')
+
+    if os.path.exists(cachefile):
+        return sp.load_npz(cachefile)
+
+    print(f'Computing conservative weights ({len(src["lat"])} -> {len(tgt["lat"])} cells)')
+    weights = compute_weights(src, tgt, norm=norm)
+    os.makedirs(cachedir, exist_ok=True)
+    fd, tmpfile = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fff:
+        sp.save_npz(fff, weights)
+    os.replace(tmpfile, cachefile)
+
+    return weights
+
+
+def apply_weights(weights, data, renormalize=True):
+    """
+    Remap (..., source) data with a single sparse product over all the leading axes.
+    With renormalize, NaNs in the source are excluded and the weights rescaled by the
+    valid fraction; targets without valid sources are set to NaN.
+
+    Returns:
+        The (..., target) remapped data
+    """
+
+    data = np.asarray(data, dtype='f8')
+    lead = data.shape[:-1]
+    flat = data.reshape(-1, data.shape[-1]).T
+
+    covered = np.asarray(weights.sum(axis=1)).ravel()
+    if renormalize and np.isnan(flat).any():
+        valid = ~np.isnan(flat)
+        result = weights @ np.where(valid, flat, 0.)
+        frac = weights @ valid.astype('f8')
+        result = np.divide(result * covered[:, np.newaxis], frac, out=np.full_like(result, np.nan),
+                           where=frac > 0)
+    else:
+        result = weights @ flat
+        result[covered == 0] = np.nan
+
+    return result.T.reshape(lead + (weights.shape[0],))
+
+
+def remap_dataset(ds, weights, src, tgt):
+    """Remap all the variables of a dataset defined on the source horizontal dims"""
+
+    ds_out = xr.Dataset(attrs=ds.attrs)
+    for name, var in ds.data_vars.items():
+        if var.dims[-len(src['dims']):] != tuple(src['dims']) or \
+                var.shape[-len(src['dims']):] != tuple(src['shape']):
+            continue
+        lead = var.dims[:-len(src['dims'])]
+        values = var.values.reshape(var.shape[:len(lead)] + (-1,))
+        remapped = apply_weights(weights, values).reshape(var.shape[:len(lead)] + tuple(tgt['shape']))
+        ds_out[name] = xr.DataArray(remapped, dims=lead + tuple(tgt['dims']), attrs=var.attrs)
+
+    ds_out['lat'] = (tgt['dims'], tgt['lat'].reshape(tgt['shape']), {'standard_name': 'latitude',
+                                                                     'units': 'degrees_north'})
+    ds_out['lon'] = (tgt['dims'], tgt['lon'].reshape(tgt['shape']), {'standard_name': 'longitude',
+                                                                     'units': 'degrees_east'})
+
+    return ds_out.set_coords(['lat', 'lon'])
+
+
+def get_args():
+    """Command line parser for the remapping weights"""
+
+    parser = argparse.ArgumentParser(description="Conservative remapping weights between grids with corners.")
+    parser.add_argument("source", type=str, help="source grid file (with cell corners)")
+    parser.add_argument("target", type=str, help="target grid file (with cell corners)")
+    parser.add_argument("--norm", type=str, default='fracarea', choices=['fracarea', 'destarea'],
+                        help="normalization of the weights")
+    parser.add_argument("--cachedir", type=str, default=CACHE_DIR, help="directory of the weights cache")
+    parser.add_argument("--apply", type=str, nargs=2, default=None, metavar=('INFILE', 'OUTFILE'),
+                        help="remap the variables of a netCDF file on the source grid")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    src_grid, tgt_grid = read_grid(args.source), read_grid(args.target)
+    remap = load_weights(src_grid, tgt_grid, norm=args.norm, cachedir=args.cachedir)
+    print(f'{remap.nnz} weights, {np.count_nonzero(np.diff(remap.indptr))} of {remap.shape[0]} targets covered')
+    if args.apply:
+        with xr.open_dataset(args.apply[0]) as dsin:
+            remap_dataset(dsin, remap, src_grid, tgt_grid).to_netcdf(args.apply[1])
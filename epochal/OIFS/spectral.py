@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Spectral tools for the IFS spherical harmonics fields, in NumPy and ecCodes, without CDO.
+
+Coefficients are in the GRIB (ECMWF) order: for each zonal wavenumber m, the total
+wavenumbers n from m to the truncation, as interleaved real and imaginary parts.
+Truncation is a vectorized index remap, applied message by message to GRIB1 and GRIB2
+alike. The transforms between spherical harmonics and (regular or reduced) Gaussian
+grids combine NumPy FFTs along the rows with associated Legendre matrices, which are
+computed for the northern hemisphere only (using their symmetry) and cached on disk
+per truncation and Gaussian number. GRIB2 files are transformed all the levels of a
+variable at once, converting the grid and packing of the messages in place.
+
+Legendre functions are normalized such that their squared integral on [-1, 1] is 2,
+so that the first coefficient is the global mean of the field, without Condon-Shortley phase.
+"""
+
+import os
+import tempfile
+import functools
+import argparse
+import numpy as np
+import eccodes
+from gaussian import gaussian_quadrature, gaussian_latitudes
+
+# default location of the Legendre tables
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'epochal', 'legendre')
+
+# truncation of the unpacked subset of the complex packing, as in the IFS files
+SUBTRUNCATION = 20
+
+
+@functools.lru_cache(maxsize=None)
+def spectral_index(truncation):
+    """Zonal (m) and total (n) wavenumbers of the coefficients of a triangular truncation"""
+
+    m_index = np.concatenate([np.full(truncation + 1 - m, m) for m in range(truncation + 1)])
+    n_index = np.concatenate([np.arange(m, truncation + 1) for m in range(truncation + 1)])
+    for arr in [m_index, n_index]:
+        arr.flags.writeable = False
+
+    return m_index, n_index
+
+
+def spectral_truncation(size):
+    """Triangular truncation of a GRIB array of coefficients of the given size"""
+
+    truncation = int(round((np.sqrt(4 * size + 1) - 3) / 2))
+    if (truncation + 1) * (truncation + 2) != size:
+        raise ValueError(f"{size} values are not the coefficients of a triangular truncation")
+
+    return truncation
+
+
+def truncate(coeffs, truncation):
+    """
+    Change the truncation of GRIB coefficients (..., 2 * ncoeffs), by an index remap:
+    coefficients beyond the new truncation are dropped, missing ones are set to zero
+    """
+
+    coeffs = np.asarray(coeffs)
+    source = spectral_truncation(coeffs.shape[-1])
+    m_index, n_index = spectral_index(truncation)
+    common = n_index <= source
+    # position of the (m, n) pairs in the source ordering
+    position = m_index * (source + 1) - m_index * (m_index - 1) // 2 + n_index - m_index
+
+    pairs = coeffs.reshape(coeffs.shape[:-1] + (-1, 2))
+    result = np.zeros(coeffs.shape[:-1] + (m_index.size, 2), dtype=coeffs.dtype)
+    result[..., common, :] = pairs[..., position[common], :]
+
+    return result.reshape(coeffs.shape[:-1] + (-1,))
+
+
+def _legendre(truncation, mu):
+    """Normalized associated Legendre functions (ncoeffs, nmu) by the standard recurrences"""
+
+    m_index, n_index = spectral_index(truncation)
+    table = np.empty((m_index.size, mu.size))
+    sine = np.sqrt(1 - mu**2)
+    p_mm = np.ones_like(mu)
+    start = 0
+    for m in range(truncation + 1):
+        if m > 0:
+            p_mm = np.sqrt((2 * m + 1) / (2 * m)) * sine * p_mm
+        table[start] = p_mm
+        if m < truncation:
+            table[start + 1] = np.sqrt(2 * m + 3) * mu * p_mm
+        for n in range(m + 2, truncation + 1):
+            a_nm = np.sqrt((4 * n**2 - 1) / (n**2 - m**2))
+            b_nm = np.sqrt(((n - 1)**2 - m**2) / (4 * (n - 1)**2 - 1))
+            row = start + n - m
+            table[row] = a_nm * (mu * table[row - 1] - b_nm * table[row - 2])
+        start += truncation + 1 - m
+
+    return table
+
+
+@functools.lru_cache(maxsize=8)
+def legendre_table(truncation, nlat_half, cachedir=CACHE_DIR):
+    """
+    Legendre functions at the northern Gaussian latitudes (ncoeffs, nlat_half), loaded
+    from the disk cache (memory-mapped) or computed and stored there
+    """
+
+    cachefile = os.path.join(cachedir, f'legendre_T{truncation}_N{nlat_half}.npy')
+    if not os.path.exists(cachefile):
+        table = _legendre(truncation, gaussian_quadrature(nlat_half)[0][:nlat_half])
+        os.makedirs(cachedir, exist_ok=True)
+        # unique temporary name, the same table may be built by concurrent jobs
+        fd, tmpfile = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fff:
+            np.save(fff, table)
+        os.replace(tmpfile, cachefile)
+
+    return np.load(cachefile, mmap_mode='r')
+
+
+def _row_points(nlat_half, points):
+    """Points per row, regular linear grid if not given"""
+
+    if points is None:
+        return np.full(2 * nlat_half, 4 * nlat_half)
+    points = np.asarray(points, dtype=int)
+    if points.size != 2 * nlat_half:
+        raise ValueError(f"{points.size} rows given for a grid with {2 * nlat_half} latitudes")
+
+    return points
+
+
+def _parity_slices(truncation):
+    """For each m, the slices of the coefficients symmetric and antisymmetric about the equator"""
+
+    starts = np.cumsum([0] + [truncation + 1 - m for m in range(truncation + 1)])
+    return [(slice(starts[m], starts[m + 1], 2), slice(starts[m] + 1, starts[m + 1], 2))
+            for m in range(truncation + 1)]
+
+
+def sh_to_grid(coeffs, nlat_half, points=None, cachedir=CACHE_DIR):
+    """
+    Inverse transform of GRIB coefficients (..., 2 * ncoeffs) to a Gaussian grid
+
+    Args:
+        nlat_half: Gaussian number of the grid (latitudes between pole and equator)
+        points: points per row for a reduced grid, regular linear grid (4 * nlat_half longitudes) if None
+
+    Returns:
+        Gridpoint values (..., npoints), from north to south and from longitude 0
+    """
+
+    coeffs = np.asarray(coeffs, dtype='f8')
+    truncation = spectral_truncation(coeffs.shape[-1])
+    table = legendre_table(truncation, nlat_half, cachedir)
+    spec = coeffs[..., 0::2] + 1j * coeffs[..., 1::2]
+    lead = spec.shape[:-1]
+    spec = spec.reshape(-1, spec.shape[-1])
+
+    # Fourier coefficients of each row, northern rows from symmetric plus antisymmetric parts
+    fourier = np.zeros((spec.shape[0], truncation + 1, 2 * nlat_half), dtype=complex)
+    for m, (even, odd) in enumerate(_parity_slices(truncation)):
+        sym, anti = spec[:, even] @ table[even], spec[:, odd] @ table[odd]
+        fourier[:, m, :nlat_half] = sym + anti
+        fourier[:, m, nlat_half:] = (sym - anti)[:, ::-1]
+
+    points = _row_points(nlat_half, points)
+    offsets = np.concatenate([[0], np.cumsum(points)])
+    values = np.empty((spec.shape[0], offsets[-1]))
+    # rows with the same number of points are transformed together
+    for nlon in np.unique(points):
+        rows = np.flatnonzero(points == nlon)
+        nwave = min(truncation + 1, nlon // 2 + 1)
+        modes = fourier[:, :nwave, rows].transpose(0, 2, 1).copy()
+        if nlon % 2 == 0 and nwave == nlon // 2 + 1:
+            modes[..., -1] *= 2
+        field = np.fft.irfft(modes, n=nlon, axis=-1) * nlon
+        for num, row in enumerate(rows):
+            values[:, offsets[row]:offsets[row + 1]] = field[:, num]
+
+    return values.reshape(lead + (-1,))
+
+
+def grid_to_sh(values, truncation, nlat_half, points=None, cachedir=CACHE_DIR):
+    """
+    Direct transform of Gaussian gridpoint values (..., npoints) to GRIB coefficients (..., 2 * ncoeffs)
+
+    Args:
+        truncation: triangular truncation of the coefficients
+        nlat_half: Gaussian number of the grid (latitudes between pole and equator)
+        points: points per row for a reduced grid, regular linear grid (4 * nlat_half longitudes) if None
+    """
+
+    values = np.asarray(values, dtype='f8')
+    points = _row_points(nlat_half, points)
+    offsets = np.concatenate([[0], np.cumsum(points)])
+    if values.shape[-1] != offsets[-1]:
+        raise ValueError(f"{values.shape[-1]} values given for a grid with {offsets[-1]} points")
+    lead = values.shape[:-1]
+    values = values.reshape(-1, values.shape[-1])
+
+    # Fourier coefficients of each row, up to the truncation or to the resolved wavenumbers
+    fourier = np.zeros((values.shape[0], truncation + 1, 2 * nlat_half), dtype=complex)
+    for nlon in np.unique(points):
+        rows = np.flatnonzero(points == nlon)
+        field = np.stack([values[:, offsets[row]:offsets[row + 1]] for row in rows], axis=1)
+        modes = np.fft.rfft(field, axis=-1) / nlon
+        nwave = min(truncation + 1, nlon // 2 + 1)
+        if nlon % 2 == 0 and nwave == nlon // 2 + 1:
+            modes[..., nlon // 2] /= 2
+        fourier[:, :nwave, rows] = modes[..., :nwave].transpose(0, 2, 1)
+
+    # Gaussian quadrature, folding the southern rows onto the northern ones
+    weights = gaussian_quadrature(nlat_half)[1][:nlat_half] / 2
+    north, south = fourier[..., :nlat_half], fourier[..., nlat_half:][..., ::-1]
+    sym, anti = (north + south) * weights, (north - south) * weights
+    table = legendre_table(truncation, nlat_half, cachedir)
+    spec = np.empty((values.shape[0], spectral_index(truncation)[0].size), dtype=complex)
+    for m, (even, odd) in enumerate(_parity_slices(truncation)):
+        spec[:, even] = sym[:, m] @ table[even].T
+        spec[:, odd] = anti[:, m] @ table[odd].T
+    spec[:, :truncation + 1] = spec[:, :truncation + 1].real
+
+    coeffs = np.stack([spec.real, spec.imag], axis=-1).reshape(values.shape[0], -1)
+    return coeffs.reshape(lead + (-1,))
+
+
+def truncate_grib(infile, outfile, truncation, names=None):
+    """
+    Truncate all the spectral messages of a GRIB file (GRIB1 and GRIB2 alike) in a single pass,
+    copying the gridpoint messages unchanged. If names are given, only these variables are kept.
+    """
+
+    with open(infile, 'rb') as fin, open(outfile, 'wb') as fout:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(fin)
+            if gid is None:
+                break
+            if names is not None and eccodes.codes_get(gid, 'shortName') not in names:
+                eccodes.codes_release(gid)
+                continue
+            if eccodes.codes_get(gid, 'gridType') == 'sh':
+                coeffs = truncate(eccodes.codes_get_values(gid), truncation)
+                for key in ['J', 'K', 'M']:
+                    eccodes.codes_set(gid, key, truncation)
+                # the unpacked subset of complex packing cannot exceed the truncation
+                if eccodes.codes_is_defined(gid, 'JS') and eccodes.codes_get(gid, 'JS') > truncation:
+                    for key in ['JS', 'KS', 'MS']:
+                        eccodes.codes_set(gid, key, truncation)
+                eccodes.codes_set_values(gid, coeffs)
+            eccodes.codes_write(gid, fout)
+            eccodes.codes_release(gid)
+
+
+def _variables(filename, names=None):
+    """Handles of the messages of a GRIB file, grouped by consecutive messages of the same variable"""
+
+    group = []
+    with open(filename, 'rb') as fff:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(fff)
+            if gid is None:
+                break
+            name = eccodes.codes_get(gid, 'shortName')
+            if names is not None and name not in names:
+                eccodes.codes_release(gid)
+                continue
+            if group and eccodes.codes_get(group[0], 'shortName') != name:
+                yield group
+                group = []
+            group.append(gid)
+    if group:
+        yield group
+
+
+def _check_edition(gid):
+    """Fail on GRIB1 messages, whose grid and packing cannot be converted in place"""
+
+    if eccodes.codes_get(gid, 'edition') != 2:
+        raise ValueError(f"{eccodes.codes_get(gid, 'shortName')} is GRIB1: only GRIB2 messages can be transformed")
+
+
+def set_gaussian_grid(gid, nlat_half, points=None):
+    """
+    Turn a gridpoint message into a Gaussian grid message, regular linear if points are not given.
+    Spectral messages must be GRIB2, since GRIB1 cannot change their packing in place.
+    """
+
+    if eccodes.codes_get(gid, 'gridType') == 'sh':
+        _check_edition(gid)
+    nlon = 4 * nlat_half if points is None else max(points)
+    latitudes = gaussian_latitudes(nlat_half)
+    eccodes.codes_set(gid, 'gridType', 'regular_gg' if points is None else 'reduced_gg')
+    eccodes.codes_set(gid, 'packingType', 'grid_simple')
+    eccodes.codes_set(gid, 'N', nlat_half)
+    eccodes.codes_set(gid, 'Nj', 2 * nlat_half)
+    if points is None:
+        eccodes.codes_set(gid, 'Ni', nlon)
+    else:
+        eccodes.codes_set_long_array(gid, 'pl', points)
+    for key, value in [('latitudeOfFirstGridPointInDegrees', latitudes[0]),
+                       ('latitudeOfLastGridPointInDegrees', latitudes[-1]),
+                       ('longitudeOfFirstGridPointInDegrees', 0),
+                       ('longitudeOfLastGridPointInDegrees', 360 - 360 / nlon)]:
+        eccodes.codes_set(gid, key, value)
+
+
+def _set_spectral(gid, coeffs, truncation):
+    """Turn a GRIB2 gridpoint message into a spectral message with complex packing of the coefficients"""
+
+    _check_edition(gid)
+    if eccodes.codes_get(gid, 'bitmapPresent'):
+        raise ValueError(f"{eccodes.codes_get(gid, 'shortName')} has missing values, it cannot be transformed")
+    eccodes.codes_set(gid, 'gridType', 'sh')
+    for key in ['J', 'K', 'M']:
+        eccodes.codes_set(gid, key, truncation)
+    # the coefficients are set before the packing, which requires the new number of values
+    eccodes.codes_set_values(gid, coeffs)
+    eccodes.codes_set(gid, 'packingType', 'spectral_complex')
+    for key in ['JS', 'KS', 'MS']:
+        eccodes.codes_set(gid, key, min(SUBTRUNCATION, truncation))
+    eccodes.codes_set_values(gid, coeffs)
+
+
+def sh_to_grid_grib(infile, outfile, nlat_half, points=None, names=None):
+    """
+    Transform the spectral messages of a GRIB2 file to a Gaussian grid, in a single pass,
+    copying the gridpoint messages unchanged. If names are given, only these variables are kept.
+
+    Args:
+        nlat_half: Gaussian number of the grid (latitudes between pole and equator)
+        points: points per row for a reduced grid, regular linear grid if None
+    """
+
+    with open(outfile, 'wb') as fout:
+        for gids in _variables(infile, names):
+            spectral = [gid for gid in gids if eccodes.codes_get(gid, 'gridType') == 'sh']
+            if spectral:
+                coeffs = np.stack([eccodes.codes_get_values(gid) for gid in spectral])
+                for gid, values in zip(spectral, sh_to_grid(coeffs, nlat_half, points)):
+                    set_gaussian_grid(gid, nlat_half, points)
+                    eccodes.codes_set_values(gid, values)
+            for gid in gids:
+                eccodes.codes_write(gid, fout)
+                eccodes.codes_release(gid)
+
+
+def grid_to_sh_grib(infile, outfile, truncation, names=None):
+    """
+    Transform the Gaussian gridpoint messages (regular or reduced) of a GRIB2 file to spherical
+    harmonics, in a single pass, copying the spectral messages unchanged. If names are given,
+    only these variables are kept.
+    """
+
+    with open(outfile, 'wb') as fout:
+        for gids in _variables(infile, names):
+            gaussian = [gid for gid in gids if eccodes.codes_get(gid, 'gridType') in ['regular_gg', 'reduced_gg']]
+            if gaussian:
+                nlat_half = eccodes.codes_get(gaussian[0], 'N')
+                points = None
+                if eccodes.codes_get(gaussian[0], 'gridType') == 'reduced_gg':
+                    points = eccodes.codes_get_array(gaussian[0], 'pl')
+                values = np.stack([eccodes.codes_get_values(gid) for gid in gaussian])
+                for gid, coeffs in zip(gaussian, grid_to_sh(values, truncation, nlat_half, points)):
+                    _set_spectral(gid, coeffs, truncation)
+            for gid in gids:
+                eccodes.codes_write(gid, fout)
+                eccodes.codes_release(gid)
+
+
+def get_args():
+    """Command line parser for the spectral truncation"""
+
+    parser = argparse.ArgumentParser(description="Change the spectral truncation of the fields of a GRIB file.")
+    parser.add_argument("infile", type=str, help="GRIB file with spherical harmonics fields")
+    parser.add_argument("outfile", type=str, help="truncated GRIB file")
+    parser.add_argument("truncation", type=int, help="target triangular truncation, e.g. 63")
+    parser.add_argument("--names", type=str, nargs='+', default=None, help="variables to keep, e.g. lnsp vo t d z")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    truncate_grib(args.infile, args.outfile, args.truncation, names=args.names)
@@ -1,5 +1,7 @@
 """Some utilities for OIFS grid definition"""
 import re
+import functools
+import numpy as np
 
 def ecmwf_grid(kind):
     """Get the info on the grid to find the right ECMWF file"""
@@ -33,3 +35,59 @@ def spectral2gaussian(spectral, kind):
         return int((int(spectral) + 1) / 2)
 
     raise ValueError("Unknown grid type")
+
+@functools.lru_cache(maxsize=None)
+def _reduced_gaussian_geometry(lat, reduced_points):
+    """Memoized worker of reduced_gaussian_geometry, on hashable tuples"""
+
+    lat = np.array(lat, dtype=float)
+    rp = np.array(reduced_points, dtype=int)
+
+    # the hypothesis is that the latitudinal bands are equally spaced, so that corners lie on the midpoints
+    lat_upper = lat.copy()
+    lat_upper[:-1] = lat[:-1] + .5 * (lat[:-1] - lat[1:])
+    lat_upper[-1] = -lat_upper[1]
+    lat_lower = lat.copy()
+    lat_lower[:-1] = lat_upper[1:]
+    lat_lower[-1] = -lat_upper[0]
+
+    # row of each point and its index along the row, from the cumulative offsets of the rows
+    row = np.repeat(np.arange(rp.size), rp)
+    num = rp[row]
+    index = np.arange(rp.sum()) - np.repeat(np.cumsum(rp) - rp, rp)
+
+    # similar assumption is done for the longitudes
+    lons, lons_left, lons_right = [np.where(x > 180, x - 360., x) for x in
+                                   [index / num * 360, (index - .5) / num * 360, (index + .5) / num * 360]]
+    lats_upper, lats_lower = lat_upper[row], lat_lower[row]
+
+    geometry = {
+        'lat': lat[row],
+        'lon': lons,
+        'corners_lat': np.stack([lats_upper, lats_upper, lats_lower, lats_lower], axis=-1),
+        'corners_lon': np.stack([lons_left, lons_right, lons_right, lons_left], axis=-1)
+    }
+    # cached arrays are shared between callers
+    for arr in geometry.values():
+        arr.flags.writeable = False
+
+    return geometry
+
+def reduced_gaussian_geometry(lat, reduced_points):
+    """
+    Centres and corners (degrees) of a reduced Gaussian grid from its latitudes and
+    number of points per row. Results are memoized per grid and read-only.
+
+    Returns:
+        A dictionary with (points) lat/lon and (points, 4) corners_lat/corners_lon,
+        corners ordered as upper-left, upper-right, lower-right, lower-left
+    """
+
+    return _reduced_gaussian_geometry(tuple(np.asarray(lat, dtype=float).tolist()),
+                                      tuple(np.asarray(reduced_points, dtype=int).tolist()))
+
+def to_xyz(lat, lon):
+    """3D unit vectors of lat/lon in degrees"""
+
+    lat, lon = np.deg2rad(lat), np.deg2rad(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
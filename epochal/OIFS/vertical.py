@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Vertical remapping of IFS fields between hybrid sigma-pressure levels, in NumPy.
+
+Half and full level pressures are computed from the a/b coefficients (the grids/L*.txt
+tables, or the PV array of the GRIB messages) and the surface pressure. All the columns
+are interpolated at once, linearly in the logarithm of pressure; above the top level
+the values are kept constant and below the lowest level temperature is extrapolated
+with the standard lapse rate as in the ECMWF post-processing, other fields kept constant.
+GRIB files are remapped in a single pass, directly on the message arrays.
+"""
+
+import argparse
+import numpy as np
+import eccodes
+
+# dry air gas constant (J/kg/K), gravity (m/s2) and standard lapse rate (K/m), as in IFS
+RD = 287.0597
+GRAVITY = 9.80665
+LAPSE_RATE = 0.0065
+
+
+def read_ab(filename):
+    """a (Pa) and b coefficients of the half levels, from a CDO vct table as grids/L91.txt"""
+
+    table = np.loadtxt(filename)
+    return table[:, 1], table[:, 2]
+
+
+def half_level_pressure(a, b, ps):
+    """Pressure (Pa) of the half levels, (nlev+1, ...) for surface pressure ps (Pa)"""
+
+    ps = np.asarray(ps, dtype='f8')
+    return a.reshape((-1,) + (1,) * ps.ndim) + b.reshape((-1,) + (1,) * ps.ndim) * ps
+
+
+def full_level_pressure(a, b, ps):
+    """Pressure (Pa) of the full levels, (nlev, ...), mean of the bounding half levels"""
+
+    return half_level_pressure(0.5 * (a[:-1] + a[1:]), 0.5 * (b[:-1] + b[1:]), ps)
+
+
+def interp_log_pressure(data, p_src, p_tgt, temperature=False):
+    """
+    Interpolate columns linearly in log-pressure, all at once
+
+    Args:
+        data: source values (nsrc, ...)
+        p_src: source pressure (nsrc, ...), increasing along the first axis
+        p_tgt: target pressure (ntgt, ...), increasing along the first axis
+        temperature: extrapolate below the lowest source level with the standard lapse rate
+
+    Returns:
+        The values at the target pressure (ntgt, ...)
+    """
+
+    lp_src, lp_tgt = np.log(p_src), np.log(p_tgt)
+    nsrc = lp_src.shape[0]
+    if nsrc < 2:
+        raise ValueError('At least two source levels are needed')
+
+    # number of source levels above each target pressure: pairs of source/target levels
+    # ordered the same way in all the columns are counted per level, the others per column
+    axes = tuple(range(1, lp_src.ndim))
+    src_min, src_max = lp_src.min(axis=axes), lp_src.max(axis=axes)
+    tgt_min, tgt_max = lp_tgt.min(axis=axes), lp_tgt.max(axis=axes)
+    always = src_max[None, :] <= tgt_min[:, None]
+    mixed = ~always & (src_min[None, :] <= tgt_max[:, None])
+    above = np.broadcast_to(always.sum(axis=1).reshape((-1,) + (1,) * len(axes)), lp_tgt.shape).copy()
+    for tgt, src in zip(*np.nonzero(mixed)):
+        above[tgt] += lp_src[src] <= lp_tgt[tgt]
+    upper = np.clip(above, 1, nsrc - 1)
+    lower = upper - 1
+
+    lp_lower = np.take_along_axis(lp_src, lower, axis=0)
+    lp_upper = np.take_along_axis(lp_src, upper, axis=0)
+    # constant values beyond the source levels
+    weight = np.clip((lp_tgt - lp_lower) / (lp_upper - lp_lower), 0, 1)
+    result = (1 - weight) * np.take_along_axis(data, lower, axis=0) + \
+        weight * np.take_along_axis(data, upper, axis=0)
+
+    if temperature:
+        below = lp_tgt > lp_src[-1]
+        extrapolated = data[-1] * np.exp(RD * LAPSE_RATE / GRAVITY * (lp_tgt - lp_src[-1]))
+        result = np.where(below, extrapolated, result)
+
+    return result
+
+
+def remap_levels(data, ps, src_ab, tgt_ab, levels=None, temperature=False):
+    """
+    Remap fields (nsrc, ...) from source to target hybrid levels, given as (a, b) pairs
+
+    Args:
+        levels: source levels (1-based) of the data, if not all of them
+    """
+
+    p_src = full_level_pressure(*src_ab, ps)
+    if levels is not None:
+        p_src = p_src[np.asarray(levels) - 1]
+
+    return interp_log_pressure(data, p_src, full_level_pressure(*tgt_ab, ps), temperature=temperature)
+
+
+def _read_messages(inputs):
+    """Handles of the messages of the GRIB files, in order"""
+
+    for filename in inputs:
+        with open(filename, 'rb') as fff:
+            while True:
+                gid = eccodes.codes_grib_new_from_file(fff)
+                if gid is None:
+                    break
+                yield gid
+
+
+def remap_grib(inputs, output, vct):
+    """
+    Remap the multi-level hybrid fields of GRIB files to the levels of a vct table, in a single pass.
+    The surface pressure is taken from the gridpoint lnsp of the files, the source levels
+    from the PV array of the messages. Single-level fields are copied unchanged.
+    """
+
+    tgt_a, tgt_b = read_ab(vct)
+    fields = {}
+    lnsp = None
+    with open(output, 'wb') as out:
+        for gid in _read_messages(inputs):
+            name = eccodes.codes_get(gid, 'shortName')
+            if name == 'lnsp' and eccodes.codes_get(gid, 'gridType') != 'sh':
+                lnsp = eccodes.codes_get_values(gid)
+            if eccodes.codes_get(gid, 'typeOfLevel') == 'hybrid' and name not in ['lnsp', 'z']:
+                # messages are kept packed until their variable is remapped
+                fields.setdefault(name, []).append(gid)
+            else:
+                eccodes.codes_write(gid, out)
+                eccodes.codes_release(gid)
+
+        if lnsp is None:
+            raise ValueError(f'No gridpoint lnsp found in {inputs}')
+        ps = np.exp(lnsp)
+
+        for name, gids in fields.items():
+            if len(gids) == 1:
+                eccodes.codes_write(gids[0], out)
+                eccodes.codes_release(gids[0])
+                continue
+            gids.sort(key=lambda gid: eccodes.codes_get(gid, 'level'))
+            pv = eccodes.codes_get_double_array(gids[0], 'pv')
+            if pv.size < 4:
+                raise ValueError(f'No vertical coordinates in the messages of {name}')
+            levels = [eccodes.codes_get(gid, 'level') for gid in gids]
+            data = np.stack([eccodes.codes_get_values(gid) for gid in gids])
+            if data.shape[1] != ps.size:
+                raise ValueError(f'{name} has {data.shape[1]} points, lnsp has {ps.size}')
+
+            remapped = remap_levels(data, ps, (pv[:pv.size // 2], pv[pv.size // 2:]), (tgt_a, tgt_b),
+                                    levels=levels, temperature=name == 't')
+            for level, values in enumerate(remapped, start=1):
+                clone = eccodes.codes_clone(gids[0])
+                eccodes.codes_set(clone, 'PVPresent', 1)
+                eccodes.codes_set_double_array(clone, 'pv', np.concatenate([tgt_a, tgt_b]))
+                eccodes.codes_set(clone, 'level', level)
+                eccodes.codes_set_values(clone, values)
+                eccodes.codes_write(clone, out)
+                eccodes.codes_release(clone)
+            for gid in gids:
+                eccodes.codes_release(gid)
+
+
+def get_args():
+    """Command line parser for the vertical remapping"""
+
+    parser = argparse.ArgumentParser(description="Remap GRIB fields on hybrid levels to other hybrid levels.")
+    parser.add_argument("inputs", type=str, nargs='+', help="GRIB files with the fields and the gridpoint lnsp")
+    parser.add_argument("output", type=str, help="remapped GRIB file")
+    parser.add_argument("--vct", type=str, required=True, help="a/b table of the target levels, e.g. grids/L31.txt")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    remap_grib(args.inputs, args.output, args.vct)